@@ -1,63 +1,88 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+
 import numpy as np
 import pandas as pd
 
+# Bump whenever Kida produces different DataFrames from the same files, so 
+# that older network caches are not reused.
+PARSER_VERSION = 4
+
+# Below this many reactions parsing the files is about as fast as loading 
+# the cache, so Kida.load does not use one.
+CACHE_MIN_REACTIONS = 2000
+
+# Names of the 22 element count columns of a KIDA species file. The networks 
+# in data/ only use C, O and Si; the other columns are named by position.
+ELEMENTS = tuple({3: 'C', 5: 'O', 6: 'Si'}.get(n, 'E{0}'.format(n)) for n in range(22))
+
 
 class Grains:
     def __init__(self,r_min,r_max,Ratio,Hamaker,density,num):
         self.column_names = ['Input1','Input2','Output1','Output2',
                         'f_ijk','K_ij','Hamaker','Radius1','Radius2','Fo']
+        self.spec_names=["species","charge","species_num","mass"]
         self.r_min = r_min
         self.r_max = r_max
         self.R = Ratio    
         self.A = Hamaker
         self.p = density
-        self.rows_list = []
-        self.spec_list=[]
         self.num = num
     def _create_bins(self): 
         self.numbins = int(np.ceil(1+np.log((self.r_max/self.r_min)**3)/np.log(self.R)))
         self.r,self.v,self.m=np.zeros(self.numbins+1),np.zeros(self.numbins+1),\
                               np.zeros(self.numbins+1)
-        for n in np.arange(1,self.numbins+1):
-            self.r[n] = self.r_min*self.R**((n-1)/3)
-            self.v[n] = 4/3*np.pi*self.r_min**3*self.R**(n-1)
-            self.m[n] = self.p*4/3*np.pi*(self.r_min*100)**3*self.R**(n-1)
+        n = np.arange(1,self.numbins+1)
+        self.r[1:] = self.r_min*self.R**((n-1)/3)
+        self.v[1:] = 4/3*np.pi*self.r_min**3*self.R**(n-1)
+        self.m[1:] = self.p*4/3*np.pi*(self.r_min*100)**3*self.R**(n-1)
     def _create_coeffs(self,r,v,m,i,j,R):
+        # i and j are arrays of bin pairs. The new grain is split between 
+        # the bins below and above it by number, with the volume fraction 
+        # that conserves grain mass. Pairs that grow past the last species 
+        # bin (numbins-1) are put entirely into that bin.
         k = 1.380649e-23 # Boltzmann Constant
+        top = self.numbins-1
         rij = (r[i]**3+r[j]**3)**(1/3)
         vij = v[i]+v[j]
         muij = (m[i]*m[j])/(m[i]+m[j])
         Kij = np.pi*(r[i]+r[j])**2*np.sqrt((8*k)/(np.pi*muij))
-        bin_num = int(np.floor(1+3*np.log(rij/r[1])/np.log(R)))
-        fraction = (r[bin_num+1]**3-rij**3)/(r[bin_num+1]**3-r[bin_num]**3)
-        fraction2 = (r[bin_num+1]**3-rij**3)/(r[bin_num+1]**3-r[bin_num]**3)*(r[bin_num]/rij)
-        return rij,vij,Kij,bin_num,fraction,fraction2
-    def _create_reac_df(self):
+        bin_num = np.floor(1+3*np.log(rij/r[1])/np.log(R)).astype(np.int64)
+        inside = bin_num+1 <= top
+        lower = np.where(inside,bin_num,top-1)
+        upper = lower+1
+        fraction = (r[upper]**3-rij**3)/(r[upper]**3-r[lower]**3)
+        bin_num = np.where(inside,bin_num,top)
+        fraction = np.where(inside,fraction,1.0)
+        return rij,vij,Kij,bin_num,inside,fraction
+    def _create_reac_columns(self):
         self._create_bins()
-        for i in np.arange(1,self.numbins-1):
-            for j in np.arange(1,i+1):
-                rij,vij,Kij,bin_num,fraction,fraction2=self._create_coeffs(self.r,self.v,\
-                                                                           self.m,i,j,self.R)
-                in1=i+self.num
-                in2=j+self.num
-                out1=bin_num+self.num
-                if bin_num+self.num+1>self.numbins:
-                    out2=bin_num+self.num
-                else:
-                    out2=bin_num+self.num+1
-                reac_coeffs=[in1,in2,out1,out2,fraction2,Kij,self.A,self.r[i],self.r[j],6]
-                reac_row={k:v for k,v in zip(self.column_names,reac_coeffs)}
-                self.rows_list.append(reac_row)
-    def _create_spec_df(self):
-        self.spec_names=["species","charge","species_num","mass"]
-        for i in np.arange(1,self.numbins):
-            spec_coeffs = ["G"+str(i),0,i+self.num,self.m[i]]
-            spec_row = {k:v for k,v in zip(self.spec_names,spec_coeffs)}
-            self.spec_list.append(spec_row)
+        # All pairs 1 <= j <= i <= numbins-2, in the order i, then j
+        i,j = np.tril_indices(max(self.numbins-2,0))
+        i,j = i+1,j+1
+        rij,vij,Kij,bin_num,inside,fraction=self._create_coeffs(self.r,self.v,\
+                                                                self.m,i,j,self.R)
+        out1 = bin_num+self.num
+        out2 = np.where(inside,bin_num+1,bin_num)+self.num
+        reac_coeffs=[i+self.num,j+self.num,out1,out2,fraction,Kij,
+                     np.full(len(i),self.A),self.r[i],self.r[j],np.full(len(i),6)]
+        self.reac_columns = dict(zip(self.column_names,reac_coeffs))
+    def _create_spec_columns(self):
+        i = np.arange(1,self.numbins)
+        spec_coeffs = [np.char.add("G",i.astype(str)),np.zeros(len(i),dtype=np.int64),
+                       i+self.num,self.m[1:self.numbins]]
+        self.spec_columns = dict(zip(self.spec_names,spec_coeffs))
+    def output_columns(self):
+        self._create_reac_columns()
+        self._create_spec_columns()
+        return self.reac_columns, self.spec_columns
     def output(self):
-        self._create_reac_df()
-        self._create_spec_df()
-        return pd.DataFrame(self.rows_list,columns=self.column_names), pd.DataFrame(self.spec_list,columns=self.spec_names)
+        reac_columns, spec_columns = self.output_columns()
+        return pd.DataFrame(reac_columns,columns=self.column_names), \
+               pd.DataFrame(spec_columns,columns=self.spec_names)
 
 #
 
@@ -67,8 +92,6 @@ class Kida:
                         'alpha','beta','gamma','F','g','Type','Re','Tlo', 
                         'Thi','Fo','N','V','R']
         self.reac_col_widths=[11,23,11,10,34,11,11,11,9,9,5,3,7,7,3,5,2,3]
-        self.reac_dtypes={'Input1':str,'Input2':str,'Output1':str,'Output2':str,
-                          'Output3':str}
         self.reac_file = reac_file
         self.spec_file = spec_file
 
@@ -76,10 +99,12 @@ class Kida:
         if not hasattr(self, '_spec_dict'):
             raise Exception("Must read species first")
 
-        self._reac_df = pd.read_fwf(self.reac_file, comment='#', header=None,
-                          names=self.reac_col_names,widths=self.reac_col_widths,
-                          converters=self.reac_dtypes)
-        self._process_reactions_file()
+        species = self.reac_col_names[0:5]
+        records = fixed_width_records(self.reac_file, self.reac_col_widths)
+        data, masks = parse_records(records, self.reac_col_names, self._spec_dict,
+                                    species=species, integers=['Fo'],
+                                    strings=['Type'], name=self.reac_file)
+        self._reac_df = records_frame(data, masks, nullable=species)
 
     def read_species(self):
         self._spec_df = pd.read_fwf(self.spec_file, comment='#', header=None)
@@ -98,45 +123,294 @@ class Kida:
     def output(self):
         return  self._reac_df,self._spec_df, self._spec_dict
 
+    def composition(self, num_species=None, charge=True):
+        '''
+        Element composition matrix of the species: row i holds the number of 
+        atoms of each element in species i of the solution vector, plus the 
+        charge if charge. Only the elements that occur get a column. Rows 
+        past the KIDA species (num_species long, e.g. with grain bins) and 
+        the Photon row are zero.
+
+        Returns the matrix and the names of its columns.
+        '''
+        spec_df = self._spec_df
+        names = [name for name in ELEMENTS if spec_df[name].any()]
+        if charge:
+            names.append('charge')
+        if num_species is None:
+            num_species = self.num_species + 1
+        matrix = np.zeros((num_species, len(names)))
+        matrix[spec_df.species_num.to_numpy(dtype=np.int64)] = \
+            spec_df[names].to_numpy(dtype=float)
+        return matrix, names
+
+    def cache_key(self):
+        # Content hash of both input files and the parser version
+        digest = hashlib.sha256('CarBoN Kida {0}'.format(PARSER_VERSION).encode())
+        for path in (self.reac_file, self.spec_file):
+            with open(path, 'rb') as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+        return digest.hexdigest()[:32]
+
+    def load(self, cache_dir='cache'):
+        '''
+        Read the species and reactions, using the compiled network in
+        cache_dir/<cache_key> if there is one and writing it otherwise.
+        Reactions files with fewer than CACHE_MIN_REACTIONS reactions are 
+        always parsed. Returns True if the cache was used.
+        '''
+        with open(self.reac_file, 'rb') as f:
+            num_reactions = sum(1 for line in f if line.strip() and not line.startswith(b'#'))
+        if num_reactions < CACHE_MIN_REACTIONS:
+            self.read_species()
+            self.read_reactions()
+            return False
+        path = os.path.join(cache_dir, self.cache_key())
+        if os.path.isfile(os.path.join(path, 'network.json')):
+            try:
+                self.load_cache(path)
+                return True
+            except (OSError, ValueError, KeyError):
+                pass        # Unreadable cache, fall back to parsing
+        self.read_species()
+        self.read_reactions()
+        self.save_cache(path)
+        return False
+
+    def save_cache(self, path):
+        '''
+        Write the processed DataFrames and species dictionary to the 
+        directory path, one .npy file per column. A directory already at 
+        path, e.g. a stale or partial cache, is replaced.
+        '''
+        parent = os.path.dirname(os.path.abspath(path))
+        os.makedirs(parent, exist_ok=True)
+        tmp = tempfile.mkdtemp(dir=parent)
+        meta = {'parser_version': PARSER_VERSION,
+                'reac_file': os.path.basename(self.reac_file),
+                'spec_file': os.path.basename(self.spec_file),
+                'num_species': int(self.num_species),
+                'spec_dict': {k: int(v) for k, v in self._spec_dict.items()},
+                'frames': {}}
+        for name, df in (('reactions', self._reac_df), ('species', self._spec_df)):
+            meta['frames'][name] = _save_frame(df, os.path.join(tmp, name))
+        with open(os.path.join(tmp, 'network.json'), 'w') as f:
+            json.dump(meta, f, indent=1)
+        old = None
+        try:
+            if os.path.isdir(path):
+                # A directory can only be replaced by a rename if it is empty
+                old = tempfile.mkdtemp(dir=parent)
+                os.replace(path, old)
+            os.replace(tmp, path)
+        except OSError:
+            # Another process got there first
+            shutil.rmtree(tmp, ignore_errors=True)
+        if old is not None:
+            shutil.rmtree(old, ignore_errors=True)
+
+    def load_cache(self, path):
+        '''
+        Restore the DataFrames written by save_cache. The column arrays are
+        memory-mapped rather than read.
+        '''
+        with open(os.path.join(path, 'network.json')) as f:
+            meta = json.load(f)
+        if meta['parser_version'] != PARSER_VERSION:
+            raise ValueError("Cache {0} was written by parser version {1}"
+                             .format(path, meta['parser_version']))
+        self._reac_df = _load_frame(meta['frames']['reactions'], os.path.join(path, 'reactions'))
+        self._spec_df = _load_frame(meta['frames']['species'], os.path.join(path, 'species'))
+        self._spec_dict = meta['spec_dict']
+        self.num_species = meta['num_species']
+
     def _process_species_file(self):
         col_list=list(self._spec_df)
         self._spec_df['atom_num'] = self._spec_df[col_list[2:24]].sum(axis=1)
-        self._spec_df = self._spec_df.drop(col_list[2:24], axis=1)
-        self._spec_df.rename(columns={0 : "species",
-                           1 : "charge",
-                           24: "species_num"}, inplace=True)
+        # The element counts are kept for Kida.composition
+        columns = dict(zip(col_list[2:24], ELEMENTS))
+        columns.update({0 : "species", 1 : "charge", 24: "species_num"})
+        self._spec_df.rename(columns=columns, inplace=True)
 
         self._spec_dict = pd.Series(self._spec_df.species_num.values,
                                index=self._spec_df.species).to_dict()
         add_photons={'Photon':0,'Pho':0}
         self._spec_dict.update(add_photons)
+        # The moderator M of three-body reactions is not a species, whatever 
+        # number the species file gives it (see network.MODERATOR)
+        self._spec_dict['M'] = 99
         self.num_species=max(self._spec_df.species_num.values) 
 
-    def _process_reactions_file(self):
-        for column in self._reac_df.columns[0:5]: 
-            self._reac_df[column] = self._reac_df[column].replace(self._spec_dict)
-            self._reac_df[column] = self._reac_df[column].astype('Int64')
+
+def _save_frame(df, prefix):
+    # Nullable and string columns are stored as plain arrays plus a mask
+    columns = []
+    for n, (name, column) in enumerate(df.items()):
+        masked = not isinstance(column.dtype, np.dtype)
+        if not masked:
+            values = column.to_numpy()
+        elif pd.api.types.is_numeric_dtype(column.dtype):
+            values = column.to_numpy(dtype=column.dtype.numpy_dtype, na_value=0)
+        else:
+            values = np.array(column.fillna('').astype(str).tolist(), dtype=str)
+        np.save('{0}_{1}.npy'.format(prefix, n), values)
+        if masked:
+            np.save('{0}_{1}_mask.npy'.format(prefix, n), column.isna().to_numpy())
+        columns.append([str(name), str(column.dtype), masked])
+    return columns
+
+def _load_frame(columns, prefix):
+    data = {}
+    for n, (name, dtype, masked) in enumerate(columns):
+        values = np.load('{0}_{1}.npy'.format(prefix, n), mmap_mode='r')
+        if masked:
+            mask = np.load('{0}_{1}_mask.npy'.format(prefix, n))
+            data[name] = pd.Series(np.asarray(values)).astype(dtype).mask(mask)
+        else:
+            data[name] = pd.Series(values, copy=False)
+    return pd.DataFrame(data)
 
 
-#reac = "data/kida_reac_C_O_only.dat"
-#spec = "data/kida_spec_C_O_only.dat"
+def fixed_width_records(path, widths, comment='#', chunk_size=4096):
+    '''
+    Read a fixed-width file such as a KIDA reactions file in chunks of 
+    chunk_size records. Anything after the comment character is ignored and 
+    blank lines are skipped. Yields the line numbers of each chunk and one 
+    array of (space padded) bytes fields per column.
+    '''
+    ends = np.cumsum(widths)
+    bounds = list(zip((ends - widths).tolist(), ends.tolist()))
+    length = bounds[-1][1]
+    comment = comment.encode()
 
-#K=Kida(reac,spec)
+    def chunk(numbers, lines):
+        chars = np.frombuffer(b''.join(lines), dtype='S1').reshape(len(lines), length)
+        return np.array(numbers), [np.ascontiguousarray(chars[:, a:b]).view('S{0}'.format(b - a))[:, 0]
+                                   for a, b in bounds]
 
-#K.read_species()
-#K.read_reactions()
-#reactions, species, dictionary = K.output()
+    numbers, lines = [], []
+    with open(path, 'rb') as f:
+        for number, line in enumerate(f, 1):
+            line = line.split(comment, 1)[0].rstrip()
+            if line:
+                numbers.append(number)
+                lines.append(line[:length].ljust(length))
+                if len(lines) == chunk_size:
+                    yield chunk(numbers, lines)
+                    numbers, lines = [], []
+    if lines:
+        yield chunk(numbers, lines)
 
-#print(reactions)
-#print(species)
-#print(dictionary)
+def csv_records(path, comment='#', chunk_size=4096):
+    '''
+    Read a comma delimited file in chunks, in the same form as 
+    fixed_width_records.
+    '''
+    comment = comment.encode()
 
-#g=Grains(1e-11,1e-6,2,2e-20,2.3,K.num_species)
+    def chunk(numbers, rows):
+        width = max(len(row) for row in rows)
+        rows = [row + [b''] * (width - len(row)) for row in rows]
+        return np.array(numbers), [np.array(column, dtype=bytes) for column in zip(*rows)]
 
+    numbers, rows = [], []
+    with open(path, 'rb') as f:
+        for number, line in enumerate(f, 1):
+            line = line.split(comment, 1)[0]
+            if line.strip():
+                numbers.append(number)
+                rows.append(line.rstrip(b'\r\n').split(b','))
+                if len(rows) == chunk_size:
+                    yield chunk(numbers, rows)
+                    numbers, rows = [], []
+    if rows:
+        yield chunk(numbers, rows)
 
+def parse_records(chunks, columns, spec_dict, species=(), integers=(),
+                  strings=(), name='reactions file'):
+    '''
+    Convert the chunks of a reactions file (from fixed_width_records or 
+    csv_records) into one typed array per column in a single pass.
 
-#grain_reacs, grain_spec = g.output()
+    Names in the species columns are looked up in spec_dict and stored as 
+    int64 indices, the integer columns are int64, the string columns are 
+    objects and every other column is float64 (NaN if empty). Each chunk is 
+    converted column by column with NumPy and copied into arrays that grow 
+    as needed.
+
+    Returns the arrays and a dictionary of masks that mark the empty fields 
+    of the species and integer columns. Raises ValueError listing every 
+    unknown species or unreadable number with its line number.
+    '''
+    kinds = {}
+    for column in columns:
+        kinds[column] = 'species' if column in species else 'int' \
+            if column in integers else 'str' if column in strings else 'float'
+    dtypes = {'species': np.int64, 'int': np.int64, 'str': object, 'float': float}
+    blanks = {'int': b'0', 'float': b'nan'}
+    masked = [column for column in columns if kinds[column] in ('species', 'int')]
+
+    capacity = 0
+    data = {column: np.zeros(0, dtype=dtypes[kinds[column]]) for column in columns}
+    masks = {column: np.zeros(0, dtype=bool) for column in masked}
+    errors = []
+    n = 0
+    for numbers, fields in chunks:
+        size = n + len(numbers)
+        if size > capacity:
+            capacity = max(size, 2 * capacity)
+            for arrays in (data, masks):
+                for column, values in arrays.items():
+                    arrays[column] = np.concatenate(
+                        [values, np.zeros(capacity - len(values), dtype=values.dtype)])
+
+        missing = np.zeros(len(numbers), dtype='S1')
+        for column, values in zip(columns, fields + [missing] * (len(columns) - len(fields))):
+            kind = kinds[column]
+            empty = np.char.strip(values) == b''
+            if kind in ('species', 'str'):
+                # Few distinct names, so look up each of them once
+                names, inverse = np.unique(values, return_inverse=True)
+                names = [name.decode().strip() for name in names]
+                if kind == 'species':
+                    lookup = np.array([spec_dict.get(name, -1) if name else 0 for name in names],
+                                      dtype=np.int64)[inverse]
+                    for row in np.flatnonzero(lookup == -1):
+                        errors.append("unknown species '{0}' in {1} on line {2}"
+                                      .format(names[inverse[row]], column, numbers[row]))
+                else:
+                    lookup = np.array([name if name else np.nan for name in names],
+                                      dtype=object)[inverse]
+                data[column][n:size] = lookup
+            else:
+                values = np.where(empty, blanks[kind], values)
+                try:
+                    data[column][n:size] = values.astype(dtypes[kind])
+                except ValueError:
+                    for number, value in zip(numbers, values):
+                        try:
+                            dtypes[kind](value.decode())
+                        except ValueError:
+                            errors.append("can not read {0} '{1}' on line {2}"
+                                          .format(column, value.decode().strip(), number))
+            if column in masks:
+                masks[column][n:size] = empty
+        n = size
 
-#print(grain_reacs)
-#print(grain_spec)
+    if errors:
+        raise ValueError("Errors reading the {0}:\n  ".format(name) + "\n  ".join(errors))
+    return ({column: values[:n] for column, values in data.items()},
+            {column: mask[:n] for column, mask in masks.items()})
 
+def records_frame(data, masks, nullable=()):
+    '''
+    DataFrame of the arrays returned by parse_records. The nullable columns 
+    and any other masked column with empty fields become Int64 columns.
+    '''
+    columns = {}
+    for column, values in data.items():
+        mask = masks.get(column)
+        if mask is not None and (column in nullable or mask.any()):
+            values = pd.arrays.IntegerArray(values, mask)
+        columns[column] = values
+    return pd.DataFrame(columns)
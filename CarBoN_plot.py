@@ -13,18 +13,21 @@ import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.ticker as ticker
 
+import conservation
 import datainput
+import trajectory
 #import matplotlib._color_data 
 #import matplotlib.cm as cmx
 #from sys import exit
-file_format, species_file, reactions_file, output_file, model_type, density, Tinit, start_time, end_time, outfile = datainput.settings()
+file_format, species_file, reactions_file, output_file, model_type, density, Tinit, start_time, end_time, outfile = datainput.settings(datainput.read_settings())
 ##############################################################################
 # The following is used to specify the data file to be plotted
 # write its path as "output/filename.dat"  
+# It can be an .npz file or a trajectory directory (output/filename.dat.traj)
 ##############################################################################
 
 #file = str('' + outfile + '')
-infile = np.load( outfile )
+infile = trajectory.TrajectoryReader( outfile )
 
 ##############################################################################
 # The following will take care of the plot's setup
@@ -34,25 +37,28 @@ totmass = 1.11 ### Total of C+O+Si
 
 plottitle = 'C/O = 1/100      C/Si = 1/10'
 
-print(infile.files)
+print(infile.names)
 
-y = infile['y'] / totmass
-speciesidx = infile['speciesidx'][()]  #extracts dictionary from array?
-speciesmass = infile['speciesmass'][()]
-abundance = infile['abundance']
-time = 365.25 * (infile['time'])         #-(99/365.25))
+# Only the plotted species are read, reduced to ~4000 points each on a 
+# log time axis keeping the minimum and maximum of every interval
+plotted = ['C', 'O', 'C2', 'CO', 'C3']
+times, values = infile.decimate(plotted, max_points = 4000)
+y = {name: value / totmass for name, value in zip(plotted, values)}
+time_scale = 365.25 if infile.time_unit == 'years' else 1
+time = {name: time_scale * t for name, t in zip(plotted, times)}  #-(99/365.25))
 
 #print(speciesidx)
 #print(y[-1,11])
 
 ##############################################################################
 # The following tests for mass conservation. Total must = 1. 
+# Trajectories also hold the element counts of their species, and each 
+# element total is checked separately.
 ##############################################################################
 
-total = 0
-for name, index in speciesidx.items():
-    if index != 99:
-        total += speciesmass[name] * y[:,index]
+total = infile.total() / totmass
+if infile.elements:
+    print(conservation.check_trajectory(infile).report())
 
 #exit()
 
@@ -65,11 +71,11 @@ fig = plt.figure(figsize=(10, 10))
 ax1 = fig.add_subplot(111)
 
 
-ax1.plot(time, y[:, 1], label = '$\mathrm{C}$', linewidth = 2.0)
-ax1.plot(time, y[:, 2], '-.', label = '$\mathrm{O}$', linewidth = 2.0)
-ax1.plot(time, y[:, 3], label = '$\mathrm{C_2}$', linewidth = 2.0)
-ax1.plot(time, y[:, 4], label = '$\mathrm{CO}$', linewidth = 2.0)
-ax1.plot(time, y[:, 5], '--', label = '$\mathrm{C_3}$', linewidth = 2.0)
+ax1.plot(time['C'], y['C'], label = '$\mathrm{C}$', linewidth = 2.0)
+ax1.plot(time['O'], y['O'], '-.', label = '$\mathrm{O}$', linewidth = 2.0)
+ax1.plot(time['C2'], y['C2'], label = '$\mathrm{C_2}$', linewidth = 2.0)
+ax1.plot(time['CO'], y['CO'], label = '$\mathrm{CO}$', linewidth = 2.0)
+ax1.plot(time['C3'], y['C3'], '--', label = '$\mathrm{C_3}$', linewidth = 2.0)
 #ax1.plot(time, y[:, 13], '--', label = '$\mathrm{SiO}$', linewidth = 2.0)
 #ax1.plot(time, y[:, 15], '-.', label = '$\mathrm{(SiC)_2}$', linewidth = 2.0)
 #ax1.plot(time, y[:, 16], '-.', label = '$\mathrm{(SiO)_2}$', linewidth = 2.0)
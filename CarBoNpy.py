@@ -5,190 +5,112 @@ CarBon_1.0.1.py - Kinetic Molecular Chemistry Code for Supernova Ejecta
 Copyright (c) 2012-2016 Ethan Deneault 
 This file is part of CarBoN
 
+Usage:
+    python CarBoNpy.py                  integrate and plot the model in settings.ini
+    python CarBoNpy.py --headless       integrate only, without importing matplotlib
+    python CarBoNpy.py --resume         continue from the checkpoint of an interrupted run
+
+The model itself is set up and run by simulation.Simulation, which can also 
+be used directly from other code.
 ''' 
-import numpy as np
-import matplotlib.pyplot as plt
-from assimulo.problem import Explicit_Problem
-from assimulo.solvers import CVode
-from sys import exit
+import argparse
+import importlib.util
 
-import CarBoN_Input_Processor as cip 
+import backends
 import datainput as d
-import models as m
+import instrumentation as instr
+import simulation
 
 
-def chemnet(t,y):
+def plot(t, y, columns):
     '''
-    This function defines the rhs of the system of differential equations 
-    used in the chemical network. It dynamically builds the equations from 
-    the DataFrame constructed by m.KIDA_Input()
+    Plot the main species of a run. matplotlib is only imported here.
     '''
-
-    if model_type=='Cons':
-        T,Ndens=m.constantD(t,dens=Ndensinit,T0=temperature)
-    else:
-        exit("No Model Loaded, Exiting Now.")
-
-    f=np.zeros([len(kida_spec.index)]) # Define the rhs array
-
-    #f -= 3*y/t
-
-
-    for num in range(len(list(kida_reac.index))):
-        
-        in1=kida_reac.loc[num]['Input1']
-        in2=kida_reac.loc[num]['Input2']
-        out1=kida_reac.loc[num]['Output1']
-        out2=kida_reac.loc[num]['Output2']
-        out3=kida_reac.loc[num]['Output3']     
-        alpha=kida_reac.loc[num]['alpha']
-        beta=kida_reac.loc[num]['beta']
-        gamma=kida_reac.loc[num]['gamma']
-        fo=kida_reac.loc[num]['Fo']
-
-
-        if num==0:
-            print('Still going! t={0}, Temp={1}'.format(t,T))
-
-        
-        if in2!=0 and in2!=99:
-            f[in1]  -=  m.arrhenius(alpha,beta,gamma,T,fo) * y[in1] * y[in2]
-            f[in2]  -=  m.arrhenius(alpha,beta,gamma,T,fo) * y[in1] * y[in2]
-            f[out1] +=  m.arrhenius(alpha,beta,gamma,T,fo) * y[in1] * y[in2]
-            if np.isnan(out2) == False and out2!=0:
-                f[out2] += m.arrhenius(alpha,beta,gamma,T,fo) * y[in1] * y[in2]
-            if np.isnan(out3) == False and out3!=0:
-                f[out3] += m.arrhenius(alpha,beta,gamma,T,fo) * y[in1] * y[in2]
-
-        elif in2==0:
-            f[in1] -= m.arrhenius(alpha, beta, gamma, T, fo) * y[in1]
-            f[out1] += m.arrhenius(alpha, beta, gamma, T, fo) * y[in1]
-            if np.isnan(out2) == False and out2!=0:
-                f[out2] += m.arrhenius(alpha, beta, gamma, T, fo) * y[in1]
-            if np.isnan(out3) == False and out3!=0:
-                f[out3] += m.arrhenius(alpha, beta, gamma, T, fo) * y[in1]              
-    return f
-
-'''
-    for num in range(len(list(grains_reac.index))):
-
-        in1=grains_reac.loc[num]['Input1']
-        in2=grains_reac.loc[num]['Input2']
-        out1=grains_reac.loc[num]['Output1']
-        out2=grains_reac.loc[num]['Output2']     
-        fijk=kida_reac.loc[num]['f_ijk']
-        kij=kida_reac.loc[num]['K_ij']
-        Hamaker=kida_reac.loc[num]['Hamaker']
-        fo=kida_reac.loc[num]['Fo']
-
-        f[in1] -= kij * np.sqrt(T) * m.VdW(r1,r2,T,Hamaker)
-        f[in2] -= kij * np.sqrt(T) * m.VdW(r1,r2,T,Hamaker)
-        f[out1] += fijk * kij * np.sqrt(T) * m.VdW(r1,r2,T,Hamaker)
-        f[out2] += (1-fijk) * kij * np.sqrt(T) * m.VdW(r1,r2,T,Hamaker)
-'''
-
-
-########### Reactions with moderators needs rewrite!
-# 
-#        elif in2==99:
-#            f[in1] -=  Ndens*m.arrhenius(alpha,beta,gamma,T,fo) \
-#                      * y[in1] * (kida_spec.loc[0]['species_num']\
-#                         + kida_spec.loc[2]['species_num'] \
-#                      + monoatomic_list[2])
-#            f[out1] +=  Ndens*m.arrhenius(alpha,beta,gamma,T,fo) \
-#                       * y[in1] * (kida_spec.loc[0]['species_num'] + kida_spec.loc[1]['species_#'] \
-#                       + monoatomic_list[2])
-#            if isinstance(out2,int) == True:
-#                f[out2] += Ndens*m.arrhenius(alpha,beta,gamma,T,fo) * y[in1] \
-#                       * (kida_spec.loc[0]['species_num'] + kida_spec.loc[1]['species_#'] \
-#                       + monoatomic_list[2])
-#            if isinstance(out3,int) == True:
-#                f[out3] += Ndens*m.arrhenius(alpha,beta,gamma,T,fo) * y[in1] \
-#                        * (kida_spec.loc[0]['species_num'] + kida_spec.loc[1]['species_#'] \
-#                       + monoatomic_list[2])
-############ NEEDS CLEANUP
-
-
-"""
-Import data from the settings file, the KIDA database files and the initial abundances file. 
-"""
-
-# This is to read files from whatever they are stored in. 
-
-
-file_format, species_file, reactions_file, output_file, model_type, density, temperature, start_time, end_time, outfile = d.settings()
-
-
-Kida_file = cip.Kida("data/kida_reac_C_O_Si_only.dat", "data/kida_spec_C_O_Si_only.dat")
-Kida_file.read_species()
-Kida_file.read_reactions()
-
-kida_reac, kida_spec, spec_dict = Kida_file.output() 
-print(kida_reac)
-print(kida_spec)
-print(spec_dict)
-
-
-abund_df = d.abundances(spec_dict)
-
-"""
-Initialize the variables
-"""
-
-yinit = np.zeros([len(kida_spec.index)])     
-yinit[abund_df.Species.values] = abund_df.Abundance.values 
-
-Ndensinit = density #np.sum(yinit)*density
-
-
-"""
-Initialize Assimulo, calculate with CVode.
-"""
-
-
-start_time *= 86400
-end_time *= 86400
-
-model=Explicit_Problem(chemnet,yinit,start_time)
-model.name='Chemnet Test'
-
-sim=CVode(model)
-
-sim.atol=1.e-12
-sim.rtol=1.e-12
-sim.maxord=3
-sim.discr='BDF'
-sim.iter='Newton'
-
-t,y=sim.simulate(end_time)
-
-#sim.plot()
-
-t = np.array(t)/86400
-plt.ylim([1e5,2e10])
-plt.semilogy(t,y[:,1],label='C')
-plt.semilogy(t,y[:,2],label='O')
-plt.semilogy(t,y[:,3],label='C2')
-plt.semilogy(t,y[:,4],label='CO')
-#plt.semilogy(t,y[:,5],label='C3')
-#plt.semilogy(t,y[:,6],label='C4')
-plt.semilogy(t,y[:,7],label='Si')
-plt.semilogy(t,y[:,8],label='SiC')
-plt.semilogy(t,y[:,9],label='SiO')
-#plt.semilogy(t,y[:,10],label='Si2O2')
-#plt.semilogy(t,y[:,11], "-.",label='Si2C2')
-#plt.semilogy(t,y[:,12], "-.",label='O2')
-#plt.semilogy(t,y[:,13], "-.",label='C+')
-#plt.semilogy(t,y[:,14], "-.",label='O+')
-#plt.semilogy(t,y[:,15], "-.",label='Si+')
-#plt.semilogy(t,y[:,16], "-.",label='CO+')
-#plt.semilogy(t,y[:,17], "-.",label='C2+')
-#plt.semilogy(t,y[:,18], "-.",label='SiC+')
-#plt.semilogy(t,y[:,19], "-.",label='e-')
-
-
-plt.legend()
-plt.show()
+    import matplotlib.pyplot as plt
+
+    plt.ylim([1e5,2e10])
+    # Also available: C3, C4, Si2O2, Si2C2, O2, C+, O+, Si+, CO+, C2+, SiC+, e-
+    for name in ['C', 'O', 'C2', 'CO', 'Si', 'SiC', 'SiO']:
+        if name in columns:
+            plt.semilogy(t,y[:,columns[name]],label=name)
+
+    plt.legend()
+    plt.show()
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Integrate a CarBoN model.")
+    parser.add_argument("--settings", default="settings.ini")
+    parser.add_argument("--abundances", default="abundances.ini")
+    parser.add_argument("--reac", help="path to KIDA reactions file",
+                        default="data/kida_reac_C_O_Si_only.dat")
+    parser.add_argument("--spec", help="path to KIDA species file",
+                        default="data/kida_spec_C_O_Si_only.dat")
+    parser.add_argument("--headless", action="store_true",
+                        help="do not plot the result")
+    parser.add_argument("-q", "--quiet", action="store_true",
+                        help="do not print progress")
+    parser.add_argument("--prune", action="store_true", default=None,
+                        help="integrate only the species reachable from the "
+                             "initial abundances (default: Prune in settings.ini)")
+    parser.add_argument("--backend", default=None,
+                        help="solver backend: auto, cvode, bdf, radau or lsoda "
+                             "(default: Backend in settings.ini)")
+    parser.add_argument("--resume", action="store_true",
+                        help="continue from the checkpoint in settings.ini")
+    parser.add_argument("--warm-start", default=None, metavar="CHECKPOINT",
+                        help="start from the state saved in this checkpoint "
+                             "instead of the initial abundances")
+    parser.add_argument("--log", default=None,
+                        help="write the run's progress events to this file as "
+                             "JSON lines (default: Log File in settings.ini)")
+    args = parser.parse_args(argv)
+
+    options = {} if args.prune is None else {'prune': args.prune}
+    if args.backend is not None:
+        options['backend'] = args.backend
+
+    config = d.read_settings(args.settings)
+    progress, log_file, log_interval = d.monitor_settings(config)
+    log_file = args.log or log_file
+    # Without progress output or a log the rhs and Jacobian run unmonitored
+    monitor = None
+    if not args.quiet or log_file:
+        monitor = instr.Monitor('Chemnet Test')
+    if not args.quiet:
+        monitor.subscribe(instr.print_progress, progress)
+    log = None
+    if log_file:
+        log = monitor.log(log_file, log_interval)
+
+    sim = simulation.Simulation.from_settings(config, args.abundances,
+                                              args.reac, args.spec,
+                                              resume=args.resume,
+                                              warm_start=args.warm_start,
+                                              name='Chemnet Test', monitor=monitor,
+                                              verbose=not args.quiet, **options)
+    if not args.quiet:
+        print('{0} species in the solution vector'.format(sim.network.num_species))
+        if d.jit_settings(config) and importlib.util.find_spec('numba') is None:
+            print('JIT = yes, but numba is not installed: using the NumPy rhs')
+
+    try:
+        t,y=sim.run()
+    finally:
+        if log is not None:
+            log.close()
+    if not args.quiet:
+        print(backends.format_statistics(sim.stats))
+    if sim.conservation is not None and (not args.quiet or not sim.conservation.ok):
+        print(sim.conservation.report())
+
+    if not args.headless:
+        plot(t, y, sim.columns())
+    return t, y
+
+
+if __name__ == '__main__':
+    main()
 
 ##############################################################################
 # The following writes to a data file
@@ -0,0 +1,281 @@
+# -*- coding: utf-8 -*-
+"""
+backends.py - ODE Solver Backends
+
+This file is part of CarBoN
+
+Every backend integrates dy/dt = rhs(t, y) with the sparse Jacobian
+jac(t, y) of a compiled network and reports the same statistics:
+
+    steps                   accepted time steps
+    rhs_evaluations         calls of rhs, including any for the Jacobian
+    jacobian_evaluations    calls of jac
+    lu_decompositions       factorizations of the Newton matrix (None if
+                            the solver does not report them)
+    error_test_failures     rejected steps (None if not reported)
+    nonlinear_iterations    Newton iterations (None if not reported)
+    wall_time               seconds spent in the solver
+
+Backends:
+
+    cvode   Assimulo CVode, BDF with a sparse (SuperLU) linear solver
+    bdf     scipy.integrate.BDF with a sparse Jacobian
+    radau   scipy.integrate.Radau with a sparse Jacobian
+    lsoda   scipy.integrate.LSODA, which needs a dense Jacobian
+    auto    cvode if Assimulo can be imported, bdf otherwise
+
+Given output times, a backend reports the solution only at those times,
+interpolated from the steps around them (CVode's and scipy's dense
+output), so the output size does not depend on the step sizes and the
+steps are not shortened to hit the times.
+
+A step(t) callback, if given, is called after every accepted step whether
+or not the step is reported, e.g. to count the steps for progress output.
+
+While a backend integrates, step_state() gives the size and order of its
+last step (None where the solver does not tell), which checkpoint.py saves
+so that a restarted run can begin with the step size it had reached.
+
+"""
+
+import time
+
+import numpy as np
+
+
+STATISTICS = ('steps', 'rhs_evaluations', 'jacobian_evaluations',
+              'lu_decompositions', 'error_test_failures',
+              'nonlinear_iterations', 'wall_time')
+
+
+class CVodeBackend:
+    '''
+    Assimulo CVode with the settings CarBoNpy.py has always used.
+    '''
+    name = 'cvode'
+
+    def __init__(self, atol=1.e-12, rtol=1.e-12, maxord=3, verbosity=50):
+        self.atol = atol
+        self.rtol = rtol
+        self.maxord = maxord
+        self.verbosity = verbosity
+        self.stats = None
+        self._sim = None
+
+    def integrate(self, rhs, jac, jac_nnz, y0, t0, t1, handle_result=None,
+                  name='Chemnet', first_step=None, times=None, step=None):
+        '''
+        Integrate from t0 to t1. If handle_result(solver, t, y) is given it
+        is called for every step instead of the solver keeping the steps,
+        and the returned arrays are empty. first_step is the size of the
+        first step to try (chosen by the solver by default). With times,
+        the solution is reported at t0 and at those of the times that lie
+        after t0 and up to t1 instead of at every step. step(t) is called
+        after every accepted step.
+        '''
+        from assimulo.problem import Explicit_Problem
+        from assimulo.solvers import CVode
+
+        model = Explicit_Problem(rhs, y0, t0)
+        model.name = name
+        model.jac = jac
+        model.jac_nnz = jac_nnz
+        if handle_result is not None:
+            model.handle_result = handle_result
+        if step is not None:
+            model.step_events = lambda solver: step(solver.t)
+
+        sim = CVode(model)
+        sim.atol = self.atol
+        sim.rtol = self.rtol
+        sim.maxord = self.maxord
+        sim.discr = 'BDF'
+        sim.iter = 'Newton'
+        sim.linear_solver = 'SPARSE'
+        sim.usejac = True
+        sim.verbosity = self.verbosity
+        if first_step:
+            sim.inith = first_step
+        if handle_result is not None:
+            sim.report_continuously = True
+        self._sim = sim
+
+        start = time.time()
+        try:
+            if times is None:
+                t, y = sim.simulate(t1)
+            else:
+                t, y = sim.simulate(t1, ncp_list=output_times(times, t0, t1))
+        finally:
+            self.stats = self._statistics(sim, time.time() - start)
+        return np.array(t), np.array(y)
+
+    def step_state(self):
+        '''
+        Size and order of the last step taken.
+        '''
+        try:
+            return float(self._sim.get_last_step()), int(self._sim.get_last_order())
+        except (AttributeError, TypeError, ValueError):
+            return None, None
+
+    @staticmethod
+    def _statistics(sim, wall_time):
+        try:
+            stats = sim.get_statistics()
+        except AttributeError:
+            stats = getattr(sim, 'statistics', {})
+
+        def get(key):
+            try:
+                return int(stats[key])
+            except (KeyError, TypeError):
+                return None
+
+        rhs = get('nfcns')
+        if rhs is not None and get('nfcnjacs'):
+            rhs += get('nfcnjacs')
+        return {'steps': get('nsteps'), 'rhs_evaluations': rhs,
+                'jacobian_evaluations': get('njacs'), 'lu_decompositions': None,
+                'error_test_failures': get('nerrfails'),
+                'nonlinear_iterations': get('nniters'), 'wall_time': wall_time}
+
+
+class ScipyBackend:
+    '''
+    One of the implicit scipy.integrate solvers, stepped one step at a time
+    so that handle_result sees every step as it is taken.
+
+    The solver runs on tau = t - t0. With t0 of order 1e7 s the spacing of
+    floats near t0 is larger than the first steps BDF takes at tight
+    tolerances, and it would fail straight away.
+    '''
+    methods = ('BDF', 'Radau', 'LSODA')
+
+    def __init__(self, method='BDF', atol=1.e-12, rtol=1.e-12, max_step=np.inf):
+        if method not in self.methods:
+            raise ValueError("Unknown scipy method {0}, use one of {1}"
+                             .format(method, ', '.join(self.methods)))
+        self.method = method
+        self.name = method.lower()
+        self.atol = atol
+        self.rtol = rtol
+        self.max_step = max_step
+        self.stats = None
+        self._solver = None
+
+    def integrate(self, rhs, jac, jac_nnz, y0, t0, t1, handle_result=None,
+                  name='Chemnet', first_step=None, times=None, step=None):
+        '''
+        Integrate from t0 to t1, see CVodeBackend.integrate.
+        '''
+        from scipy import integrate
+
+        fun = lambda tau, y: rhs(t0 + tau, y)
+        if self.method == 'LSODA':
+            # LSODA only takes dense Jacobians
+            jacobian = lambda tau, y: jac(t0 + tau, y).toarray()
+        else:
+            jacobian = lambda tau, y: jac(t0 + tau, y)
+        solver = getattr(integrate, self.method)(
+            fun, 0.0, np.array(y0, dtype=float), t1 - t0, jac=jacobian,
+            rtol=self.rtol, atol=self.atol, max_step=self.max_step,
+            first_step=min(first_step, t1 - t0) if first_step else None)
+        self._solver = solver
+
+        t_out, y_out = [], []
+        if handle_result is None:
+            report = lambda t, y: (t_out.append(t), y_out.append(y.copy()))
+        else:
+            report = lambda t, y: handle_result(self, t, y)
+        report(t0, solver.y)
+        if times is not None:
+            times = output_times(times, t0, t1)
+            pending = 0
+
+        steps = 0
+        start = time.time()
+        try:
+            while solver.status == 'running':
+                message = solver.step()
+                if solver.status == 'failed':
+                    raise RuntimeError("{0} failed at t={1}: {2}".format(
+                        self.method, t0 + solver.t, message))
+                steps += 1
+                if step is not None:
+                    step(t0 + solver.t)
+                if times is None:
+                    report(t0 + solver.t, solver.y)
+                    continue
+                # t0 + (t1 - t0) may round to just below t1
+                reached = len(times) if solver.status == 'finished' else \
+                    np.searchsorted(times, t0 + solver.t, side='right')
+                if reached > pending:
+                    dense = solver.dense_output()
+                    for t in times[pending:reached]:
+                        report(t, dense(t - t0))
+                    pending = reached
+        finally:
+            self.stats = {'steps': steps, 'rhs_evaluations': solver.nfev,
+                          'jacobian_evaluations': solver.njev,
+                          'lu_decompositions': solver.nlu if self.method != 'LSODA' else None,
+                          'error_test_failures': None, 'nonlinear_iterations': None,
+                          'wall_time': time.time() - start}
+        return np.array(t_out), np.array(y_out)
+
+    def step_state(self):
+        '''
+        Size and order of the last step taken (the order only for BDF).
+        '''
+        if self._solver is None or self._solver.step_size is None:
+            return None, None
+        order = getattr(self._solver, 'order', None)
+        return float(self._solver.step_size), None if order is None else int(order)
+
+
+def output_times(times, t0, t1):
+    '''
+    The sorted times after t0 and up to t1.
+    '''
+    times = np.unique(np.asarray(times, dtype=float))
+    return times[(times > t0) & (times <= t1)]
+
+
+def get_backend(name='auto', **options):
+    '''
+    Backend by name (cvode, bdf, radau, lsoda or auto). options are passed
+    to it, e.g. atol and rtol. An existing backend is returned unchanged.
+    '''
+    if not isinstance(name, str):
+        return name
+    name = name.lower()
+    if name == 'auto':
+        try:
+            import assimulo.solvers
+            name = 'cvode'
+        except ImportError:
+            name = 'bdf'
+    if name == 'cvode':
+        return CVodeBackend(**options)
+    options.pop('maxord', None)
+    options.pop('verbosity', None)
+    for method in ScipyBackend.methods:
+        if name == method.lower():
+            return ScipyBackend(method, **options)
+    raise ValueError("Unknown solver backend {0}, use auto, cvode, bdf, radau "
+                     "or lsoda".format(name))
+
+
+def format_statistics(stats):
+    '''
+    The statistics of a run as one line per entry, for printing.
+    '''
+    lines = []
+    for key in STATISTICS:
+        value = stats.get(key)
+        if value is None:
+            value = '-'
+        elif key == 'wall_time':
+            value = '{0:.3f} s'.format(value)
+        lines.append('{0:22s}{1}'.format(key, value))
+    return '\n'.join(lines)
@@ -0,0 +1,276 @@
+# -*- coding: utf-8 -*-
+"""
+run.py - Timed Benchmarks of the CarBoN Hot Paths
+
+This file is part of CarBoN
+
+Generates synthetic networks of each requested size (see synthetic.py) and
+times, for each of them:
+
+    parse           Kida.read_species and Kida.read_reactions
+    cache_load      Kida.load_cache of the compiled cache
+    compile         network.Network
+    tabulate        Network.tabulate_rates
+    rhs             chemnet: models.conditions and Network.rhs, with the
+                    temperature of a Cherchneff model changing every call
+    rhs_fixed_T     the same at a fixed temperature, so the rate
+                    coefficients come from the cache
+    rhs_table       rhs with tabulated rate coefficients
+    jacobian        Network.jacobian
+    rhs_jit         rhs with the Numba kernels of kernels.py (if installed)
+    jacobian_jit    jacobian with the Numba kernels
+    arrhenius_<F>   models.arrhenius for all reactions of formula F
+    integrate       simulation.integrate of a constantD model (small sizes)
+
+and, once, the grain coagulation paths:
+
+    vdw             models.VdW for every pair of grain bins
+    vdw_batch       models.VdW_batch for every pair of grain bins
+    coagulation     rhs of the KIDA network coupled to the grain bins, at a
+                    changing temperature
+
+Every benchmark is run repeatedly and the best and median time per call
+are written to a JSON file together with the versions and machine it ran
+on. Given a baseline file from an earlier run, the times are compared and
+the exit status is 1 if any benchmark got slower than the threshold.
+
+Usage (from the top level directory):
+    python -m benchmarks.run --sizes 100 1000 10000 50000 -o bench.json
+    python -m benchmarks.run -o new.json --baseline bench.json --threshold 1.5
+
+"""
+
+import argparse
+import datetime
+import itertools
+import json
+import os
+import platform
+import sys
+import tempfile
+import timeit
+
+import numpy as np
+
+import CarBoN_Input_Processor as cip
+import kernels
+import models as m
+import network as net
+import simulation as sim
+
+from benchmarks import synthetic
+
+
+# Grain settings as in settings.ini: minimum and maximum radius (m), volume
+# ratio, Hamaker constant (J) and density (g/cm^3)
+GRAINS = (1e-9, 1e-6, 2, 2e-20, 2.3)
+
+DENSITY = 1e10
+TEMPERATURE = 2000.
+TMIN, TMAX = 10., 20000.
+
+
+def measure(func, repeat=5, min_time=0.2):
+    '''
+    Time func like timeit does: the number of calls per repeat is raised
+    until a repeat takes at least min_time, then the repeat is done repeat
+    times. Returns the best and median time per call in seconds.
+    '''
+    timer = timeit.Timer(func)
+    number, elapsed = timer.autorange() if min_time else (1, None)
+    while elapsed is not None and elapsed < min_time and number < 1 << 20:
+        number *= 2
+        elapsed = timer.timeit(number)
+    times = np.array(timer.repeat(repeat, number)) / number
+    return {'best': float(times.min()), 'median': float(np.median(times)),
+            'number': number, 'repeat': repeat}
+
+
+def _load(reac_file, spec_file):
+    kida_file = cip.Kida(reac_file, spec_file)
+    kida_file.read_species()
+    kida_file.read_reactions()
+    return kida_file
+
+
+def benchmark_network(num_reactions, directory, repeat=5, min_time=0.2,
+                      integrate=True, seed=0):
+    '''
+    Time the network benchmarks for one synthetic network. Returns a list
+    of result dictionaries.
+    '''
+    reac_file, spec_file = synthetic.write(directory, num_reactions, seed=seed)
+    results = []
+
+    def record(name, func, **options):
+        options.setdefault('repeat', repeat)
+        options.setdefault('min_time', min_time)
+        result = {'benchmark': name, 'reactions': num_reactions,
+                  'species': network.num_species}
+        result.update(measure(func, **options))
+        results.append(result)
+        print('{0:>7} reactions  {1:16s}{2:12.3e} s'.format(
+            num_reactions, name, result['best']))
+
+    kida_file = _load(reac_file, spec_file)
+    kida_reac, kida_spec, spec_dict = kida_file.output()
+    network = net.Network(kida_reac, kida_spec)
+
+    record('parse', lambda: _load(reac_file, spec_file), repeat=3, min_time=0)
+    cache = os.path.join(directory, 'cache_{0}'.format(num_reactions))
+    kida_file.save_cache(cache)
+    record('cache_load', lambda: cip.Kida(reac_file, spec_file).load_cache(cache))
+    record('compile', lambda: net.Network(kida_reac, kida_spec), repeat=3)
+
+    rng = np.random.default_rng(seed)
+    y = 10 ** rng.uniform(0, 10, network.num_species)
+    times = itertools.cycle(np.linspace(100, 600, 10007) * 86400)
+
+    def chemnet(network, model_type='Cherchneff'):
+        T, Ndens = m.conditions(model_type, next(times), DENSITY, TEMPERATURE)
+        return network.rhs(y, T, Ndens)
+
+    record('rhs', lambda: chemnet(network))
+    record('rhs_fixed_T', lambda: chemnet(network, 'Cons'))
+    record('jacobian', lambda: network.jacobian(y, TEMPERATURE, DENSITY))
+
+    if kernels.AVAILABLE:
+        jitted = kernels.jit_network(network)
+        jitted.rhs(y, TEMPERATURE, DENSITY)
+        jitted.jacobian(y, TEMPERATURE, DENSITY)
+        record('rhs_jit', lambda: chemnet(jitted))
+        record('jacobian_jit', lambda: jitted.jacobian(y, TEMPERATURE, DENSITY))
+
+    for formula in range(1, 6):
+        which = network.formula == formula
+        a, b, c = network.alpha[which], network.beta[which], network.gamma[which]
+        record('arrhenius_{0}'.format(formula),
+               lambda: m.arrhenius(a, b, c, TEMPERATURE, formula))
+
+    tabulated = net.Network(kida_reac, kida_spec)
+    record('tabulate', lambda: tabulated.tabulate_rates(TMIN, TMAX), repeat=3, min_time=0)
+    record('rhs_table', lambda: chemnet(tabulated))
+
+    if integrate:
+        yinit = np.zeros(network.num_species)
+        yinit[1:] = 10 ** rng.uniform(6, 10, network.num_species - 1)
+        record('integrate', lambda: sim.integrate(network, yinit, 'Cons', DENSITY,
+                                                  TEMPERATURE, 100, 101, atol=1e-6,
+                                                  rtol=1e-6),
+               repeat=1, min_time=0)
+    return results
+
+
+def benchmark_grains(num_reactions, directory, repeat=5, min_time=0.2):
+    '''
+    Time the Van der Waals corrections for every pair of grain bins and the
+    rhs of a synthetic network coupled to the grains.
+    '''
+    reac_file, spec_file = synthetic.write(directory, num_reactions)
+    kida_file = _load(reac_file, spec_file)
+    kida_reac, kida_spec, spec_dict = kida_file.output()
+    network, grains_spec = sim.build_network(kida_reac, kida_spec, TMIN, TMAX,
+                                             grains=GRAINS)
+    coagulation = network.parts[1]
+    r1, r2, A = coagulation.rates.radius1, coagulation.rates.radius2, coagulation.rates.A
+    y = np.full(network.num_species, 1e6)
+    temperatures = itertools.cycle(np.geomspace(TMIN, TMAX, 10007))
+
+    results = []
+    for name, func in [('vdw', lambda: [m.VdW(a, b, TEMPERATURE, h)
+                                        for a, b, h in zip(r1, r2, A)]),
+                       ('vdw_batch', lambda: m.VdW_batch(r1, r2, TEMPERATURE, A)),
+                       ('coagulation', lambda: network.rhs(y, next(temperatures), DENSITY))]:
+        result = {'benchmark': name, 'reactions': num_reactions,
+                  'species': network.num_species}
+        result.update(measure(func, repeat, min_time))
+        results.append(result)
+        print('{0:>7} reactions  {1:16s}{2:12.3e} s'.format(
+            num_reactions, name, result['best']))
+    return results
+
+
+def metadata():
+    import pandas
+    import scipy
+    return {'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'python': platform.python_version(), 'numpy': np.__version__,
+            'scipy': scipy.__version__, 'pandas': pandas.__version__,
+            'platform': platform.platform(), 'machine': platform.machine(),
+            'processor': platform.processor(), 'cpus': os.cpu_count()}
+
+
+def compare(results, baseline, threshold=1.5):
+    '''
+    Print the ratio of each best time to the same benchmark in baseline.
+    Returns the (benchmark, reactions) pairs that got slower than
+    threshold times their baseline.
+    '''
+    old = {(r['benchmark'], r['reactions']): r['best'] for r in baseline['results']}
+    slower = []
+    print('\n{0:16s}{1:>10}{2:>13}{3:>13}{4:>8}'.format(
+        'benchmark', 'reactions', 'baseline', 'now', 'ratio'))
+    for result in results:
+        key = (result['benchmark'], result['reactions'])
+        if key not in old:
+            continue
+        ratio = result['best'] / old[key]
+        flag = ''
+        if ratio > threshold:
+            slower.append(key)
+            flag = '  slower'
+        print('{0:16s}{1:>10}{2:13.3e}{3:13.3e}{4:8.2f}{5}'.format(
+            key[0], key[1], old[key], result['best'], ratio, flag))
+    return slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Time CarBoN on synthetic "
+                                     "KIDA networks.")
+    parser.add_argument("--sizes", type=int, nargs='+', default=[100, 1000, 10000],
+                        help="numbers of reactions (default: 100 1000 10000)")
+    parser.add_argument("--integrate-max", type=int, default=1000,
+                        help="largest network to integrate (default: 1000)")
+    parser.add_argument("--grains", type=int, default=1000,
+                        help="size of the network coupled to the grains, "
+                             "0 to skip (default: 1000)")
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--min-time", type=float, default=0.2,
+                        help="minimum seconds per repeat (default: 0.2)")
+    parser.add_argument("--networks", default=None,
+                        help="directory for the synthetic networks "
+                             "(default: a temporary directory)")
+    parser.add_argument("-o", "--output", default="benchmarks.json")
+    parser.add_argument("--baseline", default=None,
+                        help="earlier results to compare against")
+    parser.add_argument("--threshold", type=float, default=1.5,
+                        help="slowdown that counts as a regression (default: 1.5)")
+    args = parser.parse_args(argv)
+
+    with tempfile.TemporaryDirectory() as tmp:
+        directory = args.networks or tmp
+        results = []
+        for size in args.sizes:
+            results += benchmark_network(size, directory, args.repeat, args.min_time,
+                                         integrate=size <= args.integrate_max)
+        if args.grains:
+            results += benchmark_grains(args.grains, directory, args.repeat,
+                                        args.min_time)
+
+    with open(args.output, 'w') as f:
+        json.dump({'meta': metadata(), 'results': results}, f, indent=1)
+    print('Results written to {0}'.format(args.output))
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        slower = compare(results, baseline, args.threshold)
+        if slower:
+            print('{0} benchmarks slower than {1}x the baseline'.format(
+                len(slower), args.threshold))
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
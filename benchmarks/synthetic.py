@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""
+synthetic.py - Synthetic KIDA Networks for Benchmarking
+
+This file is part of CarBoN
+
+Writes KIDA formatted species and reactions files of any size that
+CarBoN_Input_Processor.Kida can read. Every species is a cluster of 1 to
+max_size atoms of a single element, and every reaction conserves the number
+of atoms, so the networks can also be integrated without blowing up.
+
+The reactions mix the KIDA formulas:
+
+    1   cosmic ray ionization       A -> B + C
+    2   photodissociation           A + Photon -> B + C
+    3   modified Arrhenius          A + B -> C (+ D)
+    4   ion-polar (ionpol 1)        A + B -> C (+ D)
+    5   ion-polar (ionpol 2)        A + B -> C (+ D)
+
+Usage:
+    python -m benchmarks.synthetic 5000 -o /tmp/synthetic
+
+"""
+
+import argparse
+import os
+
+import numpy as np
+
+REAC_WIDTHS = [11, 23, 11, 10, 34, 11, 11, 11, 9, 9, 5, 3, 7, 7, 3, 5, 2, 3]
+
+# Share of each formula among the generated reactions
+FORMULA_WEIGHTS = {1: 0.10, 2: 0.15, 3: 0.55, 4: 0.10, 5: 0.10}
+
+
+def species_names(num_species):
+    # Zero padded to the same width, see write
+    width = len(str(num_species))
+    return ['X{0:0{1}}'.format(n, width) for n in range(1, num_species + 1)]
+
+
+def _split(rng, total):
+    first = rng.integers(1, total)
+    return first, total - first
+
+
+def generate(num_reactions, num_species=None, max_size=10, seed=0):
+    '''
+    Random species and reactions. Returns a list of (name, size) for the
+    species and a list of (inputs, outputs, alpha, beta, gamma, formula)
+    for the reactions, with species given by name.
+    '''
+    rng = np.random.default_rng(seed)
+    if num_species is None:
+        num_species = int(np.clip(num_reactions // 5, 20, 5000))
+    max_size = min(max_size, num_species)
+
+    # Every size from 1 to max_size has at least one species
+    sizes = np.concatenate([np.arange(1, max_size + 1),
+                            rng.integers(1, max_size + 1, num_species - max_size)])
+    names = species_names(num_species)
+    by_size = {size: [name for name, s in zip(names, sizes) if s == size]
+               for size in range(1, max_size + 1)}
+    pick = lambda size: by_size[size][rng.integers(len(by_size[size]))]
+    large = [name for name, size in zip(names, sizes) if size > 1]
+    size_of = dict(zip(names, sizes))
+
+    formulas = rng.choice(list(FORMULA_WEIGHTS), size=num_reactions,
+                          p=list(FORMULA_WEIGHTS.values()))
+    reactions = []
+    for formula in formulas:
+        if formula in (1, 2):
+            reactant = large[rng.integers(len(large))]
+            outputs = [pick(s) for s in _split(rng, size_of[reactant])]
+            inputs = [reactant, 'Photon' if formula == 2 else '']
+        else:
+            inputs = [names[n] for n in rng.integers(num_species, size=2)]
+            total = size_of[inputs[0]] + size_of[inputs[1]]
+            if total <= max_size and rng.random() < 0.5:
+                outputs = [pick(total)]
+            else:
+                parts = _split(rng, total)
+                while max(parts) > max_size:
+                    parts = _split(rng, total)
+                outputs = [pick(s) for s in parts]
+
+        if formula == 1:
+            alpha, beta, gamma = 10 ** rng.uniform(-1, 1), 0.0, 0.0
+        elif formula == 2:
+            alpha, beta, gamma = 10 ** rng.uniform(-10, -9), 0.0, rng.uniform(1, 3)
+        elif formula == 3:
+            alpha, beta, gamma = 10 ** rng.uniform(-12, -9), rng.uniform(-1, 1), \
+                rng.uniform(0, 2e4)
+        else:
+            alpha, beta, gamma = rng.uniform(0.1, 1), 10 ** rng.uniform(-9.5, -8.5), \
+                rng.uniform(0.1, 3)
+        reactions.append((inputs, outputs, alpha, beta, gamma, int(formula)))
+
+    return list(zip(names, sizes.tolist())), reactions
+
+
+def write(directory, num_reactions, num_species=None, max_size=10, seed=0):
+    '''
+    Write kida_spec_synthetic_<n>.dat and kida_reac_synthetic_<n>.dat to
+    directory. Returns the paths of the reactions and species files.
+    '''
+    species, reactions = generate(num_reactions, num_species, max_size, seed)
+    os.makedirs(directory, exist_ok=True)
+    reac_file = os.path.join(directory, 'kida_reac_synthetic_{0}.dat'.format(num_reactions))
+    spec_file = os.path.join(directory, 'kida_spec_synthetic_{0}.dat'.format(num_reactions))
+
+    # Kida.read_species lets read_fwf infer the columns from the first 100
+    # lines, so the widest name comes first and the names and species
+    # numbers are zero padded to a fixed width.
+    with open(spec_file, 'w') as f:
+        f.write('# Synthetic species: {0} clusters of one element\n'.format(len(species)))
+        f.write('{0:<11}{1:>2}{2} {3:05}\n'.format('Photon', 0, '  0' * 22, 0))
+        for number, (name, size) in enumerate(species, 1):
+            atoms = [0] * 22
+            atoms[4] = size
+            f.write('{0:<11}{1:>2}{2} {3:05}\n'.format(
+                name, 0, ''.join('{0:>3}'.format(a) for a in atoms), number))
+
+    with open(reac_file, 'w') as f:
+        f.write('# Synthetic network: {0} reactions\n'.format(len(reactions)))
+        for inputs, outputs, alpha, beta, gamma, formula in reactions:
+            outputs = outputs + [''] * (3 - len(outputs))
+            fields = [inputs[0], inputs[1], outputs[0], outputs[1], outputs[2],
+                      '{0:>10.3e}'.format(alpha), '{0:>10.3e}'.format(beta),
+                      '{0:>10.3e}'.format(gamma), '{0:>8.2e}'.format(1.0),
+                      '{0:>8.2e}'.format(0.0), 'logn', '1', '10', '41000',
+                      '{0:>2}'.format(formula), '1', '1', '1']
+            f.write(''.join('{0:<{1}}'.format(field, width)
+                            for field, width in zip(fields, REAC_WIDTHS)).rstrip() + '\n')
+
+    return reac_file, spec_file
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write a synthetic KIDA network.")
+    parser.add_argument("reactions", type=int, help="number of reactions")
+    parser.add_argument("--species", type=int, default=None,
+                        help="number of species (default: reactions/5, 20 to 5000)")
+    parser.add_argument("--max-size", type=int, default=10)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-o", "--output", default="benchmarks/networks")
+    args = parser.parse_args()
+    for path in write(args.output, args.reactions, args.species, args.max_size, args.seed):
+        print(path)
@@ -0,0 +1,157 @@
+# -*- coding: utf-8 -*-
+"""
+checkpoint.py - Checkpoints, Resumed Runs and Warm Starts
+
+This file is part of CarBoN
+
+A Checkpointer is handed to simulation.integrate and saves the state of the
+run every interval seconds of wall time, and once more when the run ends or
+is interrupted. It sees the steps the run reports, so with output times
+(see simulation.output_times) it saves at the first output time after the
+interval has passed. A checkpoint is an .npz file holding
+
+    t, y            time (s) and the full solution vector of the last step
+    step, order     size and order of that step, where the backend tells
+    rows            rows of the trajectory written before that step
+    network         hash of the KIDA files, parser and grain bins
+    settings        hash of the network and the model settings
+    times           output times of the run in days (empty for every step)
+
+A checkpoint is used in two ways (see Simulation.from_settings):
+
+    resume          continue the same run from its last checkpoint. The
+                    settings must be the same, except for the end time, and
+                    the trajectory on disk is continued. The output times
+                    must be the same too, so with Sampling = log or linear,
+                    which space them up to the end time, so must the end
+                    time.
+    warm start      start a new model from a saved state, e.g. a variant
+                    that shares the early time chemistry of another run.
+                    Only the network has to be the same.
+
+"""
+
+import hashlib
+import os
+import time
+
+import numpy as np
+
+
+def digest(*values):
+    '''
+    sha256 of the repr of values, as a hex string.
+    '''
+    return hashlib.sha256(repr(values).encode()).hexdigest()
+
+
+class Checkpointer:
+    '''
+    Saves checkpoints of a run to path, see the module docstring.
+
+    network and settings are the hashes to store (see digest) and times the 
+    output times of the run in days (None for every step). Before each
+    save the trajectory writer of the run, if there is one, is flushed so
+    that the trajectory on disk reaches the checkpoint. If the run is of a
+    pruned network, set expand to its expand method (see
+    network.PrunedNetwork) so the full solution vector is saved.
+    '''
+    def __init__(self, path, interval=600, network='', settings='', times=None):
+        self.path = path
+        self.interval = interval
+        self.network = network
+        self.settings = settings
+        self.times = times
+        self.backend = None
+        self.writer = None
+        self.expand = None
+        self.saved = None
+        self._t = None
+        self._y = None
+        self._next = time.perf_counter() + interval
+
+    def attach(self, backend, writer=None):
+        '''
+        Take the step size from backend and the row count from writer.
+        '''
+        self.backend = backend
+        self.writer = writer
+        self._t = self._y = None
+
+    def handle_result(self, solver, t, y):
+        self._t, self._y = t, y.copy()
+        if time.perf_counter() >= self._next:
+            self.save()
+
+    def save(self):
+        '''
+        Write the last step to path. The file is replaced in one go, so an
+        interrupted save leaves the previous checkpoint intact.
+        '''
+        self._next = time.perf_counter() + self.interval
+        if self._t is None:
+            return
+        rows = 0
+        if self.writer is not None:
+            self.writer.flush()
+            # The resumed run reports this step again as its first
+            rows = self.writer.rows - 1
+        step, order = (None, None) if self.backend is None else self.backend.step_state()
+        y = self._y if self.expand is None else self.expand(self._y)
+
+        tmp = self.path + '.tmp.npz'
+        np.savez(tmp, t=self._t, y=y, step=np.nan if step is None else step,
+                 order=-1 if order is None else order, rows=rows,
+                 network=self.network, settings=self.settings,
+                 times=np.array([] if self.times is None else self.times, dtype=float))
+        os.replace(tmp, self.path)
+        self.saved = self._t
+
+    def close(self):
+        '''
+        Save the last step, at the end of a run or after an error.
+        '''
+        if self._t is not None and self._t != self.saved:
+            self.save()
+
+
+def load(path):
+    '''
+    A checkpoint as a dictionary with the entries listed in the module
+    docstring. step and order are None if they were not saved, and times 
+    is None for a run that kept every step.
+    '''
+    with np.load(path) as data:
+        state = {key: data[key][()] for key in data.files}
+    state['t'] = float(state['t'])
+    state['step'] = None if np.isnan(state['step']) else float(state['step'])
+    state['order'] = None if state['order'] < 0 else int(state['order'])
+    state['rows'] = int(state['rows'])
+    state['network'] = str(state['network'])
+    state['settings'] = str(state['settings'])
+    times = state.get('times')
+    state['times'] = None if times is None or np.size(times) == 0 else np.atleast_1d(times)
+    return state
+
+
+def check(state, network, settings=None, path='checkpoint', times=None):
+    '''
+    Raise ValueError unless the checkpoint state was saved for the same
+    network (and, if given, the same settings and output times).
+    '''
+    if state['network'] != network:
+        raise ValueError("{0} was saved for a different reactions or species file "
+                         "or different grains".format(path))
+    if settings is not None and state['settings'] != settings:
+        raise ValueError("{0} was saved with different model, solver or rate "
+                         "settings. Use it as a warm start instead".format(path))
+    if settings is not None and not _same_times(state['times'], times):
+        raise ValueError("{0} was saved with different output times. With Sampling "
+                         "= log or linear the end time has to stay the same, or use "
+                         "it as a warm start instead".format(path))
+
+
+def _same_times(saved, times):
+    if saved is None or times is None:
+        return saved is None and times is None
+    return np.array_equal(saved, np.asarray(times, dtype=float))
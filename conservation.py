@@ -0,0 +1,139 @@
+# -*- coding: utf-8 -*-
+"""
+conservation.py - Element and Charge Conservation Checks
+
+This file is part of CarBoN
+
+The number of atoms of every element and the total charge are the product
+y @ composition of the abundances and the composition matrix from
+Kida.composition. Chemistry conserves them, so any drift of these totals
+away from their values at the first step is integration error.
+
+A ConservationMonitor checks the totals during a run (it is handed to
+simulation.integrate like a trajectory writer) or afterwards, on a stored
+trajectory (check_trajectory). Either way the steps are buffered and
+checked a chunk at a time with one matrix product, so the check is cheap
+enough to leave on.
+
+Grain bins have no element composition. With grains, add_grain_mass adds
+the total grain mass (g) as one more conserved total, which coagulation
+conserves as long as no pair grows past the last bin.
+
+"""
+
+import numpy as np
+
+
+class ConservationMonitor:
+    '''
+    Flags totals that drift by more than rtol from their values at the
+    first step checked, and records when the drift started.
+
+    The drift of each total is relative to its starting value. The charge
+    starts near zero, so its drift is relative to the largest element total
+    instead.
+
+    composition has one row per species of the solution vector. If only
+    some of the species are integrated (a pruned network), set species to
+    their indices or mask.
+    '''
+    def __init__(self, composition, names, rtol=1e-6, chunk_size=1024,
+                 time_scale=1 / 86400):
+        self.composition = np.asarray(composition, dtype=float)
+        self.names = list(names)
+        self.rtol = rtol
+        self.chunk_size = chunk_size
+        self.time_scale = time_scale
+        self.species = None
+        self.reference = None
+        self.scale = None
+        self.max_drift = np.zeros(len(self.names))
+        self.started = {}
+        self._t = []
+        self._y = []
+
+    def handle_result(self, solver, t, y):
+        self._t.append(t)
+        self._y.append(y.copy())
+        if len(self._t) == self.chunk_size:
+            self.flush()
+
+    def flush(self):
+        '''
+        Check the buffered steps.
+        '''
+        if self._t:
+            t, y = np.array(self._t), np.array(self._y)
+            self._t, self._y = [], []
+            self.check(t, y)
+
+    def close(self):
+        self.flush()
+
+    def check(self, t, y):
+        '''
+        Check the abundances y (one row per time in t, in seconds).
+        '''
+        composition = self.composition if self.species is None \
+            else self.composition[self.species]
+        totals = np.asarray(y, dtype=float) @ composition
+        if self.reference is None:
+            self.reference = totals[0]
+            self.scale = np.abs(self.reference)
+            self.scale[self.scale == 0] = max(self.scale.max(), np.finfo(float).tiny)
+            if 'charge' in self.names:
+                self.scale[self.names.index('charge')] = self.scale.max()
+        drift = np.abs(totals - self.reference) / self.scale
+        self.max_drift = np.maximum(self.max_drift, drift.max(axis=0, initial=0))
+
+        for n in np.flatnonzero(drift.max(axis=0, initial=0) > self.rtol):
+            name = self.names[n]
+            if name not in self.started:
+                row = np.argmax(drift[:, n] > self.rtol)
+                self.started[name] = float(t[row] * self.time_scale)
+
+    @property
+    def ok(self):
+        return not self.started
+
+    def report(self):
+        '''
+        One line per conserved total: its largest drift and, if it went
+        over rtol, the time it first did.
+        '''
+        lines = []
+        for name, drift in zip(self.names, self.max_drift):
+            line = '{0:8s} max drift {1:.2e}'.format(name, drift)
+            if name in self.started:
+                line += '  over {0:.0e} from t={1:.6g}'.format(self.rtol, self.started[name])
+            lines.append(line)
+        return '\n'.join(lines)
+
+
+def add_grain_mass(composition, names, grains_spec):
+    '''
+    The composition matrix and names from Kida.composition with a 'grain
+    mass' column holding the mass (g) of each bin of grains_spec (the
+    species DataFrame of cip.Grains.output()).
+    '''
+    column = np.zeros((len(composition), 1))
+    column[grains_spec.species_num.to_numpy(dtype=np.int64), 0] = \
+        grains_spec.mass.to_numpy(dtype=float)
+    return np.hstack([composition, column]), list(names) + ['grain mass']
+
+
+def check_trajectory(reader, rtol=1e-6, block_size=1 << 16):
+    '''
+    Check the element totals of a stored run (a trajectory.TrajectoryReader
+    of a trajectory that holds the element counts of its species). Only the
+    stored species count, so with Species set in the [output] section the
+    totals are those of the stored species. Returns the ConservationMonitor.
+    '''
+    if not reader.elements:
+        raise ValueError("{0} holds no element counts".format(reader.path))
+    names = list(reader.elements)
+    composition = np.array([reader.elements[name] for name in names]).T
+    monitor = ConservationMonitor(composition, names, rtol, time_scale=1)
+    for t, y in reader.blocks(block_size):
+        monitor.check(t, y)
+    return monitor
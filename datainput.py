@@ -12,6 +12,8 @@ import pandas as pd
 import configparser as cp
 from sys import exit
 
+import CarBoN_Input_Processor as cip
+
 
 def KIDA_input(reac_file,spec_file):
     '''
@@ -33,12 +35,6 @@ def KIDA_input(reac_file,spec_file):
                     'alpha','beta','gamma','F','g','Type','Re','Tlo', 
                     'Thi','Fo','N','V','R']
     reac_col_widths=[11,23,11,11,34,11,11,11,9,9,5,3,7,7,3,5,2,3]
-    reac_dtypes={'Input1':str,'Input2':str,'Output1':str,'Output2':str,
-                 'Output3':str}
-
-    reac_df = pd.read_fwf(reac_file, comment='#', header=None,
-                          names=reac_col_names,widths=reac_col_widths,
-                          converters=reac_dtypes)
 
     spec_df = pd.read_fwf(spec_file, comment='#', header=None)
 
@@ -58,24 +54,41 @@ def KIDA_input(reac_file,spec_file):
 
     print(spec_dict)
 
-    for column in reac_df.columns[0:5]: 
-        reac_df[column] = reac_df[column].replace(spec_dict)
-        reac_df[column] = reac_df[column].astype('Int64')
+    # Species names are replaced by their numbers as the file is read
+    records = cip.fixed_width_records(reac_file, reac_col_widths)
+    data, masks = cip.parse_records(records, reac_col_names, spec_dict,
+                                    species=reac_col_names[0:5], integers=['Fo'],
+                                    strings=['Type'], name=reac_file)
+    reac_df = cip.records_frame(data, masks, nullable=reac_col_names[0:5])
 
     print(reac_df.dtypes)
 
     return reac_df, spec_df, spec_dict
 
 
-def settings():
-    
+def read_settings(path='settings.ini'):
+
     """ 
-    This function reads the settings specified in settings.ini 
+    This function parses settings.ini (or the file given by path) once. 
+    The *_settings functions below each read their section of the parsed 
+    file, so a run only reads the file one time. A file that is already 
+    parsed (a ConfigParser) is returned unchanged. 
     """
 
+    if isinstance(path, cp.ConfigParser):
+        return path
     config = cp.ConfigParser()
-    config.read('settings.ini')
+    config.read(path)
+
+    return config
+
+def settings(config):
     
+    """ 
+    This function reads the settings specified in settings.ini, parsed by 
+    read_settings 
+    """
+
     files = config['files']
     model = config['model']
     plot = config['plot']
@@ -93,13 +106,214 @@ def settings():
 
     return file_format, species_file, reactions_file, output_file, model_type, density, temperature, start_time, end_time, outfile
 
-def abundances(dictionary):
+def prune_settings(config):
+
+    """ 
+    This function reads the optional Prune key of the [model] section. 
+    Prune = yes drops the species and reactions that can not be reached 
+    from the initial abundances before integrating (network.PrunedNetwork). 
+    """
+
+    return config.getboolean('model', 'prune', fallback=False)
+
+def collider_settings(config):
+
+    """ 
+    This function reads the optional Colliders key of the [model] section. 
+    The third-body density of three-body (moderator) reactions is the number 
+    density of the model for Colliders = all, or else the summed abundances 
+    of the comma separated species listed. Returns None or the list of names. 
+    """
+
+    colliders = config.get('model', 'colliders', fallback='all').strip()
+    if colliders.lower() == 'all':
+        return None
+    return [name.strip() for name in colliders.split(',') if name.strip()]
+
+def solver_settings(config):
+
+    """ 
+    This function reads the optional [solver] section of settings.ini. 
+    Backend is one of the solvers in backends.py (auto, cvode, bdf, radau 
+    or lsoda), and the tolerances are the absolute and relative error 
+    tolerances of the integration. 
+    """
+
+    backend = config.get('solver', 'backend', fallback='auto').strip().lower()
+    atol = config.getfloat('solver', 'absolute tolerance', fallback=1e-12)
+    rtol = config.getfloat('solver', 'relative tolerance', fallback=1e-12)
+
+    return backend, atol, rtol
+
+def jit_settings(config):
+
+    """ 
+    This function reads the optional JIT key of the [solver] section. 
+    JIT = yes evaluates the rhs and Jacobian with the Numba kernels of 
+    kernels.py, and falls back to NumPy if Numba is not installed. 
+    """
+
+    return config.getboolean('solver', 'jit', fallback=False)
+
+def rate_settings(config):
+
+    """ 
+    This function reads the optional [rates] section of settings.ini. 
+    Tabulate = yes interpolates the rate coefficients from a table in log(T) 
+    instead of evaluating them on every call, Tolerance is the relative 
+    error allowed in the table and Clamp = yes holds each rate at its 
+    Tlo/Thi limits from the reactions file. Clamp changes the model, the 
+    same way with or without the table. 
+    """
+
+    tabulate = config.getboolean('rates', 'tabulate', fallback=False)
+    tolerance = config.getfloat('rates', 'tolerance', fallback=1e-4)
+    clamp = config.getboolean('rates', 'clamp', fallback=False)
+
+    return tabulate, tolerance, clamp
+
+def output_settings(config):
+
+    """ 
+    This function reads the optional [output] section of settings.ini. 
+    Returns None unless Trajectory = yes, otherwise the species to store 
+    (None for all of them), the precision (double or single) and the number 
+    of steps buffered before each write of the trajectory.TrajectoryWriter. 
+    """
+
+    if not config.getboolean('output', 'trajectory', fallback=False):
+        return None
+
+    output = config['output']
+    species = output.get('species', fallback='all').strip()
+    species = None if species.lower() == 'all' else \
+        [name.strip() for name in species.split(',') if name.strip()]
+    precision = output.get('precision', fallback='double').strip().lower()
+    chunk_size = output.getint('chunk size', fallback=4096)
+
+    return species, precision, chunk_size
+
+def sampling_settings(config):
+
+    """ 
+    This function reads the optional Sampling keys of the [output] section. 
+    Sampling = steps keeps every solver step. Sampling = log or linear gives 
+    Points output times spaced that way between the start and end time, and 
+    Sampling = list the comma separated Times (in days). Returns the 
+    sampling, the number of points and the list of times. 
+
+    With a sampling other than steps the run only reports the output 
+    times, so a checkpoint can only be saved at an output time (a resumed 
+    run has to continue the same times) and the [checkpoint] Interval is 
+    only checked there. The steps counted for the progress output are 
+    still the solver's own. 
+    """
+
+    sampling = config.get('output', 'sampling', fallback='steps').strip().lower()
+    if sampling not in ('steps', 'log', 'linear', 'list'):
+        raise ValueError("Unknown Sampling {0} in [output], use steps, log, "
+                         "linear or list".format(sampling))
+    points = config.getint('output', 'points', fallback=1000)
+    times = config.get('output', 'times', fallback='')
+    times = [float(time) for time in times.split(',') if time.strip()]
+    if sampling in ('log', 'linear') and points < 2:
+        raise ValueError("Sampling = {0} in [output] needs Points of 2 or more"
+                         .format(sampling))
+    if sampling == 'list' and not times:
+        raise ValueError("Sampling = list in [output] needs a list of Times")
+
+    return sampling, points, times
+
+def cache_settings(config):
+
+    """ 
+    This function reads the optional [cache] section of settings.ini. 
+    Returns the directory where Kida keeps the compiled networks, or None 
+    when Cache = no and the KIDA files are parsed on every run. Small 
+    networks are parsed either way, see Kida.load. 
+    """
+
+    if not config.getboolean('cache', 'cache', fallback=True):
+        return None
+
+    return config.get('cache', 'directory', fallback='cache')
+
+def grain_settings(config):
+
+    """ 
+    This function reads the optional [grains] section of settings.ini. 
+    Returns None unless Grains = yes, otherwise the minimum and maximum grain 
+    radius (m), the bin volume ratio, the Hamaker constant (J) and the grain 
+    material density (g/cm^3) used to build the CarBoN_Input_Processor.Grains 
+    bins. 
+    """
+
+    if not config.getboolean('grains', 'grains', fallback=False):
+        return None
+
+    grains = config['grains']
+    r_min = grains.getfloat('minimum radius')
+    r_max = grains.getfloat('maximum radius')
+    ratio = grains.getfloat('volume ratio')
+    hamaker = grains.getfloat('hamaker constant')
+    density = grains.getfloat('density')
+
+    return r_min, r_max, ratio, hamaker, density
+
+def monitor_settings(config):
+
+    """ 
+    This function reads the optional [monitor] section of settings.ini. 
+    Returns the seconds between printed progress lines, the file the 
+    instrumentation.Monitor events are logged to as JSON lines (None for 
+    no log) and the seconds between progress events in that log. 
+    """
+
+    progress = config.getfloat('monitor', 'progress interval', fallback=10)
+    log_file = config.get('monitor', 'log file', fallback='none').strip()
+    log_file = None if log_file.lower() in ('', 'none', 'no') else log_file
+    log_interval = config.getfloat('monitor', 'log interval', fallback=1)
+
+    return progress, log_file, log_interval
+
+def checkpoint_settings(config):
+
+    """ 
+    This function reads the optional [checkpoint] section of settings.ini. 
+    Returns whether checkpoints are saved, the checkpoint file (None for 
+    the Output File name with .checkpoint.npz added) and the seconds of 
+    wall time between checkpoints. The file is also where a resumed run 
+    looks for its checkpoint. With output Sampling other than steps the 
+    checkpoints are only saved at the output times, see sampling_settings. 
+    """
+
+    checkpoints = config.getboolean('checkpoint', 'checkpoint', fallback=False)
+    checkpoint_file = config.get('checkpoint', 'file', fallback='').strip() or None
+    interval = config.getfloat('checkpoint', 'interval', fallback=600)
+
+    return checkpoints, checkpoint_file, interval
+
+def conservation_settings(config):
+
+    """ 
+    This function reads the optional [conservation] section of settings.ini. 
+    Returns None when Check = no, otherwise the relative drift of the 
+    element and charge totals that is flagged by the 
+    conservation.ConservationMonitor. 
+    """
+
+    if not config.getboolean('conservation', 'check', fallback=True):
+        return None
+
+    return config.getfloat('conservation', 'tolerance', fallback=1e-6)
+
+def abundances(dictionary, path='abundances.ini'):
 
     """ This function reads the initial abundances of reactants supplied 
     by the abundances.ini file 
     """
     
-    abund_df = pd.read_fwf('abundances.ini', comment='#')
+    abund_df = pd.read_fwf(path, comment='#')
     abund_df['Species'] = abund_df['Species'].map(dictionary)
             
     return abund_df
@@ -133,13 +347,12 @@ def basic_input(reac_file,spec_file):
                 
     numspecies=len(speciesidx)+1
 
-    convert = lambda x: speciesidx[x] if x!=' ' else None
-
-    reactions=pd.read_csv(reac_file, comment = '#', names = colnames,
-                          converters = {0:convert, 1:convert, 2:convert,
-                                        3:convert, 4:convert, 5:convert})
-    reactions.fillna(0,inplace = True)
-    reactions[colnames[0:6]] = reactions[colnames[0:6]].astype(int)
+    # Same single pass reader as the KIDA files, empty species become 0
+    records = cip.csv_records(reac_file)
+    data, masks = cip.parse_records(records, colnames, speciesidx,
+                                    species=colnames[0:6], integers=['Formula'],
+                                    name=reac_file)
+    reactions = pd.DataFrame(data).fillna(0)
     
     return reactions,speciesidx,speciesmass,numspecies
 
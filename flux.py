@@ -0,0 +1,309 @@
+# -*- coding: utf-8 -*-
+"""
+flux.py - Reaction Flux Analysis of Stored Runs
+
+This file is part of CarBoN
+
+The flux of a reaction is its rate k(T) * y[in1] * y[in2] (cm^-3 s^-1) at
+each stored time. A FluxAnalysis streams a stored trajectory (see
+trajectory.py) a block of rows at a time, evaluates the fluxes of all
+reactions in the block as one (rows, reactions) array and integrates them
+over time windows, so runs much larger than memory can be analysed. The
+full time-by-reaction flux matrix can be written out as a trajectory of
+its own, with one column per reaction.
+
+The production and destruction terms of every species are taken from the
+stoichiometry of the network once, and the report lists, for each species
+and time window, the reactions that produced and destroyed most of it.
+
+Usage (with the settings and KIDA files of the run):
+    python flux.py output/working_on_it.dat.traj --species CO SiO --top 5
+    python flux.py output/working_on_it.dat.traj --windows 20 --flux output/flux.traj
+
+"""
+
+import argparse
+
+import numpy as np
+
+import CarBoN_Input_Processor as cip
+import datainput as d
+import models as m
+import network as net
+import trajectory as traj
+
+
+# Second reactant shown for unimolecular reactions of these KIDA formulas
+IMPLICIT = {1: 'CR', 2: 'Photon'}
+
+
+def reaction_labels(network, names):
+    '''
+    'A + B -> C + D' for every reaction of network. names maps species
+    indices to names. The Photon and M reactants, which the network drops
+    from in2, are put back from its photoreactions and threebody.
+    '''
+    name = lambda index: names.get(int(index), str(index))
+    threebody = np.zeros(network.num_reactions, dtype=bool)
+    threebody[network.threebody] = True
+    photo = np.zeros(network.num_reactions, dtype=bool)
+    photo[network.photoreactions] = True
+    labels = []
+    for r in range(network.num_reactions):
+        inputs = [name(network.in1[r])]
+        if network.in2[r] != 0:
+            inputs.append(name(network.in2[r]))
+        elif threebody[r]:
+            inputs.append('M')
+        elif network.formula[r] in IMPLICIT:
+            inputs.append(IMPLICIT[network.formula[r]])
+        elif photo[r]:
+            inputs.append('Photon')
+        outputs = [name(network.out1[r])] + [name(out) for out in
+                                             (network.out2[r], network.out3[r]) if out != 0]
+        labels.append('{0} -> {1}'.format(' + '.join(inputs), ' + '.join(outputs)))
+    return labels
+
+
+class FluxAnalysis:
+    '''
+    Integrated reaction fluxes of a stored run over time windows.
+
+    network is the compiled KIDA network (network.Network) of the run,
+    names maps its species indices to names, and conditions(t) gives the
+    temperature and number density at the times t in days, e.g.
+    m.conditions of the model of the run (see from_settings, which
+    evaluates the rate coefficients exactly even if the run used a rate
+    table, with the same Tlo/Thi clamp).
+
+    windows is the number of time windows, log-spaced between the first
+    and last stored time, or the window edges in days.
+
+    After run(), integrated[w, r] holds the flux of reaction r integrated
+    over window w (cm^-3), using the trapezoid rule between stored times. A
+    step between two stored times counts towards the window it starts in.
+    '''
+    def __init__(self, network, names, conditions, windows=10):
+        self.network = network
+        self.names = dict(names)
+        self.conditions = conditions
+        self.windows = windows
+        self.edges = None
+        self.integrated = None
+        self.labels = reaction_labels(network, self.names)
+        self.species = {name: index for index, name in self.names.items()}
+
+        # Production and destruction coefficients of every species, one row
+        # each, so the reactions of a species are a row slice
+        S = network.stoichiometry.tocsr()
+        self.production = S.multiply(S > 0).tocsr()
+        self.destruction = -S.multiply(S < 0).tocsr()
+        self.production.eliminate_zeros()
+        self.destruction.eliminate_zeros()
+
+        reactants = np.concatenate([network.in1, network.in2[network.bimolecular]])
+        if network.colliders is not None:
+            reactants = np.concatenate([reactants, network.colliders])
+        self.reactants = np.setdiff1d(reactants, [0])
+
+    def fluxes(self, t, y):
+        '''
+        Flux of every reaction at the times t (days) for the abundances y,
+        one row per time.
+        '''
+        T, ndens = self.conditions(t)
+        T = np.broadcast_to(np.asarray(T, dtype=float), np.shape(t))
+        if len(T) and np.all(T == T[0]):
+            k = self.network.rates(float(T[0]))
+        else:
+            k = self.network.rates(T[:, None])
+        ndens = np.broadcast_to(np.asarray(ndens, dtype=float), np.shape(t))
+        return self.network.reaction_rates(y, k, ndens)
+
+    def _window_edges(self, reader, time_scale):
+        if np.ndim(self.windows) != 0:
+            return np.asarray(self.windows, dtype=float)
+        t_first = float(reader.time[0]) * time_scale
+        t_last = float(reader.time[-1]) * time_scale
+        if t_first > 0:
+            return np.geomspace(t_first, t_last, self.windows + 1)
+        return np.linspace(t_first, t_last, self.windows + 1)
+
+    def run(self, reader, block_size=None, max_elements=1 << 24, writer=None):
+        '''
+        Integrate the fluxes of a stored run. reader is a
+        trajectory.TrajectoryReader (or the path of one) and must hold every
+        reactant of the network. The flux array of a block has at most
+        max_elements entries unless block_size rows are asked for.
+
+        writer (a trajectory.TrajectoryWriter with one column per reaction
+        and time_scale=1) gets the full flux matrix. Returns self.
+        '''
+        if isinstance(reader, str):
+            reader = traj.TrajectoryReader(reader)
+        stored = np.asarray(reader.meta['species']) if hasattr(reader, 'meta') \
+            else np.arange(len(reader.names))
+        missing = np.setdiff1d(self.reactants, stored)
+        if len(missing):
+            raise ValueError("{0} does not hold the reactants {1}".format(
+                reader.path, [self.names.get(int(i), str(i)) for i in missing]))
+
+        time_scale = 365.25 if reader.time_unit == 'years' else 1
+        n, R = self.network.num_species, self.network.num_reactions
+        if block_size is None:
+            block_size = max(1, max_elements // max(R, n))
+        self.edges = self._window_edges(reader, time_scale)
+        self.integrated = np.zeros((len(self.edges) - 1, R))
+
+        last_t = last_flux = None
+        for t, y_stored in reader.blocks(block_size):
+            t = t * time_scale
+            y = np.zeros((len(t), n))
+            y[:, stored] = y_stored
+            flux = self.fluxes(t, y)
+            if writer is not None:
+                writer.extend(t, flux)
+            if last_t is not None:
+                t = np.concatenate([[last_t], t])
+                flux = np.concatenate([last_flux[None], flux])
+            self._integrate(t, flux)
+            last_t, last_flux = t[-1], flux[-1]
+        if writer is not None:
+            writer.flush()
+        return self
+
+    def _integrate(self, t, flux):
+        # Trapezoid rule, each step added to the window it starts in
+        if len(t) < 2:
+            return
+        window = np.searchsorted(self.edges, t[:-1], side='right') - 1
+        inside = (window >= 0) & (window < len(self.integrated))
+        steps = 0.5 * (flux[1:] + flux[:-1]) * (np.diff(t) * 86400)[:, None]
+        np.add.at(self.integrated, window[inside], steps[inside])
+
+    def _contributions(self, coefficients, name):
+        index = self.species[name]
+        row = coefficients[index]
+        return row.indices, self.integrated[:, row.indices] * row.data
+
+    def totals(self, name):
+        '''
+        Total production and destruction of a species in each window
+        (cm^-3).
+        '''
+        production = self._contributions(self.production, name)[1].sum(axis=1)
+        destruction = self._contributions(self.destruction, name)[1].sum(axis=1)
+        return production, destruction
+
+    def top(self, name, n=5):
+        '''
+        The n reactions that produced and destroyed most of species name in
+        each window. Returns one list per window of (kind, reaction, label,
+        amount, share) tuples, kind being 'production' or 'destruction',
+        reaction the row of the reaction in the network, amount its
+        integrated contribution (cm^-3) and share its fraction of the total
+        of that kind.
+        '''
+        windows = [[] for _ in range(len(self.integrated))]
+        for kind, coefficients in (('production', self.production),
+                                   ('destruction', self.destruction)):
+            reactions, amounts = self._contributions(coefficients, name)
+            totals = amounts.sum(axis=1)
+            order = np.argsort(-amounts, axis=1, kind='stable')[:, :n]
+            for w, ranked in enumerate(order):
+                for column in ranked:
+                    if amounts[w, column] <= 0:
+                        break
+                    reaction = reactions[column]
+                    windows[w].append((kind, int(reaction), self.labels[reaction],
+                                       amounts[w, column],
+                                       amounts[w, column] / totals[w]))
+        return windows
+
+    def report(self, names, n=5):
+        '''
+        The top n reactions of each species in names and every window, for
+        printing.
+        '''
+        lines = []
+        for name in names:
+            for w, rows in enumerate(self.top(name, n)):
+                lines.append('{0}  t={1:.6g}-{2:.6g} days'.format(
+                    name, self.edges[w], self.edges[w + 1]))
+                for kind, reaction, label, amount, share in rows:
+                    lines.append('  {0:11s} {1:9.3e} {2:6.1%} {3:6d}  {4}'.format(
+                        kind, amount, share, reaction, label))
+        return '\n'.join(lines)
+
+
+def from_settings(settings='settings.ini', reac_file='data/kida_reac_C_O_Si_only.dat',
+                  spec_file='data/kida_spec_C_O_Si_only.dat', num_species=None,
+                  windows=10):
+    '''
+    A FluxAnalysis of a run made with the given settings (a path or a file 
+    parsed by datainput.read_settings) and KIDA files. num_species is the 
+    length of the solution vector of the run if it was longer than the KIDA 
+    network, i.e. with grains.
+    '''
+    config = d.read_settings(settings)
+    file_format, species_file, reactions_file, output_file, model_type, \
+        density, temperature, start_time, end_time, outfile = d.settings(config)
+    cache_dir = d.cache_settings(config)
+    colliders = d.collider_settings(config)
+    tabulate, rate_tolerance, clamp_rates = d.rate_settings(config)
+
+    kida_file = cip.Kida(reac_file, spec_file)
+    if cache_dir is None:
+        kida_file.read_species()
+        kida_file.read_reactions()
+    else:
+        kida_file.load(cache_dir)
+    kida_reac, kida_spec, spec_dict = kida_file.output()
+    if colliders is not None:
+        colliders = [spec_dict[name] for name in colliders]
+    network = net.Network(kida_reac, kida_spec, num_species, colliders, clamp_rates)
+
+    names = {index: name for name, index in spec_dict.items()
+             if name not in ('Pho', 'M') and index != 0}
+    conditions = lambda t: m.conditions(model_type, np.asarray(t) * 86400,
+                                        density, temperature)
+    return FluxAnalysis(network, names, conditions, windows)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Find the reactions that drove "
+                                     "the chemistry of a stored CarBoN run.")
+    parser.add_argument("trajectory", help="trajectory directory or .npz file of the run")
+    parser.add_argument("--settings", default="settings.ini")
+    parser.add_argument("--reac", help="path to KIDA reactions file",
+                        default="data/kida_reac_C_O_Si_only.dat")
+    parser.add_argument("--spec", help="path to KIDA species file",
+                        default="data/kida_spec_C_O_Si_only.dat")
+    parser.add_argument("--species", nargs='+', default=['CO', 'SiO'],
+                        help="species to report (default: CO SiO)")
+    parser.add_argument("--top", type=int, default=5,
+                        help="reactions listed per species and window (default: 5)")
+    parser.add_argument("--windows", type=int, default=10,
+                        help="number of log-spaced time windows (default: 10)")
+    parser.add_argument("--block-size", type=int, default=None,
+                        help="rows read at a time (default: by memory use)")
+    parser.add_argument("--flux", default=None,
+                        help="also write the flux of every reaction at every "
+                             "stored time to this trajectory directory")
+    args = parser.parse_args()
+
+    reader = traj.TrajectoryReader(args.trajectory)
+    num_species = reader.meta['num_species'] if hasattr(reader, 'meta') else None
+    analysis = from_settings(args.settings, args.reac, args.spec, num_species,
+                             args.windows)
+    writer = None
+    if args.flux is not None:
+        R = analysis.network.num_reactions
+        writer = traj.TrajectoryWriter(args.flux, R, names=dict(enumerate(analysis.labels)),
+                                       time_scale=1)
+    try:
+        analysis.run(reader, args.block_size, writer=writer)
+    finally:
+        if writer is not None:
+            writer.close()
+    print(analysis.report(args.species, args.top))
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+"""
+instrumentation.py - Solver Counters, Phase Timers and Progress Reporting
+
+This file is part of CarBoN
+
+A Monitor is handed to simulation.integrate (or Simulation) and counts the
+rhs and Jacobian evaluations and accepted steps as they happen, keeps the
+current t, T and ndens, and times the phases of a run (parse, compile,
+integrate, write). When the solver finishes, the statistics of the backend
+(see backends.py) fill in the counters it only reports at the end, such as
+the Newton iterations and error test failures.
+
+Consumers subscribe with a callback and an interval in seconds. Progress
+events reach each callback at most once per interval; phase and finish
+events always do. JsonLinesLog writes the events to a file, one JSON object
+per line, and print_progress prints them.
+
+Without a Monitor nothing is instrumented: integrate uses the bare rhs and
+Jacobian, so there is no cost when it is disabled.
+
+    monitor = Monitor('Chemnet')
+    monitor.subscribe(print_progress, interval=10)
+    monitor.log('output/run.jsonl')
+    t, y = Simulation.from_settings(monitor=monitor).run()
+
+"""
+
+import json
+import time
+from contextlib import contextmanager, nullcontext
+
+import numpy as np
+
+
+COUNTERS = ('rhs_evaluations', 'jacobian_evaluations', 'steps',
+            'rejected_steps', 'error_test_failures', 'nonlinear_iterations')
+
+
+def _plain(value):
+    # Ensemble runs have one T and ndens per zone
+    if isinstance(value, (np.ndarray, np.generic)):
+        return value.tolist()
+    return value
+
+
+class Monitor:
+    '''
+    Counters, phase timers and the current state of one run, see the module
+    docstring. t is the solver time in seconds; events report it in days.
+    '''
+    def __init__(self, name='Chemnet'):
+        self.name = name
+        self.counters = dict.fromkeys(COUNTERS, 0)
+        self.phases = {}
+        self.solver_stats = None
+        self.t = self.T = self.ndens = None
+        self._subscribers = []
+        self._next = np.inf
+        self._start = time.perf_counter()
+
+    def subscribe(self, callback, interval=1.0):
+        '''
+        Call callback(event) with progress events at most every interval
+        seconds, and with every phase and finish event. event is a
+        dictionary, see Monitor.event.
+        '''
+        self._subscribers.append([callback, interval, time.perf_counter()])
+        self._schedule()
+        return callback
+
+    def log(self, path, interval=1.0):
+        '''
+        Subscribe a JsonLinesLog writing to path. Returns the log.
+        '''
+        return self.subscribe(JsonLinesLog(path), interval)
+
+    def _schedule(self):
+        self._next = min((last + interval for callback, interval, last in self._subscribers),
+                         default=np.inf)
+
+    def event(self, kind, **fields):
+        '''
+        The current state as a dictionary: the event kind, run name, wall
+        time since the Monitor was made, t (days), T, ndens and counters.
+        '''
+        event = {'event': kind, 'name': self.name,
+                 'wall_time': time.perf_counter() - self._start,
+                 't': None if self.t is None else self.t / 86400,
+                 'T': _plain(self.T), 'ndens': _plain(self.ndens)}
+        event.update(self.counters)
+        event.update(fields)
+        return event
+
+    def emit(self, kind, force=True, **fields):
+        '''
+        Send an event to the subscribers. Unless force, only to those whose
+        interval has passed.
+        '''
+        now = time.perf_counter()
+        event = None
+        for subscriber in self._subscribers:
+            callback, interval, last = subscriber
+            if force or now >= last + interval:
+                if event is None:
+                    event = self.event(kind, **fields)
+                callback(event)
+                subscriber[2] = now
+        self._schedule()
+
+    def rhs(self, t, T, ndens):
+        '''
+        Count an rhs evaluation at time t (in seconds).
+        '''
+        self.counters['rhs_evaluations'] += 1
+        self.t, self.T, self.ndens = t, T, ndens
+        if time.perf_counter() >= self._next:
+            self.emit('progress', force=False)
+
+    def jacobian(self, t, T, ndens):
+        '''
+        Count a Jacobian evaluation at time t (in seconds).
+        '''
+        self.counters['jacobian_evaluations'] += 1
+        self.t, self.T, self.ndens = t, T, ndens
+
+    def step(self, t):
+        '''
+        Count an accepted step. Called from the step loop of the backend,
+        also when the solution is only reported at output times.
+        '''
+        self.counters['steps'] += 1
+        self.t = t
+
+    def add_time(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    @contextmanager
+    def phase(self, name):
+        '''
+        Time the body of a with statement as phase name and send a phase
+        event when it ends.
+        '''
+        start = time.perf_counter()
+        try:
+            yield self
+        finally:
+            duration = time.perf_counter() - start
+            self.add_time(name, duration)
+            self.emit('phase', phase=name, duration=duration)
+
+    def finish(self, stats=None):
+        '''
+        Take the counters the solver only reports at the end from its
+        statistics (see backends.STATISTICS) and send a finish event.
+        '''
+        if stats is not None:
+            self.solver_stats = dict(stats)
+            if stats.get('steps') is not None:
+                self.counters['steps'] = stats['steps']
+            # None where the solver does not report a counter
+            for key in ('error_test_failures', 'nonlinear_iterations'):
+                self.counters[key] = stats.get(key)
+            self.counters['rejected_steps'] = stats.get('error_test_failures')
+        self.emit('finish', phases=dict(self.phases))
+
+    def summary(self):
+        '''
+        The counters and phase times, one line each, for printing.
+        '''
+        lines = ['{0:22s}{1}'.format(key, '-' if value is None else value)
+                 for key, value in self.counters.items()]
+        lines += ['{0:22s}{1:.3f} s'.format(phase + ' time', seconds)
+                  for phase, seconds in self.phases.items()]
+        return '\n'.join(lines)
+
+
+def phase(monitor, name):
+    '''
+    monitor.phase(name), or a context that does nothing if monitor is None.
+    '''
+    return nullcontext() if monitor is None else monitor.phase(name)
+
+
+class JsonLinesLog:
+    '''
+    Subscriber writing every event it gets to path as one line of JSON.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, 'w')
+
+    def __call__(self, event):
+        self._file.write(json.dumps(event) + '\n')
+        self._file.flush()
+
+    def close(self):
+        self._file.close()
+
+
+def print_progress(event):
+    '''
+    Subscriber printing a line per event.
+    '''
+    if event['event'] == 'phase':
+        print('{0}: {1} took {2:.3f} s'.format(event['name'], event['phase'],
+                                              event['duration']))
+    elif event['event'] == 'progress':
+        T = np.atleast_1d(event['T'])
+        Temp = '{0:.6g}'.format(T.min()) if T.min() == T.max() else \
+            '{0:.6g}-{1:.6g}'.format(T.min(), T.max())
+        print('{0}: t={1:.6g} days, Temp={2}, {3} rhs and {4} Jacobian evaluations, '
+              '{5:.1f} s'.format(event['name'], event['t'], Temp,
+                                 event['rhs_evaluations'],
+                                 event['jacobian_evaluations'], event['wall_time']))
@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+"""
+kernels.py - JIT-compiled rhs and Jacobian Kernels
+
+This file is part of CarBoN
+
+For the small networks run most often, the NumPy rhs of network.Network
+spends most of its time in the overhead of many small array operations.
+JitNetwork evaluates the rate coefficients (KIDA formulas 1-6), the rhs
+and the values of the sparse Jacobian each in one loop over the compiled
+index arrays of the network, compiled by Numba.
+
+Numba is optional. Without it AVAILABLE is False and jit_network returns
+the network unchanged, so the NumPy path is used. The kernels are in
+numba_kernels.py, which is only imported (and Numba with it) when a
+network is compiled, so runs with JIT = no do not pay for importing Numba.
+The compiled kernels are cached on disk (in __pycache__, or
+NUMBA_CACHE_DIR if set), so only the first run after a change pays for the
+compilation.
+
+    network = kernels.jit_network(network)
+
+"""
+
+import importlib.util
+
+import numpy as np
+from scipy import sparse
+
+from network import CoupledNetwork, Network
+from rates import RateCoefficients
+
+AVAILABLE = importlib.util.find_spec('numba') is not None
+
+_compiled = None
+
+
+def _kernels():
+    '''
+    The numba_kernels module, imported on first use.
+    '''
+    global _compiled
+    if _compiled is None:
+        import numba_kernels
+        _compiled = numba_kernels
+    return _compiled
+
+
+class JitNetwork(Network):
+    '''
+    A network.Network whose rhs and Jacobian are evaluated by the Numba
+    kernels. It shares the arrays of the network it is made from. Rate
+    tables and other rate objects are still evaluated by NumPy, only the
+    plain RateCoefficients at a single temperature are compiled.
+    '''
+    def __init__(self, network):
+        if not AVAILABLE:
+            raise ImportError("JitNetwork needs numba")
+        _kernels()
+        self.__dict__.update(network.__dict__)
+        self._cache = (None, None, None)
+        self._colliders = np.array([], dtype=np.int64) if self.colliders is None \
+            else np.asarray(self.colliders, dtype=np.int64)
+
+    def rate_coefficients(self, T):
+        rates = self.rates
+        if type(rates) is not RateCoefficients or np.ndim(T) != 0 or rates.alpha.ndim != 1:
+            return rates(T)
+        # Keyed on the rate object too, in case it is replaced
+        cached, cached_T, k = self._cache
+        if cached is rates and cached_T == T:
+            return k
+        k = np.empty(self.num_reactions)
+        _kernels().rate_coefficients(rates.alpha, rates.beta, rates.gamma,
+                                     self.formula, rates.Tlo, rates.Thi, float(T), k)
+        k.flags.writeable = False
+        self._cache = (rates, T, k)
+        return k
+
+    def _number_density(self, ndens):
+        # With colliders the kernels sum the third-body density themselves
+        if ndens is not None:
+            return float(ndens)
+        if len(self.threebody) and self.colliders is None:
+            raise ValueError("Three-body reactions need the number density "
+                             "or a set of colliders")
+        return 0.0
+
+    def rhs(self, y, T, ndens=None):
+        if np.ndim(y) != 1:
+            return super().rhs(y, T, ndens)
+        f = np.zeros(self.num_species)
+        _kernels().rhs(self.rate_coefficients(T), y, self.in1, self.in2, self.out1,
+                       self.out2, self.out3, self.threebody, self._colliders,
+                       self._number_density(ndens), f)
+        return f
+
+    def jacobian(self, y, T, ndens=None):
+        data = np.zeros(self.jac_nnz)
+        _kernels().jacobian_data(self.rate_coefficients(T), y, self._colliders,
+                                 self._number_density(ndens), self._jac_coeffs,
+                                 self._jac_reactions, self._jac_partners,
+                                 self._jac_slots, data)
+        return sparse.csc_matrix((data, self._jac_indices, self._jac_indptr),
+                                 shape=(self.num_species, self.num_species))
+
+    def subnetwork(self, reactions, species):
+        return JitNetwork(super().subnetwork(reactions, species))
+
+
+def jit_network(network):
+    '''
+    network with its KIDA Network parts replaced by JitNetworks, or
+    network itself if Numba is not installed.
+    '''
+    if not AVAILABLE:
+        return network
+    if isinstance(network, CoupledNetwork):
+        return CoupledNetwork(*[jit_network(part) for part in network.parts])
+    if type(network) is Network:
+        return JitNetwork(network)
+    return network
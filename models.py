@@ -8,6 +8,8 @@ This file is part of CarBoN
 
 """
 
+from functools import lru_cache
+
 import numpy as np
 
 def cherchneffT(y, t, idx, mass, dens, T0 = 1.8e+4,
@@ -65,14 +67,35 @@ def constantD(t,dens,T0 = 1.8e+4,gamma = 1.593, t0 = 100):
     ndens = dens
     return T,ndens
 
+def conditions(model_type,t,dens,T0):
+    '''
+    Temperature and number density of the model named in settings.ini at 
+    time t (in seconds). dens and T0 are the Density and Temperature 
+    settings.
+    '''
+    if model_type=='Cons':
+        return constantD(t,dens=dens,T0=T0)
+    elif model_type=='Cherchneff':
+        return cherchneffT(None,t/86400,None,None,dens=dens,T0=T0)
+    elif model_type=='Yu':
+        return YuT(t/86400,dens=dens,T0=T0)
+    else:
+        raise ValueError("No Model Loaded: unknown model type {0}".format(model_type))
+
+FORMULAS = (1, 2, 3, 4, 5, 6)
+
 def arrhenius(a,b,c,T,formula):
     '''
     Set the correct reaction rate formula for reactions contained in the 
     reactions file. More details for rate formulas 1-5 are found at 
     http://kida.obs.u-bordeaux1.fr
     
-    Formula 6 is defined as f*K for grains. Van der Waals corrections are 
-    added in Chemnet
+    Formula 6 is the thermal coagulation kernel K*sqrt(T) for grains, with
+    alpha holding K. The f split between the two target bins and the Van
+    der Waals corrections are added in Chemnet
+
+    a, b, c and T may also be arrays. All of the reactions in one call must
+    share the same formula.
     '''
     
     # Formula choosing subroutine
@@ -93,9 +116,13 @@ def arrhenius(a,b,c,T,formula):
     elif formula==5:                  #ionpol 2
         k = a * b * (1 + 0.0967 * c * np.sqrt(300. / T) \
                      + (300 * c ** 2) / (10.526 * T))
+
+    elif formula==6:                  #Grain coagulation
+        k = a * np.sqrt(T)
+
     else:
-        exit("Unknown formula, please check the input reactions file \
-              for possible corruption")
+        raise ValueError("Unknown formula {0}, please check the input reactions "
+                         "file for possible corruption".format(formula))
 
     return k
 
@@ -124,3 +151,36 @@ def VdW(radius1,radius2,T,A,k=1.38e-23):
     W = (RT/a)**2*np.exp(-V/(k*T))
 
     return W
+
+def VdW_batch(radius1,radius2,T,A,k=1.38e-23,iterations=60):
+    """
+    Vectorized version of VdW for arrays of radius1, radius2, T and A that 
+    broadcast against each other. 
+
+    With u = (RT/a)**2 the Sceats polynomial reduces to the cubic 
+    u*(u-1)**2 = c, c = A*radius1*radius2/(3kT a**2). Its largest real root 
+    is the only root above 1, and Newton's method started from the upper 
+    bound 1+sqrt(c) converges to it from above for every element at once.
+
+    """
+    a = radius1+radius2
+    c = A*radius1*radius2/(3*k*T*a**2)
+    u = 1+np.sqrt(c)
+    for _ in range(iterations):
+        s = u-1
+        step = (u*s*s-c)/(s*(3*u-1))
+        u = u-step
+        if np.all(np.abs(step) <= 4*np.finfo(float).eps*u):
+            break
+    V = -(A/3)*radius1*radius2/a**2*(1/(u-1) + 1/u + 2*np.log(1-1/u))
+    W = u*np.exp(-V/(k*T))
+
+    return W
+
+@lru_cache(maxsize=4096)
+def VdW_cached(radius1,radius2,T,A):
+    """
+    VdW with a least-recently-used cache, for single (radius1, radius2, T) 
+    queries that fall outside a tabulated grid.
+    """
+    return VdW(radius1,radius2,T,A)
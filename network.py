@@ -0,0 +1,537 @@
+# -*- coding: utf-8 -*-
+"""
+network.py - Compiled Reaction Network
+
+This file is part of CarBoN
+
+"""
+
+import copy
+
+import numpy as np
+from scipy import sparse
+
+from rates import CoagulationRates, RateCoefficients, RateTable
+
+
+# Input2 of the three-body reactions, the number Kida gives the moderator M
+MODERATOR = 99
+
+
+class Network:
+    '''
+    A reaction network compiled from the DataFrames returned by Kida.output().
+
+    The reactant and product columns are turned into integer index arrays
+    once, and the network stoichiometry is stored as a sparse matrix
+    S[species, reaction]. The rhs of the rate equations is then
+
+        f = S @ (k * y[in1] * y[in2])
+
+    where the y[in2] factor is dropped for unimolecular reactions (in2==0).
+    Products that are missing (NaN) or that are the photon (0) are left out
+    of S, as in the original loop in chemnet. A Photon reactant is dropped
+    the same way, and photoreactions holds the indices of those reactions
+    so that they can still be told apart (see flux.reaction_labels).
+
+    Three-body reactions (A + M -> ..., Input2 == MODERATOR) take the
+    third-body density n_M in place of y[in2]:
+
+        k * y[in1] * n_M
+
+    M is not consumed and has no place in the solution vector, so their in2
+    is stored as 0 and threebody holds their indices. n_M is the number
+    density ndens of the model, or, if colliders holds the indices of some
+    species, the sum of their abundances.
+
+    F is the KIDA uncertainty factor of every rate coefficient, used by
+    sensitivity.py. With clamp each rate coefficient is held at its value
+    at Tlo or Thi outside the validity range given in the reactions file
+    (see rates.RateCoefficients), tabulated or not.
+
+    num_species sets the length of the solution vector when it is shared
+    with other species, e.g. the grain bins of a Coagulation network.
+    '''
+    def __init__(self, kida_reac, kida_spec, num_species=None, colliders=None,
+                 clamp=False):
+        self.num_species = num_species or len(kida_spec.index)
+
+        in2 = kida_reac['Input2'].fillna(0).to_numpy(dtype=np.int64)
+        self.threebody = np.flatnonzero(in2 == MODERATOR)
+        self.colliders = None if colliders is None else np.asarray(colliders, dtype=np.int64)
+
+        self.in1 = kida_reac['Input1'].to_numpy(dtype=np.int64)
+        self.in2 = np.where(in2 == MODERATOR, 0, in2)
+        self.photoreactions = np.flatnonzero(kida_reac['Input2'].notna().to_numpy()
+                                             & (in2 == 0))
+        self.out1 = kida_reac['Output1'].to_numpy(dtype=np.int64)
+        self.out2 = kida_reac['Output2'].fillna(0).to_numpy(dtype=np.int64)
+        self.out3 = kida_reac['Output3'].fillna(0).to_numpy(dtype=np.int64)
+        self.alpha = kida_reac['alpha'].to_numpy(dtype=float)
+        self.beta = kida_reac['beta'].to_numpy(dtype=float)
+        self.gamma = kida_reac['gamma'].to_numpy(dtype=float)
+        self.formula = kida_reac['Fo'].to_numpy(dtype=np.int64)
+        self.Tlo = kida_reac['Tlo'].to_numpy(dtype=float)
+        self.Thi = kida_reac['Thi'].to_numpy(dtype=float)
+        self.F = kida_reac['F'].to_numpy(dtype=float)
+        self.num_reactions = len(self.in1)
+        self.clamp = clamp
+        self.rates = self.exact_rates(self.alpha, self.beta, self.gamma)
+
+        self.bimolecular = np.flatnonzero(self.in2 != 0)
+        self.stoichiometry = self._build_stoichiometry()
+        self._build_jacobian_pattern()
+
+    def _build_stoichiometry(self):
+        reactions = np.arange(self.num_reactions)
+        bi = self.bimolecular
+        has_out2 = self.out2 != 0
+        has_out3 = self.out3 != 0
+
+        rows = np.concatenate([self.in1, self.in2[bi], self.out1,
+                               self.out2[has_out2], self.out3[has_out3]])
+        cols = np.concatenate([reactions, bi, reactions,
+                               reactions[has_out2], reactions[has_out3]])
+        coeffs = np.concatenate([-np.ones(self.num_reactions), -np.ones(len(bi)),
+                                 np.ones(self.num_reactions),
+                                 np.ones(has_out2.sum()), np.ones(has_out3.sum())])
+
+        # Duplicate (species, reaction) entries are summed, so e.g. C + C
+        # gives a coefficient of -2 for C.
+        return sparse.csr_matrix((coeffs, (rows, cols)),
+                                 shape=(self.num_species, self.num_reactions))
+
+    def _build_jacobian_pattern(self):
+        '''
+        Work out the sparsity pattern of the Jacobian once.
+
+        Every stoichiometry entry S[i, r] contributes S[i, r]*k[r]*y[partner]
+        to J[i, j] for each reactant j of reaction r, where partner is the
+        other reactant (or nothing for unimolecular reactions). The partner
+        index num_species points at a constant 1 appended to y, and
+        num_species + 1 at the third-body density n_M (see extend).
+
+        With colliders, n_M depends on y as well, and every collider c adds
+        S[i, r]*k[r]*y[in1] to J[i, c] for the three-body reactions r.
+        '''
+        S = self.stoichiometry.tocoo()
+        n = self.num_species
+        bi = np.isin(S.col, self.bimolecular)
+        tb = np.isin(S.col, self.threebody)
+
+        # d/dy[in1], then d/dy[in2] for the bimolecular reactions
+        rows = [S.row, S.row[bi]]
+        cols = [self.in1[S.col], self.in2[S.col[bi]]]
+        reactions = [S.col, S.col[bi]]
+        partners = [np.where(bi, self.in2[S.col], np.where(tb, n + 1, n)),
+                    self.in1[S.col[bi]]]
+        coeffs = [S.data, S.data[bi]]
+        if self.colliders is not None:
+            # d/dy[c] for every collider c of the three-body reactions
+            num_colliders = len(self.colliders)
+            threebody = np.repeat(S.col[tb], num_colliders)
+            rows.append(np.repeat(S.row[tb], num_colliders))
+            cols.append(np.tile(self.colliders, tb.sum()))
+            reactions.append(threebody)
+            partners.append(self.in1[threebody])
+            coeffs.append(np.repeat(S.data[tb], num_colliders))
+        rows, cols = np.concatenate(rows), np.concatenate(cols)
+        self._jac_coeffs = np.concatenate(coeffs)
+        self._jac_reactions = np.concatenate(reactions)
+        self._jac_partners = np.concatenate(partners)
+
+        # Sorting on (column, row) gives the CSC ordering directly
+        keys, self._jac_slots = np.unique(cols * n + rows, return_inverse=True)
+        self._jac_indices = keys % n
+        self._jac_indptr = np.concatenate([[0], np.cumsum(
+            np.bincount(keys // n, minlength=n))])
+        self.jac_nnz = len(keys)
+
+    def exact_rates(self, alpha, beta, gamma):
+        '''
+        RateCoefficients of the reactions of the network for the parameters
+        alpha, beta and gamma, clamped to Tlo/Thi if the network is.
+        '''
+        limits = (self.Tlo, self.Thi) if self.clamp else ()
+        return RateCoefficients(alpha, beta, gamma, self.formula, *limits)
+
+    def rate_coefficients(self, T):
+        '''
+        Rate coefficient of every reaction at temperature T.
+        '''
+        return self.rates(T)
+
+    def tabulate_rates(self, Tmin, Tmax, rtol=1e-4):
+        '''
+        Switch to rates interpolated from a RateTable covering Tmin to Tmax,
+        for models where T changes with time.
+        '''
+        if isinstance(self.rates, RateTable):
+            self.rates = self.rates.rates
+        self.rates = RateTable(self.rates, Tmin, Tmax, rtol=rtol)
+        return self.rates
+
+    def third_body_density(self, y, ndens=None):
+        '''
+        n_M of the three-body reactions: the summed abundances of the
+        colliders, or else the number density ndens. y may hold several
+        zones along its first axis.
+        '''
+        if self.colliders is not None:
+            return y[..., self.colliders].sum(axis=-1)
+        if ndens is None:
+            raise ValueError("Three-body reactions need the number density "
+                             "or a set of colliders")
+        return ndens
+
+    def extend(self, y, ndens=None):
+        '''
+        y with a constant 1 and the third-body density appended to its last
+        axis, for looking up the partners of the Jacobian terms.
+        '''
+        n_M = self.third_body_density(y, ndens) if len(self.threebody) else 0.0
+        n_M = np.broadcast_to(np.asarray(n_M, dtype=float), y.shape[:-1])
+        return np.concatenate([y, np.ones(y.shape[:-1] + (1,)), n_M[..., None]], axis=-1)
+
+    def reaction_rates(self, y, k, ndens=None):
+        '''
+        Mass-action rate of every reaction for abundances y and rate
+        coefficients k. ndens is the number density, the third-body density
+        of the three-body reactions unless there are colliders. y may hold
+        several rows (e.g. stored times) along its first axis, with k and
+        ndens of one row or one per row.
+        '''
+        rates = k * y[..., self.in1]
+        rates[..., self.bimolecular] *= y[..., self.in2[self.bimolecular]]
+        if len(self.threebody):
+            n_M = np.asarray(self.third_body_density(y, ndens))
+            rates[..., self.threebody] *= n_M[..., None]
+        return rates
+
+    def rhs(self, y, T, ndens=None):
+        '''
+        Time derivative of the abundances y at temperature T and number
+        density ndens.
+        '''
+        return self.stoichiometry @ self.reaction_rates(y, self.rate_coefficients(T), ndens)
+
+    def jacobian(self, y, T, ndens=None):
+        '''
+        Exact Jacobian df/dy of the rhs at temperature T and number density
+        ndens, as a sparse CSC matrix.
+        '''
+        k = self.rate_coefficients(T)
+        y_ext = self.extend(y, ndens)
+        values = self._jac_coeffs * k[self._jac_reactions] * y_ext[self._jac_partners]
+        data = np.bincount(self._jac_slots, weights=values, minlength=self.jac_nnz)
+        return sparse.csc_matrix((data, self._jac_indices, self._jac_indptr),
+                                 shape=(self.num_species, self.num_species))
+
+    def subnetwork(self, reactions, species):
+        '''
+        The network restricted to the given reactions, with every species
+        renumbered to its position in species. species must hold all the
+        reactants and products of those reactions, and 0 first so that a
+        missing product stays 0. A RateTable is rebuilt for the remaining
+        reactions.
+        '''
+        index = np.full(self.num_species, -1)
+        index[species] = np.arange(len(species))
+        sub = copy.copy(self)
+        sub.num_species = len(species)
+        sub.num_reactions = len(reactions)
+        for name in ('in1', 'in2', 'out1', 'out2', 'out3'):
+            setattr(sub, name, index[getattr(self, name)[reactions]])
+        for name in ('alpha', 'beta', 'gamma', 'formula', 'Tlo', 'Thi', 'F'):
+            setattr(sub, name, getattr(self, name)[reactions])
+        sub.rates = sub.exact_rates(sub.alpha, sub.beta, sub.gamma)
+        if isinstance(self.rates, RateTable):
+            sub.rates = RateTable(sub.rates, self.rates.Tmin, self.rates.Tmax,
+                                  rtol=self.rates.rtol)
+        sub.bimolecular = np.flatnonzero(sub.in2 != 0)
+        sub.threebody = np.flatnonzero(np.isin(reactions, self.threebody))
+        sub.photoreactions = np.flatnonzero(np.isin(reactions, self.photoreactions))
+        if self.colliders is not None:
+            # Colliders that were dropped would only add zeros
+            colliders = index[self.colliders]
+            sub.colliders = colliders[colliders >= 0]
+        sub.stoichiometry = sub._build_stoichiometry()
+        sub._build_jacobian_pattern()
+        return sub
+
+
+class Coagulation(Network):
+    '''
+    Smoluchowski grain coagulation built from the DataFrame of pairs returned
+    by Grains.output().
+
+    Each pair (i, j) is a bimolecular reaction with rate
+
+        K_ij * sqrt(T) * VdW(r_i, r_j, T) * y[i] * y[j]
+
+    that removes one grain from bins i and j and puts a fraction f_ijk of the
+    new grain into Output1 and the rest into Output2, which conserves the
+    grain mass unless the pair grows past the last bin. Collisions within
+    one bin (i == j) count every pair of grains twice, so their K_ij is
+    halved. The Grains indices are
+    already offset by the number of KIDA species, so num_species should be
+    the length of the shared gas + grain solution vector. Between Tmin and
+    Tmax the VdW factors come from a rates.VdWTable.
+    '''
+    def __init__(self, grains_reac, num_species, Tmin=None, Tmax=None):
+        self.num_species = num_species
+        self.in1 = grains_reac['Input1'].to_numpy(dtype=np.int64)
+        self.in2 = grains_reac['Input2'].to_numpy(dtype=np.int64)
+        self.out1 = grains_reac['Output1'].to_numpy(dtype=np.int64)
+        self.out2 = grains_reac['Output2'].to_numpy(dtype=np.int64)
+        self.fraction = grains_reac['f_ijk'].to_numpy(dtype=float)
+        self.num_reactions = len(self.in1)
+        K = grains_reac['K_ij'].to_numpy(dtype=float)
+        self.rates = CoagulationRates(np.where(self.in1 == self.in2, 0.5 * K, K),
+                                      grains_reac['Radius1'].to_numpy(dtype=float),
+                                      grains_reac['Radius2'].to_numpy(dtype=float),
+                                      grains_reac['Hamaker'].to_numpy(dtype=float),
+                                      Tmin, Tmax)
+
+        self.bimolecular = np.arange(self.num_reactions)
+        self.threebody = np.zeros(0, dtype=np.int64)
+        self.photoreactions = np.zeros(0, dtype=np.int64)
+        self.colliders = None
+        self.stoichiometry = self._build_stoichiometry()
+        self._build_jacobian_pattern()
+
+    def _build_stoichiometry(self):
+        reactions = np.arange(self.num_reactions)
+        ones = np.ones(self.num_reactions)
+        rows = np.concatenate([self.in1, self.in2, self.out1, self.out2])
+        cols = np.concatenate([reactions] * 4)
+        coeffs = np.concatenate([-ones, -ones, self.fraction, 1 - self.fraction])
+        return sparse.csr_matrix((coeffs, (rows, cols)),
+                                 shape=(self.num_species, self.num_reactions))
+
+    def tabulate_rates(self, Tmin, Tmax, rtol=1e-6):
+        '''
+        Tabulate the VdW factors between Tmin and Tmax.
+        '''
+        self.rates.tabulate(Tmin, Tmax, rtol=rtol)
+        return self.rates
+
+    def subnetwork(self, reactions, species):
+        '''
+        The coagulation pairs in reactions, renumbered as in
+        Network.subnetwork.
+        '''
+        index = np.full(self.num_species, -1)
+        index[species] = np.arange(len(species))
+        sub = copy.copy(self)
+        sub.num_species = len(species)
+        sub.num_reactions = len(reactions)
+        for name in ('in1', 'in2', 'out1', 'out2'):
+            setattr(sub, name, index[getattr(self, name)[reactions]])
+        sub.fraction = self.fraction[reactions]
+        rates = self.rates
+        sub.rates = CoagulationRates(rates.K[reactions], rates.radius1[reactions],
+                                     rates.radius2[reactions], rates.A[reactions])
+        if rates.vdw is not None:
+            sub.rates.tabulate(rates.vdw.Tmin, rates.vdw.Tmax, rtol=rates.vdw.rtol)
+        sub.bimolecular = np.arange(sub.num_reactions)
+        sub.stoichiometry = sub._build_stoichiometry()
+        sub._build_jacobian_pattern()
+        return sub
+
+
+class CoupledNetwork:
+    '''
+    Several networks sharing one solution vector, e.g. the KIDA gas phase
+    and grain Coagulation. The rhs and the sparse Jacobian are the sums of
+    those of the parts.
+    '''
+    def __init__(self, *parts):
+        sizes = set(part.num_species for part in parts)
+        if len(sizes) != 1:
+            raise ValueError("Coupled networks must share the same number of "
+                             "species, got {0}".format(sorted(sizes)))
+        self.parts = parts
+        self.num_species = sizes.pop()
+        pattern = sum(sparse.csc_matrix((np.ones(part.jac_nnz), part._jac_indices,
+                                         part._jac_indptr),
+                                        shape=(self.num_species, self.num_species))
+                      for part in parts)
+        self.jac_nnz = pattern.nnz
+
+    def rhs(self, y, T, ndens=None):
+        return sum(part.rhs(y, T, ndens) for part in self.parts)
+
+    def jacobian(self, y, T, ndens=None):
+        return sum(part.jacobian(y, T, ndens) for part in self.parts).tocsc()
+
+
+class Ensemble:
+    '''
+    num_zones independent copies of a network (a Network, Coagulation or
+    CoupledNetwork) stacked into one block-diagonal system, so that many
+    zones with their own T and density can be integrated by one solver.
+
+    The solution vector holds the zones one after the other, i.e. zone z
+    owns y[z*n:(z+1)*n] with n = network.num_species. The rate coefficients,
+    rhs and Jacobian values of all zones are evaluated together as
+    (num_zones, ...) arrays.
+    '''
+    def __init__(self, network, num_zones):
+        self.network = network
+        self.parts = getattr(network, 'parts', (network,))
+        self.num_zones = num_zones
+        self.zone_size = n = network.num_species
+        self.num_species = n * num_zones
+
+        # Every part adds into the union of the per-zone Jacobian patterns.
+        # _gather[p] maps the Jacobian terms of part p to their slot in it.
+        keys = [np.repeat(np.arange(n), np.diff(part._jac_indptr)) * n
+                + part._jac_indices for part in self.parts]
+        union = np.unique(np.concatenate(keys))
+        self._gather = []
+        for part, part_keys in zip(self.parts, keys):
+            slots = np.searchsorted(union, part_keys)[part._jac_slots]
+            self._gather.append(sparse.csr_matrix(
+                (np.ones(len(slots)), (np.arange(len(slots)), slots)),
+                shape=(len(slots), len(union))).T.tocsr())
+
+        # Block diagonal CSC structure. Column z*n + j holds the entries of
+        # column j of zone z, so the data is the (num_zones, nnz) array of
+        # Jacobian values flattened zone by zone.
+        indices = union % n
+        indptr = np.concatenate([[0], np.cumsum(np.bincount(union // n, minlength=n))])
+        zones = np.arange(num_zones)[:, None]
+        self._jac_indices = (indices + zones * n).ravel()
+        self._jac_indptr = np.concatenate([(indptr[:-1] + zones * len(union)).ravel(),
+                                           [num_zones * len(union)]])
+        self.jac_nnz = num_zones * len(union)
+        self._T = None
+        self._k = None
+
+    def zones(self, y):
+        '''
+        View of the solution vector (or solver output) with the zones on
+        their own axis, shape (..., num_zones, num_species).
+        '''
+        y = np.asarray(y)
+        return y.reshape(y.shape[:-1] + (self.num_zones, self.zone_size))
+
+    def rate_coefficients(self, T):
+        '''
+        Rate coefficients of every part for the zone temperatures T, each of
+        shape (num_zones, num_reactions). The last result is cached.
+        '''
+        T = np.broadcast_to(np.asarray(T, dtype=float), (self.num_zones,))
+        if self._T is None or not np.array_equal(T, self._T):
+            self._k = [part.rates(T[:, None]) for part in self.parts]
+            self._T = T.copy()
+        return self._k
+
+    def rhs(self, y, T, ndens=None):
+        '''
+        Time derivative of all zones. T and ndens hold one temperature and
+        number density per zone.
+        '''
+        Y = self.zones(y)
+        f = np.zeros_like(Y)
+        for part, k in zip(self.parts, self.rate_coefficients(T)):
+            rates = k * Y[:, part.in1]
+            rates[:, part.bimolecular] *= Y[:, part.in2[part.bimolecular]]
+            if len(part.threebody):
+                n_M = np.broadcast_to(part.third_body_density(Y, ndens), (self.num_zones,))
+                rates[:, part.threebody] *= n_M[:, None]
+            f += (part.stoichiometry @ rates.T).T
+        return f.ravel()
+
+    def jacobian(self, y, T, ndens=None):
+        '''
+        Exact block-diagonal Jacobian of all zones as a sparse CSC matrix.
+        '''
+        Y = self.zones(y)
+        data = 0
+        for part, k, gather in zip(self.parts, self.rate_coefficients(T), self._gather):
+            Y_ext = part.extend(Y, ndens)
+            values = part._jac_coeffs * k[:, part._jac_reactions] \
+                * Y_ext[:, part._jac_partners]
+            data = data + gather @ values.T
+        return sparse.csc_matrix((data.T.ravel(), self._jac_indices, self._jac_indptr),
+                                 shape=(self.num_species, self.num_species))
+
+
+def reachable(network, yinit):
+    '''
+    Species that can ever become non-zero when starting from yinit, and the
+    reactions of each part that can ever run.
+
+    Starting from the species present in yinit, a reaction is reachable
+    once all of its reactants are, and its products are then reachable as
+    well. This is repeated until nothing changes. Species 0 (the photon,
+    or no product) always counts as reachable.
+    '''
+    parts = getattr(network, 'parts', (network,))
+    species = np.asarray(yinit) > 0
+    species[0] = True
+    while True:
+        reactions = [species[part.in1] & species[part.in2] for part in parts]
+        produced = species.copy()
+        for part, live in zip(parts, reactions):
+            for name in ('out1', 'out2', 'out3'):
+                if hasattr(part, name):
+                    produced[getattr(part, name)[live]] = True
+        if np.array_equal(produced, species):
+            return species, reactions
+        species = produced
+
+
+class PrunedNetwork:
+    '''
+    A network reduced to the species and reactions reachable from yinit
+    (see reachable), with a shorter solution vector.
+
+    keep holds the original index of every remaining species, in order, and
+    index maps original indices to new ones (-1 for dropped species). Use
+    reduce() on vectors in the original order before integrating and
+    expand() to put results back in the original order, with zeros for the
+    dropped species (which stay at zero).
+    '''
+    def __init__(self, network, yinit):
+        self.original = network
+        self.original_num_species = network.num_species
+        species, reactions = reachable(network, yinit)
+        self.keep = np.flatnonzero(species)
+        self.index = np.full(network.num_species, -1)
+        self.index[self.keep] = np.arange(len(self.keep))
+
+        parts = [part.subnetwork(np.flatnonzero(live), self.keep)
+                 for part, live in zip(getattr(network, 'parts', (network,)), reactions)
+                 if live.any()]
+        if not parts:
+            # Nothing can react, keep an empty copy of the first part
+            first = getattr(network, 'parts', (network,))[0]
+            parts = [first.subnetwork(np.zeros(0, dtype=np.int64), self.keep)]
+        self.network = parts[0] if len(parts) == 1 else CoupledNetwork(*parts)
+        self.num_species = self.network.num_species
+        self.num_reactions = sum(part.num_reactions for part in parts)
+        self.jac_nnz = self.network.jac_nnz
+
+    def reduce(self, y):
+        '''
+        The remaining species of y (original order, last axis).
+        '''
+        return np.asarray(y)[..., self.keep]
+
+    def expand(self, y):
+        '''
+        y (reduced, last axis) in the original species order.
+        '''
+        y = np.asarray(y)
+        full = np.zeros(y.shape[:-1] + (self.original_num_species,), dtype=y.dtype)
+        full[..., self.keep] = y
+        return full
+
+    def rhs(self, y, T, ndens=None):
+        return self.network.rhs(y, T, ndens)
+
+    def jacobian(self, y, T, ndens=None):
+        return self.network.jacobian(y, T, ndens)
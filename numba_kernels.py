@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+numba_kernels.py - Numba Kernels of the rhs and Jacobian
+
+This file is part of CarBoN
+
+The compiled loops used by kernels.JitNetwork. Importing this module
+imports Numba, so kernels.py only imports it when a network is compiled.
+
+"""
+
+import numba
+import numpy as np
+
+
+@numba.njit(cache=True)
+def rate_coefficients(alpha, beta, gamma, formula, Tlo, Thi, T0, k):
+    # Same formulas as models.arrhenius, with T clamped to [Tlo, Thi]
+    for r in range(len(k)):
+        T = min(max(T0, Tlo[r]), Thi[r])
+        a, b, c = alpha[r], beta[r], gamma[r]
+        fo = formula[r]
+        if fo == 1:
+            k[r] = a * 2.0e-17
+        elif fo == 2:
+            k[r] = a * np.exp(-c * 1.0)
+        elif fo == 3:
+            k[r] = a * (T / 300) ** b * np.exp(-c / T)
+        elif fo == 4:
+            k[r] = a * b * (0.62 + 0.4767 * c * np.sqrt(300. / T))
+        elif fo == 5:
+            k[r] = a * b * (1 + 0.0967 * c * np.sqrt(300. / T)
+                            + (300 * c ** 2) / (10.526 * T))
+        else:
+            k[r] = a * np.sqrt(T)
+
+@numba.njit(cache=True)
+def third_body_density(y, colliders, ndens):
+    if len(colliders) == 0:
+        return ndens
+    n_M = 0.0
+    for c in colliders:
+        n_M += y[c]
+    return n_M
+
+@numba.njit(cache=True)
+def rhs(k, y, in1, in2, out1, out2, out3, threebody, colliders, ndens, f):
+    n_M = third_body_density(y, colliders, ndens)
+    rates = np.empty(len(k))
+    for r in range(len(k)):
+        rates[r] = k[r] * y[in1[r]]
+        if in2[r] != 0:
+            rates[r] *= y[in2[r]]
+    for r in threebody:
+        rates[r] *= n_M
+    # The columns of the stoichiometry matrix, see Network
+    for r in range(len(k)):
+        rate = rates[r]
+        f[in1[r]] -= rate
+        if in2[r] != 0:
+            f[in2[r]] -= rate
+        f[out1[r]] += rate
+        if out2[r] != 0:
+            f[out2[r]] += rate
+        if out3[r] != 0:
+            f[out3[r]] += rate
+
+@numba.njit(cache=True)
+def jacobian_data(k, y, colliders, ndens, coeffs, reactions, partners, slots,
+                   data):
+    # Partner n is the constant 1 and n + 1 the third-body density
+    n_M = third_body_density(y, colliders, ndens)
+    n = len(y)
+    for i in range(len(coeffs)):
+        partner = partners[i]
+        if partner < n:
+            factor = y[partner]
+        elif partner == n:
+            factor = 1.0
+        else:
+            factor = n_M
+        data[slots[i]] += coeffs[i] * k[reactions[i]] * factor
@@ -0,0 +1,392 @@
+# -*- coding: utf-8 -*-
+"""
+rates.py - Batched Rate Coefficients
+
+This file is part of CarBoN
+
+"""
+
+import math
+from functools import lru_cache
+
+import numpy as np
+
+import models as m
+
+
+class RateCoefficients:
+    '''
+    Evaluates the rate coefficients of a whole reaction list at once.
+
+    Reactions are grouped by KIDA formula when the object is built, and each
+    group is evaluated as one NumPy expression by m.arrhenius. The last
+    k-vector is kept together with its temperature, so calling again at the
+    same T (e.g. under m.constantD) returns the cached result.
+
+    T may also be an array of shape (N, 1), which gives k of shape
+    (N, num_reactions). Such results are not cached. With N rows, alpha,
+    beta and gamma may have shape (N, num_reactions) as well, e.g. one set
+    of perturbed parameters per zone of a network.Ensemble.
+
+    Given the Tlo and Thi limits of the reactions file, each reaction is
+    held at its rate at Tlo or Thi when T leaves its own validity range
+    (NaN and non-positive limits are ignored). The limits are kept in Tlo
+    and Thi, with -inf and inf where there are none.
+    '''
+    def __init__(self, alpha, beta, gamma, formula, Tlo=None, Thi=None):
+        self.alpha = np.asarray(alpha, dtype=float)
+        self.beta = np.asarray(beta, dtype=float)
+        self.gamma = np.asarray(gamma, dtype=float)
+        formula = np.asarray(formula)
+
+        unknown = np.setdiff1d(formula, m.FORMULAS)
+        if len(unknown) > 0:
+            rows = np.flatnonzero(np.isin(formula, unknown))
+            raise ValueError("Unknown formula(s) {0} in reactions {1}, please "
+                             "check the input reactions file for possible "
+                             "corruption".format(unknown.tolist(), rows.tolist()))
+
+        self.groups = [(fo, np.flatnonzero(formula == fo)) for fo in m.FORMULAS
+                       if np.any(formula == fo)]
+        self.num_reactions = n = len(formula)
+
+        self.Tlo = np.full(n, -np.inf)
+        self.Thi = np.full(n, np.inf)
+        if Tlo is not None:
+            Tlo = np.asarray(Tlo, dtype=float)
+            self.Tlo = np.where(Tlo > 0, Tlo, -np.inf)
+        if Thi is not None:
+            Thi = np.asarray(Thi, dtype=float)
+            self.Thi = np.where(Thi > 0, Thi, np.inf)
+        self.clamped = bool(np.isfinite(self.Tlo).any() or
+                            np.isfinite(self.Thi).any())
+        self._T = None
+        self._k = None
+
+    def __call__(self, T):
+        if np.ndim(T) == 0:
+            if T == self._T:
+                return self._k
+            k = self.evaluate(T)
+            k.flags.writeable = False
+            self._T, self._k = T, k
+            return k
+        return self.evaluate(T)
+
+    def evaluate(self, T, clamp=True):
+        '''
+        Rate coefficients at T, bypassing the cache. With clamp=False the
+        Tlo/Thi limits are ignored.
+        '''
+        k = np.empty(np.shape(T)[:-1] + (self.num_reactions,))
+        clamp = clamp and self.clamped
+        for fo, idx in self.groups:
+            # One temperature per reaction when clamped
+            T_fo = np.clip(T, self.Tlo[idx], self.Thi[idx]) if clamp else T
+            k[..., idx] = m.arrhenius(self.alpha[..., idx], self.beta[..., idx],
+                                      self.gamma[..., idx], T_fo, fo)
+        return k
+
+    def evaluate_each(self, T):
+        '''
+        Rate coefficients with a separate temperature T[i] for reaction i.
+        '''
+        T = np.clip(T, self.Tlo, self.Thi)
+        k = np.empty(self.num_reactions)
+        for fo, idx in self.groups:
+            k[idx] = m.arrhenius(self.alpha[idx], self.beta[idx],
+                                 self.gamma[idx], T[idx], fo)
+        return k
+
+
+class RateTable:
+    '''
+    Rate coefficients tabulated on a log-spaced temperature grid.
+
+    This is meant for the time-dependent models (m.cherchneffT, m.YuT) where
+    T changes on every rhs call and RateCoefficients cannot reuse its cache.
+    log(k) and its slope are tabulated against log(T) between Tmin and Tmax
+    and read back with cubic Hermite interpolation, so a lookup is one small
+    matrix product and one exp. The grid is refined until the interpolation
+    error at the midpoints of the grid is below rtol for every reaction.
+    Rate coefficients below kmin (e.g. exp(-gamma/T) underflowing at low T)
+    are treated as zero when checking the error.
+
+    Temperatures outside [Tmin, Tmax] are clipped to that range. If rates
+    has Tlo/Thi limits inside that range, the table holds the unclamped
+    rates and each reaction is held at its tabulated rate at its limit, so
+    the tabulated rates follow the same model as rates itself and stay
+    continuous in T.
+    '''
+    def __init__(self, rates, Tmin, Tmax, rtol=1e-4, kmin=1e-200,
+                 points_per_decade=8, max_points=1 << 14):
+        if not 0 < Tmin < Tmax:
+            raise ValueError("Need 0 < Tmin < Tmax to tabulate rates, got "
+                             "Tmin={0}, Tmax={1}".format(Tmin, Tmax))
+        self.rates = rates
+        self.rtol = rtol
+        self.kmin = kmin
+        self.num_reactions = n = rates.num_reactions
+        self.Tmin, self.Tmax = float(Tmin), float(Tmax)
+        self.logTmin, self.logTmax = np.log(Tmin), np.log(Tmax)
+
+        self.Tlo = np.where(rates.Tlo > Tmin, rates.Tlo, -np.inf)
+        self.Thi = np.where(rates.Thi < Tmax, rates.Thi, np.inf)
+        self.clamped = bool(np.isfinite(self.Tlo).any() or
+                            np.isfinite(self.Thi).any())
+
+        decades = np.log10(Tmax / Tmin)
+        points = max(2, int(np.ceil(points_per_decade * decades)) + 1)
+        while True:
+            self._build(points)
+            error = self._midpoint_error()
+            if error <= rtol:
+                break
+            if points >= max_points:
+                raise ValueError("Could not tabulate the rates to rtol={0} "
+                                 "with {1} points (error {2:.3g})"
+                                 .format(rtol, points, error))
+            points = min(2 * points - 1, max_points)
+        self.error = error
+        if self.clamped:
+            self.k_lo = self._at_limits(self.Tlo)
+            self.k_hi = self._at_limits(self.Thi)
+        self._T = None
+        self._k = None
+
+    def _at_limits(self, limits):
+        # Rates held outside the limits: the tabulated rate at a limit inside
+        # the table, so there is no jump, and the exact rate otherwise
+        k = self.rates.evaluate_each(np.where(np.isfinite(limits), limits, self.Tmin))
+        inside = np.flatnonzero((limits >= self.Tmin) & (limits <= self.Tmax))
+        x = (np.log(limits[inside]) - self.logTmin) / self.dlogT
+        i = np.clip(x.astype(np.int64), 0, len(self.segments) - 1)
+        w = x - i
+        v = 1 - w
+        basis = np.stack([(1 + 2 * w) * v * v, w * v * v,
+                          w * w * (3 - 2 * w), -w * w * v], axis=-1)
+        table = (basis * self.segments[i, :, inside]).sum(axis=-1)
+        positive = np.ones(len(inside), dtype=bool) if self._exp_columns is None \
+            else np.isin(inside, self._exp_columns)
+        k[inside] = np.where(positive, np.exp(table), table)
+        return k
+
+    def _build(self, points, eps=1e-5):
+        self.logT = np.linspace(self.logTmin, self.logTmax, points)
+        self.dlogT = self.logT[1] - self.logT[0]
+        logT = self.logT[:, None]
+        k = self.rates.evaluate(np.exp(logT), clamp=False)
+        k_up = self.rates.evaluate(np.exp(logT + eps), clamp=False)
+        k_down = self.rates.evaluate(np.exp(logT - eps), clamp=False)
+
+        # Interpolate log(k) unless k goes negative somewhere. Underflowed
+        # rates are stored as log(tiny), which reads back as ~0.
+        positive = np.all(k >= 0, axis=0) & np.all(k_up >= 0, axis=0) \
+            & np.all(k_down >= 0, axis=0)
+        tiny = np.finfo(float).tiny
+        to_table = lambda k: np.where(positive, np.log(np.maximum(k, tiny)), k)
+        table = to_table(k)
+        # Slopes are stored per grid step rather than per unit log(T)
+        slope = (to_table(k_up) - to_table(k_down)) / (2 * eps) * self.dlogT
+        self.segments = np.stack([table[:-1], slope[:-1],
+                                  table[1:], slope[1:]], axis=1)
+        self._exp_columns = None if positive.all() else np.flatnonzero(positive)
+
+    def _midpoint_error(self):
+        T = np.exp(self.logT[:-1] + 0.5 * self.dlogT)[:, None]
+        exact = self.rates.evaluate(T, clamp=False)
+        approx = self._interpolate(T, clamp=False)
+        scale = np.maximum(np.abs(exact), np.abs(approx))
+        significant = scale > self.kmin
+        if not np.any(significant):
+            return 0.0
+        return np.max(np.abs(approx - exact)[significant] / scale[significant])
+
+    def _interpolate(self, T, clamp=True):
+        x = (np.log(np.clip(T, self.Tmin, self.Tmax)) - self.logTmin) / self.dlogT
+        i = np.clip(x.astype(np.int64), 0, len(self.segments) - 1)
+        w = x - i
+        v = 1 - w
+        basis = np.stack([(1 + 2 * w) * v * v, w * v * v,
+                          w * w * (3 - 2 * w), -w * w * v], axis=-1)
+        k = np.matmul(basis, self.segments[i[..., 0]])[..., 0, :]
+        if self._exp_columns is None:
+            np.exp(k, out=k)
+        else:
+            k[..., self._exp_columns] = np.exp(k[..., self._exp_columns])
+        if clamp and self.clamped:
+            k = np.where(T < self.Tlo, self.k_lo, k)
+            k = np.where(T > self.Thi, self.k_hi, k)
+        return k
+
+    def _lookup(self, T):
+        # Scalar version of _interpolate without the array overheads
+        x = (math.log(min(max(T, self.Tmin), self.Tmax)) - self.logTmin) / self.dlogT
+        i = min(int(x), len(self.segments) - 1)
+        w = x - i
+        v = 1 - w
+        k = np.dot(((1 + 2 * w) * v * v, w * v * v, w * w * (3 - 2 * w), -w * w * v),
+                   self.segments[i])
+        if self._exp_columns is None:
+            np.exp(k, out=k)
+        else:
+            k[self._exp_columns] = np.exp(k[self._exp_columns])
+        if self.clamped:
+            k = np.where(T < self.Tlo, self.k_lo, k)
+            k = np.where(T > self.Thi, self.k_hi, k)
+        return k
+
+    def __call__(self, T):
+        if np.ndim(T) == 0:
+            if T == self._T:
+                return self._k
+            k = self._lookup(float(T))
+            k.flags.writeable = False
+            self._T, self._k = T, k
+            return k
+        return self._interpolate(T)
+
+
+class VdWTable:
+    '''
+    Van der Waals enhancement factors m.VdW for a fixed list of grain pairs,
+    tabulated on a log-spaced temperature grid.
+
+    log(W) and its slope are stored for every pair at every grid temperature
+    and read back with cubic Hermite interpolation in log(T), like RateTable.
+    The table is built with m.VdW_batch and refined until the error at the
+    grid midpoints is below rtol. Temperatures outside [Tmin, Tmax] are
+    evaluated exactly and the results are kept in an LRU cache of size
+    cache_size.
+    '''
+    def __init__(self, radius1, radius2, A, Tmin, Tmax, rtol=1e-6,
+                 points_per_decade=4, max_points=1 << 12, cache_size=64):
+        if not 0 < Tmin < Tmax:
+            raise ValueError("Need 0 < Tmin < Tmax to tabulate VdW factors, "
+                             "got Tmin={0}, Tmax={1}".format(Tmin, Tmax))
+        self.radius1 = np.asarray(radius1, dtype=float)
+        self.radius2 = np.asarray(radius2, dtype=float)
+        self.A = np.broadcast_to(np.asarray(A, dtype=float), self.radius1.shape)
+        self.rtol = rtol
+        self.Tmin, self.Tmax = float(Tmin), float(Tmax)
+        self.logTmin, self.logTmax = np.log(Tmin), np.log(Tmax)
+        self._columns = {pair: n for n, pair in
+                         enumerate(zip(self.radius1.tolist(), self.radius2.tolist()))}
+
+        decades = np.log10(Tmax / Tmin)
+        points = max(2, int(np.ceil(points_per_decade * decades)) + 1)
+        while True:
+            self._build(points)
+            error = self._midpoint_error()
+            if error <= rtol:
+                break
+            if points >= max_points:
+                raise ValueError("Could not tabulate the VdW factors to rtol={0} "
+                                 "with {1} points (error {2:.3g})"
+                                 .format(rtol, points, error))
+            points = min(2 * points - 1, max_points)
+        self.error = error
+        self._cache_size = cache_size
+        self._off_grid = lru_cache(maxsize=cache_size)(self._exact)
+
+    def __getstate__(self):
+        # The LRU cache wrapper cannot be pickled (e.g. for sweep workers)
+        state = self.__dict__.copy()
+        del state['_off_grid']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._off_grid = lru_cache(maxsize=self._cache_size)(self._exact)
+
+    def _exact(self, T):
+        W = m.VdW_batch(self.radius1, self.radius2, T, self.A)
+        W.flags.writeable = False
+        return W
+
+    def _build(self, points, eps=1e-5):
+        self.logT = np.linspace(self.logTmin, self.logTmax, points)
+        self.dlogT = self.logT[1] - self.logT[0]
+        logW = lambda logT: np.log(m.VdW_batch(self.radius1, self.radius2,
+                                               np.exp(logT)[:, None], self.A))
+        self.table = logW(self.logT)
+        # Slopes are stored per grid step rather than per unit log(T)
+        self.slope = (logW(self.logT + eps) - logW(self.logT - eps)) \
+            / (2 * eps) * self.dlogT
+
+    def _midpoint_error(self):
+        logT = self.logT[:-1] + 0.5 * self.dlogT
+        exact = m.VdW_batch(self.radius1, self.radius2, np.exp(logT)[:, None],
+                            self.A)
+        approx = np.array([self._interpolate(T) for T in np.exp(logT)])
+        return np.max(np.abs(approx - exact) / exact)
+
+    def _interpolate(self, T):
+        x = (math.log(T) - self.logTmin) / self.dlogT
+        i = min(max(int(x), 0), len(self.logT) - 2)
+        w = x - i
+        v = 1 - w
+        logW = (1 + 2 * w) * v * v * self.table[i] + w * v * v * self.slope[i] \
+            + w * w * (3 - 2 * w) * self.table[i + 1] - w * w * v * self.slope[i + 1]
+        return np.exp(logW)
+
+    def __call__(self, T):
+        '''
+        VdW factor of every pair at temperature T.
+        '''
+        T = float(T)
+        if self.Tmin <= T <= self.Tmax:
+            return self._interpolate(T)
+        return self._off_grid(T)
+
+    def lookup(self, radius1, radius2, T):
+        '''
+        VdW factor of a single tabulated pair. Temperatures off the grid go
+        through m.VdW_cached.
+        '''
+        n = self._columns[(radius1, radius2)]
+        if self.Tmin <= T <= self.Tmax:
+            return self._interpolate(T)[n]
+        return m.VdW_cached(radius1, radius2, T, float(self.A[n]))
+
+
+class CoagulationRates:
+    '''
+    Rate coefficients K*sqrt(T)*VdW(r1, r2, T) of grain coagulation pairs,
+    cached by temperature like RateCoefficients.
+
+    The VdW factors come from a VdWTable once tabulate() has been called and
+    from m.VdW_batch otherwise.
+    '''
+    def __init__(self, K, radius1, radius2, A, Tmin=None, Tmax=None):
+        self.K = np.asarray(K, dtype=float)
+        self.radius1 = np.asarray(radius1, dtype=float)
+        self.radius2 = np.asarray(radius2, dtype=float)
+        self.A = np.asarray(A, dtype=float)
+        self.num_reactions = len(self.K)
+        self.vdw = None
+        if Tmin is not None and Tmax is not None and Tmin < Tmax:
+            self.tabulate(Tmin, Tmax)
+        self._T = None
+        self._k = None
+
+    def tabulate(self, Tmin, Tmax, rtol=1e-6):
+        self.vdw = VdWTable(self.radius1, self.radius2, self.A, Tmin, Tmax,
+                            rtol=rtol)
+        self._T = None
+
+    def __call__(self, T):
+        if np.ndim(T) != 0:
+            # One temperature per row, e.g. the zones of a network.Ensemble
+            W = m.VdW_batch(self.radius1, self.radius2, T, self.A)
+            return m.arrhenius(self.K, 0, 0, T, 6) * W
+        if T == self._T:
+            return self._k
+        if self.vdw is not None:
+            W = self.vdw(T)
+        else:
+            W = m.VdW_batch(self.radius1, self.radius2, T, self.A)
+        k = m.arrhenius(self.K, 0, 0, T, 6) * W
+        k.flags.writeable = False
+        self._T, self._k = T, k
+        return k
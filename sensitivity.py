@@ -0,0 +1,431 @@
+# -*- coding: utf-8 -*-
+"""
+sensitivity.py - Sensitivity of Final Abundances to the Rate Parameters
+
+This file is part of CarBoN
+
+Finds the reactions whose alpha, beta and gamma matter for the final
+abundances of some target species (e.g. CO, SiO and SiC). Three methods:
+
+    cvodes  forward sensitivities d y / d ln alpha, integrated alongside
+            the model by Assimulo CVode (CVODES). Needs Assimulo.
+    fd      central finite differences of ln y in ln alpha, ln beta and
+            ln gamma of every reaction, with a relative step
+    mc      Monte Carlo: alpha of every reaction is scaled by a factor
+            drawn log-uniformly between 1/F and F, F being the KIDA
+            uncertainty factor, and ln y is correlated with the factors
+    auto    cvodes if Assimulo can be imported, fd otherwise
+
+fd and mc integrate many perturbed models. They are integrated zones at a
+time as one network.Ensemble (every zone with its own rate parameters) on a
+pool of worker processes, which get the compiled network once, when the
+pool starts. The two models of a central difference are always in the same
+batch, so they take the same time steps and most of the integration error
+cancels in their difference.
+
+The result is a Sensitivities table, ranked by the largest sensitivity of
+any target, that can be printed or written to a CSV file.
+
+Usage (with settings.ini and abundances.ini):
+    python sensitivity.py --species CO SiO SiC --method fd -j 8 --zones 16
+    python sensitivity.py --method mc --samples 512 -o output/sensitivity.csv
+
+"""
+
+import argparse
+import copy
+import csv
+import multiprocessing as mp
+
+import numpy as np
+
+import flux
+import models as m
+import simulation as sim
+
+
+PARAMETERS = ('alpha', 'beta', 'gamma')
+
+
+def kida_part(network):
+    '''
+    The KIDA Network of a network, which may be coupled to grains.
+    '''
+    return getattr(network, 'parts', (network,))[0]
+
+
+def perturbed_network(network, alpha, beta, gamma):
+    '''
+    A copy of network with the rate parameters of its KIDA part replaced.
+    They may hold one row per zone of a network.Ensemble. The rate
+    coefficients are evaluated exactly, without any rate table, but with
+    the Tlo/Thi clamp of the network.
+    '''
+    kida = copy.copy(kida_part(network))
+    kida.rates = kida.exact_rates(alpha, beta, gamma)
+    if not hasattr(network, 'parts'):
+        return kida
+    coupled = copy.copy(network)
+    coupled.parts = (kida,) + tuple(network.parts[1:])
+    return coupled
+
+
+class _ScaledRates:
+    # Rate coefficients times factors, the CVODES parameters
+    def __init__(self, rates, factors):
+        self.rates = rates
+        self.factors = factors
+
+    def __call__(self, T):
+        return self.rates(T) * self.factors
+
+
+_shared = {}
+
+
+def _init_worker(network, yinit, model, targets, backend, atol, rtol):
+    _shared.update(network=network, yinit=yinit, model=model, targets=targets,
+                   backend=backend, atol=atol, rtol=rtol)
+
+
+def _run_batch(task):
+    # Final abundances of the targets for a batch of parameter sets
+    first, alpha, beta, gamma = task
+    network = perturbed_network(_shared['network'], alpha, beta, gamma)
+    yinit = np.tile(_shared['yinit'], (len(alpha), 1))
+    try:
+        t, y = sim.integrate_ensemble(network, yinit, *_shared['model'],
+                                      atol=_shared['atol'], rtol=_shared['rtol'],
+                                      name='Sensitivity batch {0}'.format(first),
+                                      backend=_shared['backend'])
+        return first, y[-1][:, _shared['targets']], ''
+    except Exception as e:
+        return first, np.full((len(alpha), len(_shared['targets'])), np.nan), \
+            '{0}: {1}'.format(type(e).__name__, e)
+
+
+class Sensitivities:
+    '''
+    One row per rate parameter: the row of the reaction in the network, its
+    label, the parameter and the sensitivity of each target species
+    (values, one column per name). columns holds any further columns, one
+    value per row. Rows are ranked by the largest absolute value over the
+    targets.
+    '''
+    def __init__(self, method, reactions, labels, parameters, names, values,
+                 columns=None):
+        self.method = method
+        self.reactions = np.asarray(reactions)
+        self.labels = list(labels)
+        self.parameters = list(parameters)
+        self.names = list(names)
+        self.values = np.asarray(values, dtype=float)
+        self.columns = columns or {}
+
+    def ranked(self):
+        '''
+        Row indices, most important first. Rows without a value go last.
+        '''
+        score = np.nan_to_num(np.abs(self.values), nan=-1).max(axis=1, initial=-1)
+        return np.argsort(-score, kind='stable')
+
+    def rows(self):
+        '''
+        The table as a list of dictionaries, ranked.
+        '''
+        rows = []
+        for rank, n in enumerate(self.ranked(), 1):
+            row = {'rank': rank, 'reaction': int(self.reactions[n]),
+                   'label': self.labels[n], 'parameter': self.parameters[n]}
+            row.update(zip(self.names, self.values[n].tolist()))
+            row.update((name, values[n]) for name, values in self.columns.items())
+            rows.append(row)
+        return rows
+
+    def write(self, path):
+        '''
+        Write the ranked table to a CSV file.
+        '''
+        fields = ['rank', 'reaction', 'label', 'parameter'] + self.names + list(self.columns)
+        with open(path, 'w', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=fields)
+            writer.writeheader()
+            writer.writerows(self.rows())
+
+    def report(self, n=20):
+        '''
+        The n most important rows, for printing.
+        '''
+        lines = ['{0:>4} {1:>6} {2:9s}'.format('rank', 'row', 'parameter')
+                 + ''.join('{0:>11}'.format(name) for name in self.names) + '  reaction']
+        for row in self.rows()[:n]:
+            lines.append('{0:4d} {1:6d} {2:9s}'.format(row['rank'], row['reaction'],
+                                                       row['parameter'])
+                         + ''.join('{0:11.3e}'.format(row[name]) for name in self.names)
+                         + '  ' + row['label'])
+        return '\n'.join(lines)
+
+
+class SensitivityAnalysis:
+    '''
+    Sensitivities of the final abundances of the target species (a
+    {name: index} dictionary) of one model to the rate parameters of its
+    KIDA reactions. The model is given as for simulation.integrate; labels
+    are the reaction labels (see flux.reaction_labels).
+
+    processes is the size of the worker pool (all cores by default) and
+    zones the number of perturbed models integrated together as one
+    Ensemble. Runs that fail are left as NaN and counted in failed, with
+    the errors in errors.
+    '''
+    def __init__(self, network, yinit, model_type, density, temperature,
+                 start_time, end_time, targets, labels=None, atol=1.e-12,
+                 rtol=1.e-12, backend='auto', processes=None, zones=16):
+        self.network = network
+        self.yinit = np.asarray(yinit, dtype=float)
+        self.model = (model_type, density, temperature, start_time, end_time)
+        self.names = list(targets)
+        self.targets = np.array([targets[name] for name in self.names])
+        kida = kida_part(network)
+        self.labels = labels or ['reaction {0}'.format(r) for r in range(kida.num_reactions)]
+        self.atol = atol
+        self.rtol = rtol
+        self.backend = backend
+        self.processes = processes
+        self.zones = zones
+        self.failed = 0
+        self.errors = []
+
+    def final_abundances(self, alpha, beta, gamma, zones=None):
+        '''
+        Final abundances of the targets for every row of the parameter
+        arrays, integrated in batches of zones (self.zones by default) on
+        the worker pool.
+        '''
+        zones = zones or self.zones
+        tasks = [(n, alpha[n:n + zones], beta[n:n + zones], gamma[n:n + zones])
+                 for n in range(0, len(alpha), zones)]
+        final = np.empty((len(alpha), len(self.targets)))
+        backend = self.backend if isinstance(self.backend, str) else self.backend.name
+        initargs = (self.network, self.yinit, self.model, self.targets, backend,
+                    self.atol, self.rtol)
+        with mp.Pool(self.processes, initializer=_init_worker, initargs=initargs) as pool:
+            for first, y, error in pool.imap_unordered(_run_batch, tasks):
+                final[first:first + len(y)] = y
+                if error:
+                    self.failed += len(y)
+                    self.errors.append(error)
+        return final
+
+    def _log(self, y):
+        # ln y, with abundances below atol counted as atol
+        return np.log(np.maximum(y, self.atol))
+
+    def _reactions(self, reactions):
+        kida = kida_part(self.network)
+        return np.arange(kida.num_reactions) if reactions is None \
+            else np.asarray(reactions, dtype=np.int64)
+
+    def finite_difference(self, reactions=None, parameters=PARAMETERS, step=0.01):
+        '''
+        d ln y / d ln p for the parameters p of the given reactions (all by
+        default), by central differences with p scaled by 1 +- step.
+        Parameters that are zero are left out.
+        '''
+        kida = kida_part(self.network)
+        reactions = self._reactions(reactions)
+        base = {name: getattr(kida, name) for name in PARAMETERS}
+        rows = [(r, p) for r in reactions for p in parameters if base[p][r] != 0]
+
+        # Each parameter scaled up and down, in pairs that are never split
+        # between batches
+        samples = {name: np.tile(value, (2 * len(rows), 1))
+                   for name, value in base.items()}
+        for n, (r, p) in enumerate(rows):
+            samples[p][2 * n, r] *= 1 + step
+            samples[p][2 * n + 1, r] *= 1 - step
+        zones = max(2, self.zones - self.zones % 2)
+        ln_y = self._log(self.final_abundances(samples['alpha'], samples['beta'],
+                                               samples['gamma'], zones))
+        values = (ln_y[0::2] - ln_y[1::2]) / (np.log1p(step) - np.log1p(-step))
+        return Sensitivities('fd', [r for r, p in rows], [self.labels[r] for r, p in rows],
+                             [p for r, p in rows], self.names, values,
+                             {'F': np.array([kida.F[r] for r, p in rows])})
+
+    def monte_carlo(self, samples=256, reactions=None, seed=0):
+        '''
+        Scale alpha of the given reactions (all by default) by exp(x), x
+        drawn uniformly within +-ln F, in samples models at once. The
+        sensitivity of each reaction is the correlation of ln y with x;
+        the slope d ln y / d x of the fit is in the slope columns.
+        '''
+        kida = kida_part(self.network)
+        reactions = self._reactions(reactions)
+        ln_F = np.log(np.nan_to_num(kida.F[reactions], nan=1.0).clip(min=1.0))
+        rng = np.random.default_rng(seed)
+        x = rng.uniform(-1, 1, (samples, len(reactions))) * ln_F
+
+        alpha = np.tile(kida.alpha, (samples, 1))
+        alpha[:, reactions] *= np.exp(x)
+        ln_y = self._log(self.final_abundances(alpha, np.tile(kida.beta, (samples, 1)),
+                                               np.tile(kida.gamma, (samples, 1))))
+        ok = np.all(np.isfinite(ln_y), axis=1)
+        x, ln_y = x[ok], ln_y[ok]
+
+        dx, dy = x - x.mean(axis=0), ln_y - ln_y.mean(axis=0)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            covariance = dx.T @ dy / max(len(x) - 1, 1)
+            slope = covariance / dx.var(axis=0, ddof=1)[:, None]
+            correlation = covariance / np.outer(dx.std(axis=0, ddof=1),
+                                                dy.std(axis=0, ddof=1))
+        # Reactions without an uncertainty were not varied
+        slope[ln_F == 0] = correlation[ln_F == 0] = 0
+        columns = {'F': kida.F[reactions]}
+        columns.update(('slope ' + name, slope[:, n]) for n, name in enumerate(self.names))
+        return Sensitivities('mc', reactions, [self.labels[r] for r in reactions],
+                             ['alpha'] * len(reactions), self.names, correlation, columns)
+
+    def forward(self, reactions=None):
+        '''
+        d ln y / d ln alpha of the given reactions (all by default) from
+        CVODES forward sensitivities. Raises ImportError without Assimulo.
+        '''
+        from assimulo.problem import Explicit_Problem
+        from assimulo.solvers import CVode
+
+        kida = kida_part(self.network)
+        reactions = self._reactions(reactions)
+        factors = np.ones(kida.num_reactions)
+        scaled = copy.copy(kida)
+        scaled.rates = _ScaledRates(kida.rates, factors)
+        network = scaled
+        if hasattr(self.network, 'parts'):
+            network = copy.copy(self.network)
+            network.parts = (scaled,) + tuple(self.network.parts[1:])
+        model_type, density, temperature, start_time, end_time = self.model
+
+        def rhs(t, y, p):
+            factors[reactions] = np.exp(p)
+            T, Ndens = m.conditions(model_type, t, density, temperature)
+            return network.rhs(y, T, Ndens)
+
+        def jac(t, y, p=None):
+            if p is not None:
+                factors[reactions] = np.exp(p)
+            T, Ndens = m.conditions(model_type, t, density, temperature)
+            return network.jacobian(y, T, Ndens).toarray()
+
+        # p = ln(alpha / alpha0), so the sensitivities are d y / d ln alpha
+        model = Explicit_Problem(rhs, self.yinit, start_time * 86400,
+                                 p0=np.zeros(len(reactions)))
+        model.jac = jac
+        solver = CVode(model)
+        solver.atol = self.atol
+        solver.rtol = self.rtol
+        solver.maxord = 3
+        solver.linear_solver = 'DENSE'
+        solver.usejac = True
+        solver.pbar = np.ones(len(reactions))
+        solver.verbosity = 50
+        t, y = solver.simulate(end_time * 86400)
+
+        final = np.asarray(y)[-1, self.targets]
+        dy = np.array([np.asarray(s)[-1, self.targets] for s in solver.p_sol])
+        values = dy / np.maximum(final, self.atol)
+        return Sensitivities('cvodes', reactions, [self.labels[r] for r in reactions],
+                             ['alpha'] * len(reactions), self.names, values,
+                             {'F': kida.F[reactions]})
+
+    def run(self, method='auto', reactions=None, **options):
+        '''
+        Sensitivities by method (cvodes, fd, mc or auto), see the module
+        docstring. options go to the method, e.g. step or samples.
+        '''
+        if method == 'auto':
+            try:
+                import assimulo.solvers
+                method = 'cvodes'
+            except ImportError:
+                method = 'fd'
+        if method == 'cvodes':
+            return self.forward(reactions)
+        if method == 'fd':
+            return self.finite_difference(reactions, **options)
+        if method == 'mc':
+            return self.monte_carlo(reactions=reactions, **options)
+        raise ValueError("Unknown sensitivity method {0}, use auto, cvodes, fd "
+                         "or mc".format(method))
+
+
+def from_settings(settings='settings.ini', abundances='abundances.ini',
+                  reac_file='data/kida_reac_C_O_Si_only.dat',
+                  spec_file='data/kida_spec_C_O_Si_only.dat',
+                  species=('CO', 'SiO', 'SiC'), **kwargs):
+    '''
+    A SensitivityAnalysis of the model in settings.ini (a path or the file
+    parsed by datainput.read_settings). kwargs are passed on to
+    SensitivityAnalysis.
+    '''
+    simulation = sim.Simulation.from_settings(settings, abundances, reac_file, spec_file,
+                                              writer=None, checkpoint=None,
+                                              conservation=None)
+    spec_dict = simulation.spec_dict
+    unknown = [name for name in species if name not in spec_dict]
+    if unknown:
+        raise KeyError("Unknown species {0}".format(unknown))
+    names = {index: name for name, index in spec_dict.items()
+             if name not in ('Pho', 'M') and index != 0}
+    labels = flux.reaction_labels(kida_part(simulation.network), names)
+    kwargs.setdefault('backend', simulation.backend)
+    kwargs.setdefault('atol', simulation.atol)
+    kwargs.setdefault('rtol', simulation.rtol)
+    return SensitivityAnalysis(simulation.network, simulation.yinit,
+                               simulation.model_type, simulation.density,
+                               simulation.temperature, simulation.start_time,
+                               simulation.end_time,
+                               {name: spec_dict[name] for name in species},
+                               labels, **kwargs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rank the rate parameters that "
+                                     "matter for the final abundances.")
+    parser.add_argument("--settings", default="settings.ini")
+    parser.add_argument("--abundances", default="abundances.ini")
+    parser.add_argument("--reac", help="path to KIDA reactions file",
+                        default="data/kida_reac_C_O_Si_only.dat")
+    parser.add_argument("--spec", help="path to KIDA species file",
+                        default="data/kida_spec_C_O_Si_only.dat")
+    parser.add_argument("--species", nargs='+', default=['CO', 'SiO', 'SiC'],
+                        help="target species (default: CO SiO SiC)")
+    parser.add_argument("--method", default='auto',
+                        help="cvodes, fd, mc or auto (default: auto)")
+    parser.add_argument("--reactions", type=int, nargs='+', default=None,
+                        help="rows of the reactions to perturb (default: all)")
+    parser.add_argument("--step", type=float, default=0.01,
+                        help="relative step of fd (default: 0.01)")
+    parser.add_argument("--samples", type=int, default=256,
+                        help="number of mc samples (default: 256)")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("-j", "--processes", type=int, default=None,
+                        help="number of worker processes (default: all cores)")
+    parser.add_argument("--zones", type=int, default=16,
+                        help="perturbed models integrated at once (default: 16)")
+    parser.add_argument("--top", type=int, default=20,
+                        help="rows printed (default: 20)")
+    parser.add_argument("-o", "--output", default=None,
+                        help="write the ranked table to this CSV file")
+    args = parser.parse_args()
+
+    analysis = from_settings(args.settings, args.abundances, args.reac, args.spec,
+                             args.species, processes=args.processes, zones=args.zones)
+    options = {'fd': {'step': args.step},
+               'mc': {'samples': args.samples, 'seed': args.seed}}.get(args.method, {})
+    result = analysis.run(args.method, args.reactions, **options)
+    print(result.report(args.top))
+    if analysis.failed:
+        print('{0} perturbed runs failed, e.g. {1}'.format(analysis.failed,
+                                                          analysis.errors[0]))
+    if args.output:
+        result.write(args.output)
+        print('Table written to {0}'.format(args.output))
@@ -0,0 +1,488 @@
+# -*- coding: utf-8 -*-
+"""
+simulation.py - Integration of a Compiled Network
+
+This file is part of CarBoN
+
+Nothing here runs on import, and Assimulo is only imported when a model is
+integrated, so the module can be used from worker processes and called
+repeatedly in one process:
+
+    simulation = Simulation.from_settings('settings.ini')
+    t, y = simulation.run()
+
+"""
+
+import time
+
+import numpy as np
+
+import backends
+import checkpoint as ckpt
+import conservation as cons
+import CarBoN_Input_Processor as cip
+import datainput as d
+import instrumentation as instr
+import models as m
+import network as net
+import trajectory as traj
+
+
+def initial_abundances(num_species, spec_dict, abundances):
+    '''
+    Build yinit from a {species name: abundance} dictionary.
+    '''
+    yinit = np.zeros([num_species])
+    for name, value in abundances.items():
+        if name not in spec_dict:
+            raise KeyError("Unknown species {0} in the initial abundances".format(name))
+        yinit[spec_dict[name]] = value
+    return yinit
+
+
+def species_dictionary(spec_dict, grains_spec=None):
+    '''
+    spec_dict with the names and indices of the grain bins (G1, G2, ...) 
+    of grains_spec added, so that the initial abundances can seed them and 
+    the output names them.
+    '''
+    spec_dict = dict(spec_dict)
+    if grains_spec is not None:
+        spec_dict.update(zip(grains_spec.species.tolist(), grains_spec.species_num.tolist()))
+    return spec_dict
+
+
+def integrate(network, yinit, model_type, density, temperature, start_time,
+              end_time, atol=1.e-12, rtol=1.e-12, name='Chemnet', writer=None,
+              verbose=False, backend='auto', monitor=None, checkpoint=None,
+              first_step=None, conservation=None, times=None):
+    '''
+    Integrate a compiled network. start_time and end_time are in days, and 
+    so is the returned time array. With times (in days, see output_times) 
+    the solution is only reported at the start time and those times, 
+    interpolated by the solver, instead of at every step.
+
+    backend is the name of a backends.py solver (by default CVode with the 
+    same settings as CarBoNpy.py has always used, or scipy BDF if Assimulo 
+    is not installed) or a backend object. The backend object keeps the 
+    statistics of the run in its stats attribute.
+
+    If writer (a trajectory.TrajectoryWriter) is given, every step is 
+    written to it as it is taken and not kept by the solver, so the 
+    returned arrays are empty.
+
+    monitor (an instrumentation.Monitor) counts the evaluations and steps 
+    and reports progress. With verbose and no monitor, progress is printed 
+    every 10 seconds.
+
+    checkpoint (a checkpoint.Checkpointer) saves the state of the run as it 
+    goes. first_step is the size in seconds of the first step the solver 
+    tries, e.g. the step a checkpoint was saved with. conservation (a 
+    conservation.ConservationMonitor) checks the element totals of every 
+    step.
+    '''
+    backend = backends.get_backend(backend, atol=atol, rtol=rtol)
+    if verbose and monitor is None:
+        monitor = instr.Monitor(name)
+        monitor.subscribe(instr.print_progress, interval=10)
+    handle_result = None if writer is None else writer.handle_result
+
+    if monitor is None:
+        def chemnet(t, y):
+            T, Ndens = m.conditions(model_type, t, density, temperature)
+            return network.rhs(y, T, Ndens)
+
+        def chemjac(t, y):
+            T, Ndens = m.conditions(model_type, t, density, temperature)
+            return network.jacobian(y, T, Ndens)
+    else:
+        def chemnet(t, y):
+            T, Ndens = m.conditions(model_type, t, density, temperature)
+            monitor.rhs(t, T, Ndens)
+            return network.rhs(y, T, Ndens)
+
+        def chemjac(t, y):
+            T, Ndens = m.conditions(model_type, t, density, temperature)
+            monitor.jacobian(t, T, Ndens)
+            return network.jacobian(y, T, Ndens)
+
+        if writer is not None:
+            def handle_result(solver, t, y):
+                start = time.perf_counter()
+                writer.handle_result(solver, t, y)
+                monitor.add_time('write', time.perf_counter() - start)
+
+    steps = None
+    observers = [o for o in (checkpoint, conservation) if o is not None]
+    if checkpoint is not None:
+        checkpoint.attach(backend, writer)
+    if observers:
+        report = handle_result
+        if report is None:
+            # The observers need every step, so keep them here instead of 
+            # in the solver
+            steps = [], []
+            report = lambda solver, t, y: (steps[0].append(t), steps[1].append(y.copy()))
+
+        def handle_result(solver, t, y):
+            report(solver, t, y)
+            for observer in observers:
+                observer.handle_result(solver, t, y)
+
+    try:
+        t, y = backend.integrate(chemnet, chemjac, network.jac_nnz, yinit,
+                                 start_time * 86400, end_time * 86400,
+                                 handle_result=handle_result, name=name,
+                                 first_step=first_step,
+                                 times=None if times is None else np.asarray(times) * 86400,
+                                 step=None if monitor is None else monitor.step)
+    finally:
+        if writer is not None:
+            start = time.perf_counter()
+            writer.flush()
+            if monitor is not None:
+                monitor.add_time('write', time.perf_counter() - start)
+        for observer in observers:
+            observer.close()
+        if monitor is not None:
+            monitor.finish(backend.stats)
+    if steps is not None:
+        t, y = np.array(steps[0]), np.array(steps[1])
+    return t / 86400, y
+
+
+def integrate_ensemble(network, yinit, model_type, density, temperature,
+                       start_time, end_time, atol=1.e-12, rtol=1.e-12,
+                       name='Chemnet ensemble', backend='auto', monitor=None,
+                       times=None):
+    '''
+    Integrate many independent zones of the same network with a single 
+    solver instance. yinit has shape (num_zones, num_species), and density 
+    and temperature hold the Density and Temperature setting of each zone 
+    (or a single value for all of them). 
+
+    The zones share the solver's time steps, so the step size follows the 
+    stiffest zone. Returns the time array in days and y with shape 
+    (len(t), num_zones, num_species), at every step or at the output times 
+    (see integrate).
+    '''
+    yinit = np.atleast_2d(yinit)
+    ensemble = net.Ensemble(network, len(yinit))
+    density = np.broadcast_to(np.asarray(density, dtype=float), (ensemble.num_zones,))
+    temperature = np.broadcast_to(np.asarray(temperature, dtype=float),
+                                  (ensemble.num_zones,))
+    t, y = integrate(ensemble, yinit.ravel(), model_type, density, temperature,
+                     start_time, end_time, atol=atol, rtol=rtol, name=name,
+                     backend=backend, monitor=monitor, times=times)
+    return t, ensemble.zones(y)
+
+
+class _ExpandingWriter:
+    # Puts the dropped species of a PrunedNetwork back before writing a step
+    def __init__(self, writer, pruned):
+        self.writer = writer
+        self.pruned = pruned
+
+    @property
+    def rows(self):
+        return self.writer.rows
+
+    def handle_result(self, solver, t, y):
+        self.writer.handle_result(solver, t, self.pruned.expand(y))
+
+    def flush(self):
+        self.writer.flush()
+
+
+def output_times(sampling, points, times, start_time, end_time):
+    '''
+    Output times in days for the sampling read by datainput.sampling_settings: 
+    points log- or linearly spaced times from start_time to end_time, the 
+    listed times, or None to keep every step.
+    '''
+    if sampling == 'steps':
+        return None
+    if sampling == 'log':
+        if start_time <= 0:
+            raise ValueError("Log spaced output times need a start time above 0")
+        return np.geomspace(start_time, end_time, points)
+    if sampling == 'linear':
+        return np.linspace(start_time, end_time, points)
+    return np.sort(np.asarray(times, dtype=float))
+
+
+def build_network(kida_reac, kida_spec, Tmin, Tmax,
+                  tabulate=False, rate_tolerance=1e-4, clamp_rates=False,
+                  grains=None, colliders=None, jit=False):
+    '''
+    Compile the KIDA network and, if grains holds the settings returned by 
+    datainput.grain_settings, the grain coagulation network. The grain bins 
+    follow the rows of the KIDA species in the solution vector (one per 
+    line of the species file). With tabulate the KIDA 
+    rate coefficients are interpolated from a table between Tmin and Tmax. 
+    With clamp_rates they are held at their Tlo/Thi limits outside the 
+    validity range of each reaction. colliders are the species indices whose abundances make up the 
+    third-body density of three-body reactions (None for the number 
+    density of the model). With jit the rhs and Jacobian of the KIDA 
+    network are evaluated by the Numba kernels of kernels.py, if Numba is 
+    installed.
+
+    Returns the network and the species DataFrame of the grain bins (None 
+    without grains).
+    '''
+    num_species = len(kida_spec.index)
+    grains_spec = None
+    if grains is not None:
+        # Grains numbers its bins from the index after the one it is given
+        grains_reac, grains_spec = cip.Grains(*grains, num_species - 1).output()
+        if grains_spec.species_num.min() <= kida_spec.species_num.max():
+            raise ValueError("The grain bins overlap the KIDA species")
+        num_species += len(grains_spec.index)
+
+    network = net.Network(kida_reac, kida_spec, num_species, colliders, clamp_rates)
+    if tabulate:
+        network.tabulate_rates(Tmin, Tmax, rtol=rate_tolerance)
+    if jit:
+        # Only imported (with Numba) when it is used
+        import kernels
+        network = kernels.jit_network(network)
+
+    if grains is not None:
+        coagulation = net.Coagulation(grains_reac, num_species, Tmin, Tmax)
+        network = net.CoupledNetwork(network, coagulation)
+    return network, grains_spec
+
+
+def network_from_settings(config, kida_file, model_type, Tmin, Tmax):
+    '''
+    build_network for a parsed Kida file with the [rates], [grains], 
+    [model] Colliders and [solver] JIT settings of config (a settings file 
+    parsed by datainput.read_settings), for models whose temperature stays 
+    between Tmin and Tmax. This is how Simulation.from_settings and 
+    sweep.py compile their networks.
+    '''
+    tabulate, rate_tolerance, clamp_rates = d.rate_settings(config)
+    colliders = d.collider_settings(config)
+    kida_reac, kida_spec, spec_dict = kida_file.output()
+    if colliders is not None:
+        unknown = [name for name in colliders if name not in spec_dict]
+        if unknown:
+            raise KeyError("Unknown colliders {0} in [model] Colliders".format(unknown))
+        colliders = [spec_dict[name] for name in colliders]
+    # Under constantD the rates are computed once and cached anyway
+    return build_network(kida_reac, kida_spec, Tmin, Tmax,
+                         tabulate and model_type != 'Cons', rate_tolerance, clamp_rates,
+                         d.grain_settings(config), colliders, d.jit_settings(config))
+
+
+class Simulation:
+    '''
+    A single CarBoN model: a compiled network, its initial abundances and 
+    the temperature and density model, with start_time and end_time in 
+    days. 
+
+    Simulation.from_settings builds one the way CarBoNpy.py does, from 
+    settings.ini, abundances.ini and the KIDA files. Otherwise any network 
+    from network.py can be passed in directly.
+
+    With prune=True only the part of the network reachable from yinit is 
+    integrated (see network.PrunedNetwork). The results are still returned 
+    for every species, in the original order.
+
+    backend names the solver (see backends.py). After run() the solver 
+    statistics are in stats. A monitor (instrumentation.Monitor) also gets 
+    the parse and compile phases of from_settings and the integrate and 
+    write phases of run().
+
+    times are the output times in days (see output_times), None for every 
+    step. A checkpoint (checkpoint.Checkpointer) saves the state of the run 
+    as it goes, and conservation (conservation.ConservationMonitor) checks 
+    the element totals of every step. With initial_state, a state loaded by 
+    checkpoint.load, the run starts from its time and abundances instead of 
+    start_time and yinit; without a writer run() then only returns the 
+    steps from there on.
+    '''
+    def __init__(self, network, yinit, model_type, density, temperature,
+                 start_time, end_time, spec_dict=None, atol=1.e-12,
+                 rtol=1.e-12, writer=None, name='Chemnet', verbose=False,
+                 prune=False, backend='auto', monitor=None, checkpoint=None,
+                 initial_state=None, conservation=None, times=None):
+        self.network = network
+        self.yinit = np.asarray(yinit, dtype=float)
+        self.model_type = model_type
+        self.density = density
+        self.temperature = temperature
+        self.start_time = start_time
+        self.initial_state = initial_state
+        if initial_state is not None:
+            self.yinit = np.asarray(initial_state['y'], dtype=float)
+            self.start_time = initial_state['t'] / 86400
+        self.end_time = end_time
+        self.spec_dict = spec_dict or {}
+        self.atol = atol
+        self.rtol = rtol
+        self.writer = writer
+        self.name = name
+        self.verbose = verbose
+        self.prune = prune
+        self.backend = backend
+        self.monitor = monitor
+        self.checkpoint = checkpoint
+        self.conservation = conservation
+        self.times = times
+        self.stats = None
+
+    @classmethod
+    def from_settings(cls, settings='settings.ini', abundances='abundances.ini',
+                      reac_file='data/kida_reac_C_O_Si_only.dat',
+                      spec_file='data/kida_spec_C_O_Si_only.dat', resume=False,
+                      warm_start=None, **kwargs):
+        '''
+        Read the settings and initial abundances files and compile the 
+        network they describe. settings is the path of the settings file or 
+        the file parsed by datainput.read_settings. Keyword arguments are 
+        passed on to Simulation.
+
+        With resume the run continues from the checkpoint file named in the 
+        [checkpoint] section, which must have been saved with the same 
+        network and settings (the end time may differ unless it sets the 
+        output times, see checkpoint.py), and so does its trajectory. warm_start is the path of a checkpoint of the same 
+        network to start this model from instead of the initial abundances.
+        '''
+        config = d.read_settings(settings)
+        file_format, species_file, reactions_file, output_file, model_type, \
+            density, temperature, start_time, end_time, outfile = d.settings(config)
+        tabulate, rate_tolerance, clamp_rates = d.rate_settings(config)
+        grains = d.grain_settings(config)
+        cache_dir = d.cache_settings(config)
+        output = d.output_settings(config)
+        kwargs.setdefault('prune', d.prune_settings(config))
+        backend, atol, rtol = d.solver_settings(config)
+        kwargs.setdefault('backend', backend)
+        kwargs.setdefault('atol', atol)
+        kwargs.setdefault('rtol', rtol)
+        checkpoints, checkpoint_file, interval = d.checkpoint_settings(config)
+        checkpoint_file = checkpoint_file or output_file + '.checkpoint.npz'
+        conservation_tolerance = d.conservation_settings(config)
+        colliders = d.collider_settings(config)
+        sampling = d.sampling_settings(config)
+        kwargs.setdefault('times', output_times(*sampling, start_time, end_time))
+
+        monitor = kwargs.get('monitor')
+
+        kida_file = cip.Kida(reac_file, spec_file)
+        with instr.phase(monitor, 'parse'):
+            if cache_dir is None:
+                kida_file.read_species()
+                kida_file.read_reactions()
+            else:
+                kida_file.load(cache_dir)
+        kida_reac, kida_spec, spec_dict = kida_file.output()
+
+        T_range = [m.conditions(model_type, t * 86400, density, temperature)[0]
+                   for t in (start_time, end_time)]
+        with instr.phase(monitor, 'compile'):
+            network, grains_spec = network_from_settings(config, kida_file, model_type,
+                                                         min(T_range), max(T_range))
+        spec_dict = species_dictionary(spec_dict, grains_spec)
+
+        abund_df = d.abundances(spec_dict, abundances)
+        yinit = np.zeros([network.num_species])
+        yinit[abund_df.Species.values] = abund_df.Abundance.values
+
+        network_key = ckpt.digest(kida_file.cache_key(), grains)
+        settings_key = ckpt.digest(network_key, model_type, density, temperature,
+                                   start_time, tabulate, rate_tolerance, clamp_rates,
+                                   colliders, sampling, kwargs['prune'], kwargs['backend'], kwargs['atol'],
+                                   kwargs['rtol'])
+        keep_rows = None
+        if resume:
+            state = ckpt.load(checkpoint_file)
+            ckpt.check(state, network_key, settings_key, checkpoint_file,
+                       kwargs['times'])
+            kwargs['initial_state'] = state
+            keep_rows = state['rows']
+        elif warm_start is not None:
+            state = ckpt.load(warm_start)
+            ckpt.check(state, network_key, path=warm_start)
+            kwargs['initial_state'] = state
+        if checkpoints and 'checkpoint' not in kwargs:
+            kwargs['checkpoint'] = ckpt.Checkpointer(checkpoint_file, interval,
+                                                     network_key, settings_key,
+                                                     kwargs['times'])
+
+        elements = kida_file.composition(network.num_species)
+        if grains_spec is not None:
+            elements = cons.add_grain_mass(*elements, grains_spec)
+        if conservation_tolerance is not None and 'conservation' not in kwargs:
+            kwargs['conservation'] = cons.ConservationMonitor(*elements,
+                                                              rtol=conservation_tolerance)
+
+        if output is not None and 'writer' not in kwargs:
+            stored_species, precision, chunk_size = output
+            names = {index: name for name, index in spec_dict.items() if name != 'Pho'}
+            if stored_species is not None:
+                stored_species = [spec_dict[name] for name in stored_species]
+            masses = dict(zip(kida_spec.species_num, kida_spec.atom_num))
+            kwargs['writer'] = traj.TrajectoryWriter(
+                output_file + '.traj', network.num_species, stored_species, names,
+                precision, chunk_size, masses=masses, keep_rows=keep_rows,
+                elements=elements)
+
+        return cls(network, yinit, model_type, density, temperature, start_time,
+                   end_time, spec_dict=spec_dict, **kwargs)
+
+    def conditions(self, t):
+        '''
+        Temperature and number density at time t (in seconds).
+        '''
+        return m.conditions(self.model_type, t, self.density, self.temperature)
+
+    def run(self):
+        '''
+        Integrate from start_time to end_time. Returns the times in days and 
+        the abundances, or the memory-mapped trajectory if a writer was 
+        given (see trajectory.load).
+        '''
+        network, yinit, writer = self.network, self.yinit, self.writer
+        if self.prune:
+            network = net.PrunedNetwork(self.network, self.yinit)
+            yinit = network.reduce(self.yinit)
+            if writer is not None:
+                writer = _ExpandingWriter(writer, network)
+            if self.verbose:
+                print('Pruned to {0} of {1} species'.format(network.num_species,
+                                                          self.network.num_species))
+        if self.checkpoint is not None:
+            self.checkpoint.expand = network.expand if self.prune else None
+        if self.conservation is not None:
+            self.conservation.species = network.keep if self.prune else None
+        first_step = None if self.initial_state is None else self.initial_state['step']
+
+        backend = backends.get_backend(self.backend, atol=self.atol, rtol=self.rtol)
+        try:
+            with instr.phase(self.monitor, 'integrate'):
+                t, y = integrate(network, yinit, self.model_type, self.density,
+                                 self.temperature, self.start_time, self.end_time,
+                                 name=self.name, writer=writer, verbose=self.verbose,
+                                 backend=backend, monitor=self.monitor,
+                                 checkpoint=self.checkpoint, first_step=first_step,
+                                 conservation=self.conservation, times=self.times)
+        finally:
+            self.stats = backend.stats
+        if self.writer is None:
+            return t, network.expand(y) if self.prune else y
+        with instr.phase(self.monitor, 'write'):
+            self.writer.close()
+        t, y, meta = traj.load(self.writer.path)
+        return t, y
+
+    def columns(self):
+        '''
+        Column of each species name in the arrays returned by run().
+        '''
+        if self.writer is None:
+            return {name: index for name, index in self.spec_dict.items() if name != 'Pho'}
+        names = {index: name for name, index in self.spec_dict.items() if name != 'Pho'}
+        return {names.get(int(index), str(index)): n
+                for n, index in enumerate(self.writer.species)}
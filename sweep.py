@@ -0,0 +1,310 @@
+# -*- coding: utf-8 -*-
+"""
+sweep.py - Parameter Sweeps over Density, Temperature and Initial Abundances
+
+This file is part of CarBoN
+
+The KIDA network is parsed and compiled once, with the same settings.ini
+sections as CarBoNpy.py (rates, grains, colliders, JIT, solver, pruning
+and output sampling), and handed to a pool of worker processes, which
+integrate one parameter set each. Every run is written to
+its own output/<sweep>/run_<n>.npz file and listed in index.csv together with
+its parameters, status and wall time. A run that raises or goes over the
+timeout is marked as failed without stopping the rest of the sweep.
+
+index.csv also holds the solver counters of every run (see
+instrumentation.py) and the time it got to, so slow or failed runs can be
+told apart: many rejected steps, many Jacobians, or stuck at some t.
+Besides time and y, every .npz file holds names, the species name of each
+column of y, so it can be read without the KIDA files.
+
+With --zones N the parameter sets are instead integrated in batches of N
+zones, each batch as one network.Ensemble with a single CVode instance.
+This saves the per-model solver overhead for small networks. A batch is
+written to batch_<n>.npz, and a failure or timeout marks its whole batch.
+
+Usage:
+    python sweep.py --density 1e9 1e10 --temperature 2000 4000 \
+                    --abundance C=1e10 O=1e10,1e11 Si=1e9 -j 8 -o output/sweep
+    python sweep.py --temperature 1000 2000 4000 8000 --zones 64
+    python sweep.py --settings other.ini --density 1e9 1e10
+
+"""
+
+import argparse
+import csv
+import itertools
+import multiprocessing as mp
+import os
+import signal
+import time
+from contextlib import contextmanager
+
+import numpy as np
+
+import CarBoN_Input_Processor as cip
+import datainput as d
+import instrumentation as instr
+import models as m
+import network as net
+import simulation as sim
+
+
+def parameter_grid(density, temperature, abundances):
+    '''
+    All combinations of the given densities, temperatures and initial
+    abundances. abundances maps a species name to a list of values.
+    '''
+    names = list(abundances)
+    param_sets = []
+    for dens, temp, *values in itertools.product(density, temperature,
+                                                 *abundances.values()):
+        param_sets.append({'density': dens, 'temperature': temp,
+                           'abundances': dict(zip(names, values))})
+    return param_sets
+
+
+@contextmanager
+def _time_limit(seconds):
+    # SIGALRM is only available on Unix; elsewhere runs are not timed out
+    if not seconds or not hasattr(signal, 'SIGALRM'):
+        yield
+        return
+
+    def handler(signum, frame):
+        raise TimeoutError("Run took longer than {0} s".format(seconds))
+
+    previous = signal.signal(signal.SIGALRM, handler)
+    signal.setitimer(signal.ITIMER_REAL, seconds)
+    try:
+        yield
+    finally:
+        signal.setitimer(signal.ITIMER_REAL, 0)
+        signal.signal(signal.SIGALRM, previous)
+
+
+_shared = {}
+
+MONITORED = ('steps', 'rejected_steps', 'rhs_evaluations', 'jacobian_evaluations',
+             'nonlinear_iterations', 'time_reached')
+
+def _init_worker(network, spec_dict, model_type, start_time, end_time, options):
+    _shared.update(network=network, spec_dict=spec_dict, model_type=model_type,
+                   start_time=start_time, end_time=end_time, options=options,
+                   names=_column_names(network.num_species, spec_dict))
+
+
+def _column_names(num_species, spec_dict):
+    # Name of each column of y, as in the trajectory.json of a run
+    names = {index: name for name, index in spec_dict.items() if name != 'Pho'}
+    return np.array([names.get(index, str(index)) for index in range(num_species)])
+
+
+def _counters(monitor):
+    row = {key: monitor.counters.get(key) for key in MONITORED}
+    row['time_reached'] = None if monitor.t is None else monitor.t / 86400
+    return row
+
+
+def _run_task(task):
+    index, params, path, timeout = task
+    row = {'run': index, 'density': params['density'],
+           'temperature': params['temperature']}
+    row.update(params['abundances'])
+
+    monitor = instr.Monitor('Sweep run {0}'.format(index))
+    start = time.time()
+    try:
+        with _time_limit(timeout):
+            network = _shared['network']
+            yinit = sim.initial_abundances(network.num_species, _shared['spec_dict'],
+                                           params['abundances'])
+            simulation = sim.Simulation(network, yinit, _shared['model_type'],
+                                        params['density'], params['temperature'],
+                                        _shared['start_time'], _shared['end_time'],
+                                        name='Sweep run {0}'.format(index),
+                                        monitor=monitor, **_shared['options'])
+            t, y = simulation.run()
+            np.savez(path, time=t, y=y, names=_shared['names'], density=params['density'],
+                     temperature=params['temperature'],
+                     species=np.array(list(params['abundances'])),
+                     abundance=np.array(list(params['abundances'].values())))
+        row.update(status='ok', file=os.path.basename(path), error='')
+    except TimeoutError as e:
+        row.update(status='timeout', file='', error=str(e))
+    except Exception as e:
+        row.update(status='failed', file='', error='{0}: {1}'.format(type(e).__name__, e))
+    row['wall_time'] = time.time() - start
+    row.update(_counters(monitor))
+    return [row]
+
+
+def _run_batch(task):
+    runs, param_sets, path, timeout = task
+    rows = []
+    for zone, (index, params) in enumerate(zip(runs, param_sets)):
+        row = {'run': index, 'zone': zone, 'density': params['density'],
+               'temperature': params['temperature']}
+        row.update(params['abundances'])
+        rows.append(row)
+
+    monitor = instr.Monitor('Sweep runs {0}-{1}'.format(runs[0], runs[-1]))
+    start = time.time()
+    try:
+        with _time_limit(timeout):
+            network = _shared['network']
+            options = dict(_shared['options'])
+            yinit = np.array([sim.initial_abundances(network.num_species,
+                                                     _shared['spec_dict'], params['abundances'])
+                              for params in param_sets])
+            pruned = None
+            if options.pop('prune'):
+                # Everything reachable from any of the zones
+                pruned = net.PrunedNetwork(network, yinit.max(axis=0))
+                network, yinit = pruned.network, pruned.reduce(yinit)
+            density = [params['density'] for params in param_sets]
+            temperature = [params['temperature'] for params in param_sets]
+            t, y = sim.integrate_ensemble(network, yinit, _shared['model_type'],
+                                          density, temperature,
+                                          _shared['start_time'], _shared['end_time'],
+                                          name=monitor.name, monitor=monitor, **options)
+            if pruned is not None:
+                y = pruned.expand(y)
+            np.savez(path, time=t, y=y, names=_shared['names'], run=np.array(runs),
+                     density=density, temperature=temperature)
+        result = dict(status='ok', file=os.path.basename(path), error='')
+    except TimeoutError as e:
+        result = dict(status='timeout', file='', error=str(e))
+    except Exception as e:
+        result = dict(status='failed', file='', error='{0}: {1}'.format(type(e).__name__, e))
+    result['wall_time'] = time.time() - start
+    result.update(_counters(monitor))
+    for row in rows:
+        row.update(result)
+    return rows
+
+
+def run_sweep(network, spec_dict, param_sets, output_dir, model_type,
+              start_time, end_time, processes=None, timeout=None, zones=1,
+              backend='auto', atol=1.e-12, rtol=1.e-12, prune=False, times=None):
+    '''
+    Integrate every parameter set on a pool of worker processes.
+
+    param_sets is a list of {'density', 'temperature', 'abundances'}
+    dictionaries (see parameter_grid). The network is sent to each worker
+    once, when the pool starts. With zones > 1 the parameter sets are
+    integrated in ensembles of that many zones, and the timeout applies to
+    a whole ensemble. backend, atol, rtol, prune and times (in days) are
+    the solver and output options of simulation.Simulation; an ensemble is
+    pruned to what any of its zones can reach. Returns the rows written to
+    output_dir/index.csv, in order of completion.
+    '''
+    options = dict(backend=backend, atol=atol, rtol=rtol, prune=prune, times=times)
+    os.makedirs(output_dir, exist_ok=True)
+    if zones > 1:
+        run = _run_batch
+        tasks = [(list(range(n, min(n + zones, len(param_sets)))),
+                  param_sets[n:n + zones],
+                  os.path.join(output_dir, 'batch_{0}.npz'.format(n // zones)), timeout)
+                 for n in range(0, len(param_sets), zones)]
+    else:
+        run = _run_task
+        tasks = [(n, params, os.path.join(output_dir, 'run_{0}.npz'.format(n)), timeout)
+                 for n, params in enumerate(param_sets)]
+
+    species = sorted(set(name for params in param_sets for name in params['abundances']))
+    fields = ['run', 'status', 'density', 'temperature'] + species + \
+             ['wall_time'] + list(MONITORED) + ['file', 'error']
+    if zones > 1:
+        fields.insert(1, 'zone')
+
+    rows = []
+    with open(os.path.join(output_dir, 'index.csv'), 'w', newline='') as index, \
+         mp.Pool(processes, initializer=_init_worker,
+                 initargs=(network, spec_dict, model_type, start_time, end_time,
+                           options)) as pool:
+        writer = csv.DictWriter(index, fieldnames=fields)
+        writer.writeheader()
+        for result in pool.imap_unordered(run, tasks):
+            writer.writerows(result)
+            index.flush()
+            rows.extend(result)
+            print('Run {0} {1} in {2:.1f} s ({3}/{4})'.format(
+                ', '.join(str(row['run']) for row in result), result[0]['status'],
+                result[0]['wall_time'], len(rows), len(param_sets)))
+    return rows
+
+
+def _abundance(text):
+    name, values = text.split('=')
+    return name, [float(v) for v in values.split(',')]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Run a grid of CarBoN models "
+                                     "in parallel.")
+    parser.add_argument("--settings", default="settings.ini")
+    parser.add_argument("--abundances", default="abundances.ini")
+    parser.add_argument("--reac", help="path to KIDA reactions file",
+                        default="data/kida_reac_C_O_Si_only.dat")
+    parser.add_argument("--spec", help="path to KIDA species file",
+                        default="data/kida_spec_C_O_Si_only.dat")
+    parser.add_argument("--density", type=float, nargs='+', default=None,
+                        help="densities (default: Density in the settings)")
+    parser.add_argument("--temperature", type=float, nargs='+', default=None,
+                        help="temperatures (default: Temperature in the settings)")
+    parser.add_argument("--abundance", type=_abundance, nargs='*', default=[],
+                        help="initial abundances as NAME=v1,v2,...; species "
+                             "not given are taken from abundances.ini")
+    parser.add_argument("-j", "--processes", type=int, default=None,
+                        help="number of worker processes (default: all cores)")
+    parser.add_argument("--timeout", type=float, default=None,
+                        help="wall time limit per run in seconds")
+    parser.add_argument("--zones", type=int, default=1,
+                        help="integrate this many parameter sets at once as "
+                             "one ensemble (default: 1, separate runs)")
+    parser.add_argument("--backend", default=None,
+                        help="solver backend: auto, cvode, bdf, radau or lsoda "
+                             "(default: Backend in the settings)")
+    parser.add_argument("--cache", default=None,
+                        help="directory of compiled network caches "
+                             "(default: from the settings)")
+    parser.add_argument("-o", "--output", default="output/sweep")
+    args = parser.parse_args()
+
+    config = d.read_settings(args.settings)
+    file_format, species_file, reactions_file, output_file, model_type, density, \
+        temperature, start_time, end_time, outfile = d.settings(config)
+    density = args.density or [density]
+    temperature = args.temperature or [temperature]
+    backend, atol, rtol = d.solver_settings(config)
+    cache_dir = args.cache or d.cache_settings(config)
+    times = sim.output_times(*d.sampling_settings(config), start_time, end_time)
+
+    kida_file = cip.Kida(args.reac, args.spec)
+    if cache_dir is None:
+        kida_file.read_species()
+        kida_file.read_reactions()
+    else:
+        kida_file.load(cache_dir)
+    kida_reac, kida_spec, spec_dict = kida_file.output()
+    # Tabulated rates have to cover the temperatures of every parameter set
+    T_range = [m.conditions(model_type, t * 86400, dens, temp)[0]
+               for t in (start_time, end_time) for dens in density for temp in temperature]
+    network, grains_spec = sim.network_from_settings(config, kida_file, model_type,
+                                                     min(T_range), max(T_range))
+    spec_dict = sim.species_dictionary(spec_dict, grains_spec)
+
+    abund_df = d.abundances(spec_dict, args.abundances)
+    inverse_dict = {v: k for k, v in spec_dict.items() if k != 'Pho'}
+    abundances = {inverse_dict[i]: [a] for i, a in zip(abund_df.Species, abund_df.Abundance)}
+    abundances.update(args.abundance)
+
+    param_sets = parameter_grid(density, temperature, abundances)
+    rows = run_sweep(network, spec_dict, param_sets, args.output, model_type,
+                     start_time, end_time, args.processes, args.timeout, args.zones,
+                     args.backend or backend, atol, rtol, d.prune_settings(config),
+                     times)
+    failed = sum(row['status'] != 'ok' for row in rows)
+    print('{0} runs, {1} failed. Index written to {2}'.format(
+        len(rows), failed, os.path.join(args.output, 'index.csv')))
@@ -0,0 +1,50 @@
+# -*- coding: utf-8 -*-
+"""
+Grain coagulation run through the command line entry point, CarBoNpy.main.
+"""
+
+import configparser
+import os
+
+import numpy as np
+
+import CarBoN_Input_Processor as cip
+import CarBoNpy
+import datainput as d
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+REAC = os.path.join(ROOT, 'data', 'kida_reac_C_O_Si_only.dat')
+SPEC = os.path.join(ROOT, 'data', 'kida_spec_C_O_Si_only.dat')
+
+
+def test_seeded_grain_bins_conserve_mass(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    config = configparser.ConfigParser()
+    config.read(os.path.join(ROOT, 'settings.ini'))
+    config['files']['output file'] = str(tmp_path / 'run')
+    config['solver'].update({'backend': 'bdf', 'absolute tolerance': '1e-6',
+                             'relative tolerance': '1e-8', 'jit': 'no'})
+    config['grains']['grains'] = 'yes'
+    config['cache']['cache'] = 'no'
+    with open('settings.ini', 'w') as f:
+        config.write(f)
+    with open('abundances.ini', 'w') as f:
+        f.write("Species Abundance\nC       1e10\nO       1e10\nSi      1e9\n"
+                "G1      1e6\nG3      1e5\n")
+
+    t, y = CarBoNpy.main(['--reac', REAC, '--spec', SPEC, '--headless', '-q'])
+
+    kida_file = cip.Kida(REAC, SPEC)
+    kida_file.read_species()
+    num_gas = len(kida_file.species_dataframe().index)
+    grains_spec = cip.Grains(*d.grain_settings(d.read_settings()), num_gas - 1).output()[1]
+    bins = grains_spec.species_num.to_numpy()
+    assert bins[0] == num_gas
+
+    # The seeded bins start where abundances.ini put them and coagulate
+    assert y[0, bins[0]] == 1e6 and y[0, bins[2]] == 1e5
+    assert y[-1, bins[0]] < y[0, bins[0]]
+    assert y[-1, bins[1]] > 0
+
+    mass = y[:, bins] @ grains_spec.mass.to_numpy()
+    np.testing.assert_allclose(mass, mass[0], rtol=1e-10)
@@ -0,0 +1,292 @@
+# -*- coding: utf-8 -*-
+"""
+trajectory.py - On-disk Trajectories
+
+This file is part of CarBoN
+
+A trajectory is a directory holding
+
+    trajectory.json   species names, indices, masses and element counts,
+                      precision, time unit
+    time.bin          float64 times, one per row
+    y.bin             abundances, one row of the stored species per time
+
+The .bin files are raw little-endian arrays that grow by whole chunks while
+the solver runs, so they can be memory-mapped at any time. If a run dies,
+everything up to the last written chunk is still readable.
+
+"""
+
+import json
+import os
+
+import numpy as np
+
+
+class TrajectoryWriter:
+    '''
+    Appends the time and abundances of every solver step to a trajectory
+    directory, keeping at most chunk_size rows in memory.
+
+    species is a list of indices into the solution vector to store (all of
+    them by default), names maps those indices to species names and masses
+    to the species masses used for the mass conservation check. elements
+    is the (matrix, names) pair from Kida.composition, kept for
+    conservation.check_trajectory. With
+    precision='single' the abundances are stored as float32, which halves
+    the file size; abundances below ~1e-38 are then stored as 0.
+
+    Pass handle_result as the handle_result of an assimulo problem to write
+    the steps as they are taken, e.g. through simulation.integrate.
+
+    With keep_rows the trajectory already at path is continued: its first
+    keep_rows rows are kept and anything after them is overwritten. This is
+    how a run resumed from a checkpoint carries on (see checkpoint.py).
+    '''
+    def __init__(self, path, num_species, species=None, names=None,
+                 precision='double', chunk_size=4096, time_unit='days',
+                 time_scale=1 / 86400, masses=None, keep_rows=None, elements=None):
+        if precision not in ('double', 'single'):
+            raise ValueError("Unknown precision {0}, use double or single".format(precision))
+        self.path = path
+        self.species = np.arange(num_species) if species is None \
+            else np.asarray(species, dtype=np.int64)
+        self.dtype = np.dtype('<f8') if precision == 'double' else np.dtype('<f4')
+        self.chunk_size = chunk_size
+        self.time_scale = time_scale
+        self.rows = 0
+        self._t = np.empty(chunk_size)
+        self._y = np.empty((chunk_size, len(self.species)), dtype=self.dtype)
+        self._n = 0
+
+        names = names or {}
+        os.makedirs(path, exist_ok=True)
+        meta = {'num_species': int(num_species),
+                'species': self.species.tolist(),
+                'names': [names.get(int(i), str(i)) for i in self.species],
+                'dtype': self.dtype.str,
+                'masses': None if masses is None else
+                          [float(masses.get(int(i), np.nan)) for i in self.species],
+                'elements': None if elements is None else
+                            {name: elements[0][self.species, n].tolist()
+                             for n, name in enumerate(elements[1])},
+                'time_unit': time_unit}
+        time_file, y_file = os.path.join(path, 'time.bin'), os.path.join(path, 'y.bin')
+        if keep_rows is not None:
+            t, y, old = load(path)
+            if old['species'] != meta['species'] or old['dtype'] != meta['dtype']:
+                raise ValueError("Can not continue {0}: it stores other species or "
+                                 "another precision".format(path))
+            if keep_rows > len(t):
+                raise ValueError("Can not continue {0}: it has {1} rows, not {2}"
+                                 .format(path, len(t), keep_rows))
+            del t, y
+            os.truncate(time_file, keep_rows * 8)
+            os.truncate(y_file, keep_rows * len(self.species) * self.dtype.itemsize)
+            self.rows = keep_rows
+        with open(os.path.join(path, 'trajectory.json'), 'w') as f:
+            json.dump(meta, f, indent=1)
+        mode = 'wb' if keep_rows is None else 'ab'
+        self._time_file = open(time_file, mode)
+        self._y_file = open(y_file, mode)
+
+    def append(self, t, y):
+        '''
+        Add the abundances y (the full solution vector) at time t.
+        '''
+        self._t[self._n] = t * self.time_scale
+        self._y[self._n] = y[self.species]
+        self._n += 1
+        if self._n == self.chunk_size:
+            self.flush()
+
+    def extend(self, t, y):
+        '''
+        Add many rows at once: the times t and the solution vectors y, one 
+        per row. They are written straight to disk.
+        '''
+        self.flush()
+        (np.asarray(t, dtype=float) * self.time_scale).astype('<f8').tofile(self._time_file)
+        np.asarray(y)[:, self.species].astype(self.dtype).tofile(self._y_file)
+        self.rows += len(t)
+
+    def handle_result(self, solver, t, y):
+        self.append(t, y)
+
+    def flush(self):
+        '''
+        Write the buffered rows to disk.
+        '''
+        if self._n:
+            self._t[:self._n].astype('<f8').tofile(self._time_file)
+            self._y[:self._n].tofile(self._y_file)
+            self.rows += self._n
+            self._n = 0
+        self._time_file.flush()
+        self._y_file.flush()
+
+    def close(self):
+        if not self._time_file.closed:
+            self.flush()
+            self._time_file.close()
+            self._y_file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load(path, mmap_mode='r'):
+    '''
+    Memory-map a trajectory. Returns the times, the abundances with one
+    column per stored species, and the metadata from trajectory.json.
+    '''
+    with open(os.path.join(path, 'trajectory.json')) as f:
+        meta = json.load(f)
+    dtype = np.dtype(meta['dtype'])
+    columns = len(meta['species'])
+    # A run that died may have left part of a row in one of the files
+    rows = min(os.path.getsize(os.path.join(path, 'time.bin')) // 8,
+               os.path.getsize(os.path.join(path, 'y.bin')) // (columns * dtype.itemsize or 1))
+    if rows == 0:
+        return np.zeros(0), np.zeros((0, columns), dtype=dtype), meta
+    t = np.memmap(os.path.join(path, 'time.bin'), dtype='<f8', mode=mmap_mode,
+                  shape=(rows,))
+    y = np.memmap(os.path.join(path, 'y.bin'), dtype=dtype, mode=mmap_mode,
+                  shape=(rows, columns))
+    return t, y, meta
+
+
+class TrajectoryReader:
+    '''
+    Read-only access to a stored run: a trajectory directory, which is
+    memory-mapped, or an .npz file written by np.savez with time, y,
+    speciesidx and speciesmass entries.
+
+    Nothing is read until it is asked for. species() takes names and reads
+    just those columns, and decimate() reduces them to a plottable number
+    of points without losing spikes.
+    '''
+    def __init__(self, path):
+        self.path = path
+        if os.path.isdir(path):
+            self.time, self._y, self.meta = load(path)
+            self.names = self.meta['names']
+            self.masses = self.meta.get('masses')
+            self.elements = self.meta.get('elements')
+            self.time_unit = self.meta['time_unit']
+        else:
+            infile = np.load(path, allow_pickle=True)
+            speciesidx = infile['speciesidx'][()]
+            speciesmass = infile['speciesmass'][()]
+            self.time, self._y = infile['time'], infile['y']
+            self.names = [str(n) for n in range(self._y.shape[1])]
+            self.masses = [np.nan] * self._y.shape[1]
+            for name, index in speciesidx.items():
+                if index != 99:
+                    self.names[index] = name
+                    self.masses[index] = speciesmass[name]
+            self.elements = None
+            self.time_unit = 'years'
+        self.columns = {name: n for n, name in enumerate(self.names)}
+
+    def __len__(self):
+        return len(self.time)
+
+    def _columns(self, names):
+        if names is None:
+            return list(range(len(self.names)))
+        missing = [name for name in names if name not in self.columns]
+        if missing:
+            raise KeyError("Species {0} not stored in {1}".format(missing, self.path))
+        return [self.columns[name] for name in names]
+
+    def species(self, names=None):
+        '''
+        Abundances of the named species (all by default), one column each.
+        '''
+        return np.asarray(self._y[:, self._columns(names)])
+
+    def blocks(self, block_size=1 << 16):
+        '''
+        The times and abundances of all stored species, block_size rows at 
+        a time.
+        '''
+        for a in range(0, len(self), block_size):
+            yield np.asarray(self.time[a:a + block_size]), \
+                np.asarray(self._y[a:a + block_size])
+
+    def total(self, weights=None, block_size=1 << 16):
+        '''
+        Weighted sum over all stored species at each time, e.g. the total
+        mass for the mass conservation check (the default weights are the
+        species masses). Read in blocks so memory use stays small.
+        '''
+        if weights is None:
+            weights = self.masses
+        weights = np.nan_to_num(np.asarray(weights, dtype=float))
+        total = np.empty(len(self))
+        for a in range(0, len(self), block_size):
+            total[a:a + block_size] = self._y[a:a + block_size] @ weights
+        return total
+
+    def decimate(self, names=None, max_points=4000, log_time=True,
+                 block_size=1 << 16):
+        '''
+        Reduce the named species to about max_points samples each for
+        plotting.
+
+        The time axis is split into max_points/2 bins (log-spaced if
+        log_time and the times are positive) and in each bin the samples
+        with the smallest and largest abundance of every species are kept,
+        so peaks and dips survive. The rows are read once, in order.
+
+        Returns the time array and abundance array of each species.
+        '''
+        columns = self._columns(names)
+        rows = len(self)
+        if rows <= max_points:
+            t = np.asarray(self.time)
+            y = self.species(names)
+            return [t] * len(columns), [y[:, n] for n in range(len(columns))]
+
+        t_first, t_last = float(self.time[0]), float(self.time[-1])
+        bins = max(max_points // 2, 1)
+        if log_time and t_first > 0:
+            edges = np.geomspace(t_first, t_last, bins + 1)
+        else:
+            edges = np.linspace(t_first, t_last, bins + 1)
+        starts = np.unique(np.concatenate([[0], np.searchsorted(self.time, edges[1:-1]),
+                                           [rows]]))
+
+        keep = []
+        for lo, hi in zip(starts[:-1], starts[1:]):
+            low = high = None
+            for a in range(lo, hi, block_size):
+                block = np.asarray(self._y[a:min(a + block_size, hi)][:, columns])
+                arg_min, arg_max = block.argmin(axis=0), block.argmax(axis=0)
+                n = np.arange(len(columns))
+                if low is None:
+                    low, low_val = arg_min + a, block[arg_min, n]
+                    high, high_val = arg_max + a, block[arg_max, n]
+                    continue
+                better = block[arg_min, n] < low_val
+                low = np.where(better, arg_min + a, low)
+                low_val = np.where(better, block[arg_min, n], low_val)
+                better = block[arg_max, n] > high_val
+                high = np.where(better, arg_max + a, high)
+                high_val = np.where(better, block[arg_max, n], high_val)
+            keep.append(np.minimum(low, high))
+            keep.append(np.maximum(low, high))
+        keep = np.array(keep)
+        keep = np.concatenate([np.zeros((1, len(columns)), dtype=np.int64), keep,
+                               np.full((1, len(columns)), rows - 1)])
+
+        times, values = [], []
+        for n, column in enumerate(columns):
+            rows_n = np.unique(keep[:, n])
+            times.append(np.asarray(self.time[rows_n]))
+            values.append(np.asarray(self._y[rows_n, column]))
+        return times, values